@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package AsyncSmartDrive
+# asyncio front end for the SmartDrive motor controller. Needs Python 3.7+.
+#
+# Every I2C transaction of every controller on one bus runs on a single
+# worker thread owned by that bus; waiting for a move to finish follows the
+# drive's wait engine schedule with asyncio.sleep on the event loop, so no
+# thread is tied up per wait.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import weakref
+
+from SmartDrive import SmartDrive
+from SmartDriveTransport import BusTransport
+from SmartDriveWait import STATUS_TIME, STATUS_TACHO
+
+# executor per bus, dropped with the bus
+_executors = weakref.WeakKeyDictionary()
+# buses that cannot be weakly referenced; the bus is kept alive with its
+# executor so its id is never reused
+_pinned = {}
+_executors_lock = threading.Lock()
+
+## Returns the single-thread executor that serializes access to a bus
+#  SmartDrives reach a bus through the transport under their wrappers,
+#  shared by every SmartDrive on it (see SharedSMBusTransport), so pass
+#  BusTransport(drive.transport).
+#  @param bus The bus transport shared by the SmartDrive instances.
+def bus_executor(bus):
+    with _executors_lock:
+        try:
+            executor = _executors.get(bus)
+            if executor is None:
+                executor = _executors[bus] = ThreadPoolExecutor(max_workers = 1)
+        except TypeError:
+            entry = _pinned.get(id(bus))
+            if entry is None:
+                entry = _pinned[id(bus)] = (bus, ThreadPoolExecutor(max_workers = 1))
+            executor = entry[1]
+        return executor
+
+## AsyncSmartDrive: coroutine wrapper around a SmartDrive
+class AsyncSmartDrive(object):
+
+    ## Initialize the wrapper
+    #  @param self The object pointer.
+    #  @param SmartDrive_address Address of your SmartDrive, used if drive is not given.
+    #  @param drive An existing SmartDrive to wrap.
+    def __init__(self, SmartDrive_address = SmartDrive.SmartDrive_ADDRESS, drive = None):
+        if drive is None:
+            drive = SmartDrive(SmartDrive_address)
+        self.drive = drive
+        self.executor = bus_executor(BusTransport(drive.transport))
+        # completion polling follows the drive's own wait engine settings
+        self.wait_engine = drive.wait_engine
+
+    ## Runs fn(*args) on the bus thread and returns its result
+    #  @param self The object pointer.
+    #  @param fn The blocking SmartDrive call to make.
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def _status(self):
+        status = bytearray(2)
+        await self.call(self.drive.readBlockInto, self.drive.SmartDrive_STATUS_M1, status, 0, 2)
+        return status
+
+    ## Resolves when the given status bit has cleared on the motor(s)
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) to wait for.
+    #  @param bit STATUS_TIME or STATUS_TACHO.
+    #  @param estimate Expected duration of the move in seconds.
+    #  @exception SmartDrive_TimeoutError The motor(s) did not finish within the wait engine's timeout.
+    #  @return Seconds from the start of the wait until completion was seen; the wait engine's last_report has the details.
+    async def WaitDone(self, motor_number, bit, estimate = 0.0):
+        engine = self.wait_engine
+        loop = asyncio.get_running_loop()
+        schedule = engine.Schedule(motor_number, estimate, loop.time())
+        while True:
+            now = loop.time()
+            await asyncio.sleep(max(0.0, schedule.Next(now) - now))
+            status = await self._status()
+            now = loop.time()
+            if schedule.Done(now, engine.Busy(motor_number, status[0], status[1], bit)):
+                return schedule.Report(now).elapsed
+
+    ## Turns the specified motor(s) forever
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) you wish to turn.
+    #  @param direction The direction you wish to turn the motor(s).
+    #  @param speed The speed at which you wish to turn the motor(s).
+    async def SmartDrive_Run_Unlimited(self, motor_number, direction, speed):
+        await self.call(self.drive.SmartDrive_Run_Unlimited, motor_number, direction, speed)
+
+    ## Stops the specified motor(s)
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) you wish to stop.
+    #  @param next_action How you wish to stop the motor(s).
+    async def SmartDrive_Stop(self, motor_number, next_action):
+        await self.call(self.drive.SmartDrive_Stop, motor_number, next_action)
+
+    ## Turns the specified motor(s) for a given amount of seconds, resolves on completion
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) you wish to turn.
+    #  @param direction The direction you wish to turn the motor(s).
+    #  @param speed The speed at which you wish to turn the motor(s).
+    #  @param duration The time in seconds you wish to turn the motor(s).
+    #  @param wait_for_completion Await completion (default) or return once the command is sent.
+    #  @param next_action How you wish to stop the motor(s).
+    async def SmartDrive_Run_Seconds(self, motor_number, direction, speed, duration,
+                                     wait_for_completion = SmartDrive.SmartDrive_Completion_Wait_For,
+                                     next_action = SmartDrive.SmartDrive_Next_Action_Brake):
+        await self.call(self.drive.SmartDrive_Run_Seconds, motor_number, direction, speed, duration,
+                        SmartDrive.SmartDrive_Completion_Dont_Wait, next_action)
+        if wait_for_completion == SmartDrive.SmartDrive_Completion_Wait_For:
+            await self.WaitDone(motor_number, STATUS_TIME, duration)
+
+    ## Turns the specified motor(s) for given relative tacheometer count, resolves on completion
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) you wish to turn.
+    #  @param direction The direction you wish to turn the motor(s).
+    #  @param speed The speed at which you wish to turn the motor(s).
+    #  @param degrees The relative tacheometer count you wish to turn the motor(s).
+    #  @param wait_for_completion Await completion (default) or return once the command is sent.
+    #  @param next_action How you wish to stop the motor(s).
+    async def SmartDrive_Run_Degrees(self, motor_number, direction, speed, degrees,
+                                     wait_for_completion = SmartDrive.SmartDrive_Completion_Wait_For,
+                                     next_action = SmartDrive.SmartDrive_Next_Action_Brake):
+        await self.call(self.drive.SmartDrive_Run_Degrees, motor_number, direction, speed, degrees,
+                        SmartDrive.SmartDrive_Completion_Dont_Wait, next_action)
+        if wait_for_completion == SmartDrive.SmartDrive_Completion_Wait_For:
+            await self.WaitDone(motor_number, STATUS_TACHO, self.wait_engine.TachoEstimate(speed, degrees))
+
+    ## Turns the specified motor(s) for given relative rotations, resolves on completion
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) you wish to turn.
+    #  @param direction The direction you wish to turn the motor(s).
+    #  @param speed The speed at which you wish to turn the motor(s).
+    #  @param rotations The relative amount of rotations you wish to turn the motor(s).
+    #  @param wait_for_completion Await completion (default) or return once the command is sent.
+    #  @param next_action How you wish to stop the motor(s).
+    async def SmartDrive_Run_Rotations(self, motor_number, direction, speed, rotations,
+                                       wait_for_completion = SmartDrive.SmartDrive_Completion_Wait_For,
+                                       next_action = SmartDrive.SmartDrive_Next_Action_Brake):
+        await self.call(self.drive.SmartDrive_Run_Rotations, motor_number, direction, speed, rotations,
+                        SmartDrive.SmartDrive_Completion_Dont_Wait, next_action)
+        if wait_for_completion == SmartDrive.SmartDrive_Completion_Wait_For:
+            await self.WaitDone(motor_number, STATUS_TACHO, self.wait_engine.TachoEstimate(speed, rotations * 360))
+
+    ## Turns the specified motor(s) to an absolute tacheometer count, resolves on completion
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) you wish to turn.
+    #  @param speed The speed at which you wish to turn the motor(s).
+    #  @param tacho_count The absolute tacheometer count you wish to turn the motor(s) to.
+    #  @param wait_for_completion Await completion (default) or return once the command is sent.
+    #  @param next_action How you wish to stop the motor(s).
+    async def SmartDrive_Run_Tacho(self, motor_number, speed, tacho_count,
+                                   wait_for_completion = SmartDrive.SmartDrive_Completion_Wait_For,
+                                   next_action = SmartDrive.SmartDrive_Next_Action_Brake):
+        estimate = 0.0
+        if wait_for_completion == SmartDrive.SmartDrive_Completion_Wait_For:
+            snapshot = await self.ReadSnapshot()
+            delta = max(abs(tacho_count - snapshot.position_m1) if motor_number & 0x01 else 0,
+                        abs(tacho_count - snapshot.position_m2) if motor_number & 0x02 else 0)
+            estimate = self.wait_engine.TachoEstimate(speed, delta)
+        await self.call(self.drive.SmartDrive_Run_Tacho, motor_number, speed, tacho_count,
+                        SmartDrive.SmartDrive_Completion_Dont_Wait, next_action)
+        if wait_for_completion == SmartDrive.SmartDrive_Completion_Wait_For:
+            await self.WaitDone(motor_number, STATUS_TACHO, estimate)
+
+    ## Reads the tacheometer position of the specified motor
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor you wish to read.
+    async def ReadTachometerPosition(self, motor_number):
+        return await self.call(self.drive.ReadTachometerPosition, motor_number)
+
+    ## Reads the battery voltage
+    #  @param self The object pointer.
+    async def GetBattVoltage(self):
+        return await self.call(self.drive.GetBattVoltage)
+
+    ## Reads the whole read register block, see SmartDrive.ReadSnapshot
+    #  @param self The object pointer.
+    async def ReadSnapshot(self):
+        return await self.call(self.drive.ReadSnapshot)
@@ -25,8 +25,20 @@
 # This is the i2c module for OpenElectrons SmartDrive motor controller.
 
 from OpenElectrons_i2c import OpenElectrons_i2c
+from SmartDriveErrors import SmartDrive_TimeoutError, wrapBusError
+from SmartDriveRegisters import clock, FRAME, INT32, PID, UINT16
+from SmartDriveSnapshot import SmartDrive_Snapshot, SmartDrive_SnapshotArray, SNAPSHOT_START, SNAPSHOT_SIZE
+from SmartDriveTransport import SharedSMBusTransport
+from SmartDriveWait import SmartDrive_WaitEngine
+import json
+import os
+import threading
 import time
 
+## Names of the SetPerformanceParameters arguments, in order; profile file keys.
+PERFORMANCE_PARAMETERS = ('Kp_tacho', 'Ki_tacho', 'Kd_tacho', 'Kp_speed', 'Ki_speed', 'Kd_speed',
+                          'passcount', 'tolerance')
+
 ## SmartDrive: this class provides motor control functions
 class SmartDrive(OpenElectrons_i2c):
     
@@ -126,49 +138,300 @@ class SmartDrive(OpenElectrons_i2c):
     ## Initialize the class with the i2c address of your SmartDrive
     #  @param self The object pointer.
     #  @param SmartDrive_address Address of your SmartDrive.
-    def __init__(self, SmartDrive_address = SmartDrive_ADDRESS):
-        #the SmartDrive address
-        OpenElectrons_i2c.__init__(self, SmartDrive_address >> 1)       
-      
+    #  @param transport Register transport to use (see SmartDriveTransport), defaults to the OpenElectrons_i2c helpers on a bus handle shared by every SmartDrive on the bus.
+    #  @param profile Profile file whose gains are applied now, see LoadPerformanceProfile.
+    def __init__(self, SmartDrive_address = SmartDrive_ADDRESS, transport = None, profile = None):
+        if transport is None:
+            #the SmartDrive address
+            self.address = SmartDrive_address >> 1
+            # one bus handle for every SmartDrive on the bus
+            transport = SharedSMBusTransport(self)
+        else:
+            # the transport owns the bus, no smbus handle is opened
+            self.address = SmartDrive_address >> 1
+            self.bus = transport
+        self.transport = transport
+        # scratch buffer for the single register helpers, used under bus_lock
+        self._scratch = bytearray(4)
+        # used by the Run_* methods to wait for completion
+        self.wait_engine = SmartDrive_WaitEngine()
+        # held for each bus transaction; the transport's own when it has one,
+        # so SmartDrives sharing a transport share it. SmartDriveFleet sets its own.
+        self.bus_lock = getattr(transport, 'bus_lock', None) or threading.RLock()
+        # print every command() sent; use SmartDriveStats for counters instead
+        self.debug = False
+        # when set, power readings come from its cache, see SmartDrivePower
+        self.power_telemetry = None
+        # tuned gains, see SmartDriveTuner
+        if profile is not None:
+            self.LoadPerformanceProfile(profile)
+
+    # The i2c helpers go through the transport and hold bus_lock for the
+    # length of one transaction, so SmartDrives sharing a bus from several
+    # threads do not interleave.
+    def readByte(self, reg):
+        with self.bus_lock:
+            self.transport.readInto(self.address, reg, self._scratch, 0, 1)
+            return self._scratch[0]
+
+    def readArray(self, reg, length):
+        buf = bytearray(length)
+        self.readBlockInto(reg, buf, 0, length)
+        return list(buf)
+
+    def readInteger(self, reg):
+        with self.bus_lock:
+            self.transport.readInto(self.address, reg, self._scratch, 0, 2)
+            return UINT16.unpack_from(self._scratch)[0]
+
+    def readLongSigned(self, reg):
+        with self.bus_lock:
+            self.transport.readInto(self.address, reg, self._scratch, 0, 4)
+            return INT32.unpack_from(self._scratch)[0]
+
+    def writeByte(self, reg, value):
+        self.writeBlocks([(reg, bytearray([value & 0xFF]))])
+
+    def writeArray(self, reg, arr):
+        self.writeBlocks([(reg, bytearray([v & 0xFF for v in arr]))])
+
     ## Writes a specified command on the command register of the SmartDrive
     #  @param self The object pointer.
     #  @param cmd The command you wish the SmartDrive to execute.
     def command(self, cmd):
-        print  cmd
+        if self.debug:
+            print(cmd)
         self.writeByte(self.SmartDrive_COMMAND, cmd)       
     
+    ## Reads length consecutive registers starting at reg into buf at offset
+    #  @param self The object pointer.
+    #  @param reg First register to read.
+    #  @param buf A bytearray receiving the register values.
+    #  @param offset Position in buf of the first register.
+    #  @param length Number of registers to read.
+    def readBlockInto(self, reg, buf, offset, length):
+        with self.bus_lock:
+            self.transport.readInto(self.address, reg, buf, offset, length)
+
+    ## Reads the whole read register block (0x52 - 0x73) and decodes it
+    #  One transaction on SmartDrive_RdwrTransport; on the default SMBus
+    #  transport current_m2 comes from a second one, see SmartDriveSnapshot.
+    #  @param self The object pointer.
+    #  @return A SmartDrive_Snapshot of positions, status, PID, power and currents.
+    def ReadSnapshot(self):
+        buf = bytearray(SNAPSHOT_SIZE)
+        self.readBlockInto(SNAPSHOT_START, buf, 0, SNAPSHOT_SIZE)
+        return SmartDrive_Snapshot.decode(buf, 0, time.time())
+
+    ## Takes count snapshots back to back into a preallocated array
+    #  @param self The object pointer.
+    #  @param count Number of snapshots to take.
+    #  @param out Optional SmartDrive_SnapshotArray to reuse, must hold count entries.
+    #  @return The SmartDrive_SnapshotArray holding the snapshots.
+    def ReadSnapshots(self, count, out = None):
+        if out is None:
+            out = SmartDrive_SnapshotArray(count)
+        elif out.capacity < count:
+            raise ValueError("snapshot array too small")
+        raw = out.raw
+        stamps = out.timestamps
+        out.count = 0
+        for i in range(count):
+            self.readBlockInto(SNAPSHOT_START, raw, i * SNAPSHOT_SIZE, SNAPSHOT_SIZE)
+            stamps[i] = time.time()
+            out.count = i + 1
+        return out
+
+    ## Writes a list of register blocks in order
+    #  @param self The object pointer.
+    #  @param blocks A sequence of (register, bytearray) pairs.
+    def writeBlocks(self, blocks):
+        with self.bus_lock:
+            self.transport.writeBlocks(self.address, blocks)
+
+    ## Encodes one motor command frame into buf at offset
+    #  @param self The object pointer.
+    #  @param buf A bytearray receiving the frame.
+    #  @param offset Position in buf of the setpoint register.
+    #  @param setpoint The tacheometer setpoint (signed).
+    #  @param speed The signed speed, -100 to 100.
+    #  @param duration The time in seconds, 0 to 255.
+    #  @param ctrl The control byte (command A).
+    def encodeMotorFrame(self, buf, offset, setpoint, speed, duration, ctrl):
+        FRAME.pack_into(buf, offset, int(setpoint), int(speed), int(duration), 0, ctrl)
+
+    ## Returns the control byte (command A) of a move
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s); a single motor also gets SmartDrive_CONTROL_GO.
+    #  @param next_action How you wish to stop the motor(s).
+    #  @param flags Mode bits: SmartDrive_CONTROL_TACHO, _RELATIVE or _TIME.
+    def encodeControl(self, motor_number, next_action, flags = 0):
+        ctrl = self.SmartDrive_CONTROL_SPEED | flags
+        if ( next_action == self.SmartDrive_Next_Action_Brake ):
+            ctrl |= self.SmartDrive_CONTROL_BRK
+        if ( next_action == self.SmartDrive_Next_Action_BrakeHold ):
+            ctrl |= self.SmartDrive_CONTROL_BRK
+            ctrl |= self.SmartDrive_CONTROL_ON
+        if ( motor_number != self.SmartDrive_Motor_Both ):
+            ctrl |= self.SmartDrive_CONTROL_GO
+        return ctrl
+
+    ## Returns the register blocks that command the specified motor(s).
+    #  For SmartDrive_Motor_Both both frames go out in one block
+    #  (0x42 - 0x51), followed by the S command to start them together.
+    #  Without a setpoint it is a single block from speed M1 to command A M2
+    #  (0x46 - 0x51), each motor started by the GO bit of its command A. The
+    #  motor 2 setpoint registers in between are written with 0; speed and
+    #  timed runs do not use them.
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) to command.
+    #  @param setpoint The tacheometer setpoint, a (m1, m2) pair for SmartDrive_Motor_Both, or None for a run without one; the motor 1 setpoint (and for a single motor, its own) is then left alone.
+    #  @param speed The signed speed.
+    #  @param duration The time in seconds.
+    #  @param ctrl The control byte.
+    #  @return A list of (register, bytearray) pairs for writeBlocks.
+    def encodeMotorBlocks(self, motor_number, setpoint, speed, duration, ctrl):
+        if ( motor_number == self.SmartDrive_Motor_Both ):
+            buf = bytearray(2 * FRAME.size)
+            if setpoint is None:
+                ctrl |= self.SmartDrive_CONTROL_GO
+                self.encodeMotorFrame(buf, 0, 0, speed, duration, ctrl)
+                self.encodeMotorFrame(buf, FRAME.size, 0, speed, duration, ctrl)
+                return [(self.SmartDrive_SPEED_M1, buf[self.SmartDrive_SPEED_M1 - self.SmartDrive_SETPT_M1:])]
+            if not isinstance(setpoint, tuple):
+                setpoint = (setpoint, setpoint)
+            self.encodeMotorFrame(buf, 0, setpoint[0], speed, duration, ctrl)
+            self.encodeMotorFrame(buf, FRAME.size, setpoint[1], speed, duration, ctrl)
+            return [(self.SmartDrive_SETPT_M1, buf), (self.SmartDrive_COMMAND, bytearray([self.S]))]
+        buf = bytearray(FRAME.size)
+        self.encodeMotorFrame(buf, 0, setpoint or 0, speed, duration, ctrl)
+        if ( motor_number == self.SmartDrive_Motor_1 ):
+            reg = self.SmartDrive_SETPT_M1
+        else:
+            reg = self.SmartDrive_SETPT_M2
+        if setpoint is None:
+            return [(reg + 4, buf[4:])]
+        return [(reg, buf)]
+
+    ## Writes the command frame(s) for the specified motor(s), see encodeMotorBlocks
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) to command.
+    #  @param setpoint The tacheometer setpoint, or None for a run without one, see encodeMotorBlocks.
+    #  @param speed The signed speed.
+    #  @param duration The time in seconds.
+    #  @param ctrl The control byte.
+    def writeMotorFrames(self, motor_number, setpoint, speed, duration, ctrl):
+        self.writeBlocks(self.encodeMotorBlocks(motor_number, setpoint, speed, duration, ctrl))
+
+    ## Writes both motors' frames in one block and starts them with the S command
+    #  @param self The object pointer.
+    #  @param setpoint_m1 The tacheometer setpoint of motor 1.
+    #  @param speed_m1 The signed speed of motor 1.
+    #  @param duration_m1 The time in seconds of motor 1.
+    #  @param ctrl_m1 The control byte of motor 1, without SmartDrive_CONTROL_GO.
+    #  @param setpoint_m2 The tacheometer setpoint of motor 2.
+    #  @param speed_m2 The signed speed of motor 2.
+    #  @param duration_m2 The time in seconds of motor 2.
+    #  @param ctrl_m2 The control byte of motor 2, without SmartDrive_CONTROL_GO.
+    #  @param start False to only preload the frames; send the S command later to start.
+    def SmartDrive_Write_Both(self, setpoint_m1, speed_m1, duration_m1, ctrl_m1, setpoint_m2, speed_m2, duration_m2, ctrl_m2, start = True):
+        buf = bytearray(2 * FRAME.size)
+        self.encodeMotorFrame(buf, 0, setpoint_m1, speed_m1, duration_m1, ctrl_m1)
+        self.encodeMotorFrame(buf, FRAME.size, setpoint_m2, speed_m2, duration_m2, ctrl_m2)
+        if start:
+            self.writeBlocks([(self.SmartDrive_SETPT_M1, buf), (self.SmartDrive_COMMAND, bytearray([self.S]))])
+        else:
+            self.writeBlocks([(self.SmartDrive_SETPT_M1, buf)])
+
+    ## Starts both motors together with individual speeds and targets
+    #  @param self The object pointer.
+    #  @param speed_m1 The signed speed of motor 1, negative turns in reverse.
+    #  @param speed_m2 The signed speed of motor 2, negative turns in reverse.
+    #  @param tacho_m1 Tacheometer target of motor 1, or None to run on speed (or time) only.
+    #  @param tacho_m2 Tacheometer target of motor 2, or None to run on speed (or time) only.
+    #  @param duration Time in seconds to run motors without a tacheometer target, 0 for unlimited.
+    #  @param move SmartDrive_Move_Relative or SmartDrive_Move_Absolute for the tacheometer targets.
+    #  @param wait_for_completion Tells the program when to handle the next line of code.
+    #  @param next_action How you wish to stop the motor(s).
+    #  @param start False to only preload the frames (no wait); send the S command later to start.
+    def SmartDrive_Run_Both(self, speed_m1, speed_m2, tacho_m1 = None, tacho_m2 = None, duration = 0,
+                            move = SmartDrive_Move_Relative, wait_for_completion = SmartDrive_Completion_Dont_Wait,
+                            next_action = SmartDrive_Next_Action_Brake, start = True):
+        ctrl = self.encodeControl(self.SmartDrive_Motor_Both, next_action)
+        ctrls = []
+        for tacho in (tacho_m1, tacho_m2):
+            c = ctrl
+            if tacho is not None:
+                c |= self.SmartDrive_CONTROL_TACHO
+                if ( move == self.SmartDrive_Move_Relative ):
+                    c |= self.SmartDrive_CONTROL_RELATIVE
+            elif duration:
+                c |= self.SmartDrive_CONTROL_TIME
+            ctrls.append(c)
+        self.SmartDrive_Write_Both(tacho_m1 or 0, speed_m1, duration, ctrls[0],
+                                   tacho_m2 or 0, speed_m2, duration, ctrls[1], start)
+        if ( start and wait_for_completion == self.SmartDrive_Completion_Wait_For ):
+            tacho_motors = 0
+            if tacho_m1 is not None:
+                tacho_motors |= self.SmartDrive_Motor_1
+            if tacho_m2 is not None:
+                tacho_motors |= self.SmartDrive_Motor_2
+            if tacho_motors:
+                targets = (tacho_m1 or 0, tacho_m2 or 0)
+                speeds = (speed_m1, speed_m2)
+                if ( move == self.SmartDrive_Move_Relative ):
+                    self.wait_engine.WaitTacho(self, tacho_motors, speeds, delta = targets)
+                else:
+                    self.wait_engine.WaitTacho(self, tacho_motors, speeds, target = targets)
+            if duration and tacho_motors != self.SmartDrive_Motor_Both:
+                self.wait_engine.WaitTime(self, self.SmartDrive_Motor_Both ^ tacho_motors, duration)
+
     ## Reads the battery voltage. Multiplier constant not yet verified
     #  @param self The object pointer.
+    #  @exception SmartDrive_BusError The register could not be read.
     def GetBattVoltage(self):
+        if self.power_telemetry is not None:
+            return self.power_telemetry.Voltage()
         try:
             return self.readByte(self.SmartDrive_BATT_VOLTAGE) * self.SmartDrive_VOLTAGE_MULTIPLIER
-        except:
-            print "Error: Could not read voltage"
-            return ""
+        except (IOError, OSError) as e:
+            raise wrapBusError(e, "could not read voltage", self.address, self.SmartDrive_BATT_VOLTAGE)
             
-### Function not supported. May support function in the future.        
-#    def GetMotorCurrent(self, motor_number):
-#        try:
-#             if motor_number == 1:
-#                return self.readInteger(self.SmartDrive_CURRENT_M1)
-#            if motor_number == 2:
-#                return self.readInteger(self.SmartDrive_CURRENT_M2)
-#        except:
-#            print "Error: Could not read current"
-#            return ""
+    ## Reads the current register of the specified motor. Units not yet verified
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor you wish to read.
+    #  @exception SmartDrive_BusError The register could not be read.
+    #  @exception ValueError motor_number is not 1 or 2.
+    def GetMotorCurrent(self, motor_number):
+        if motor_number == 1:
+            reg = self.SmartDrive_CURRENT_M1
+        elif motor_number == 2:
+            reg = self.SmartDrive_CURRENT_M2
+        else:
+            raise ValueError("motor_number must be 1 or 2, not %r" % (motor_number,))
+        if self.power_telemetry is not None:
+            return self.power_telemetry.Current(motor_number)
+        try:
+            return self.readInteger(reg)
+        except (IOError, OSError) as e:
+            raise wrapBusError(e, "could not read current", self.address, reg)
         
     ## Reads the tacheometer position of the specified motor
     #  @param self The object pointer.
     #  @param motor_number Number of the motor you wish to read.
+    #  @exception SmartDrive_BusError The register could not be read.
+    #  @exception ValueError motor_number is not 1 or 2.
     def ReadTachometerPosition(self, motor_number):
+        if motor_number == 1 :
+            reg = self.SmartDrive_POSITION_M1
+        elif motor_number == 2 :
+            reg = self.SmartDrive_POSITION_M2
+        else:
+            raise ValueError("motor_number must be 1 or 2, not %r" % (motor_number,))
         try:
-            if motor_number == 1 :
-                return self.readLongSigned(self.SmartDrive_POSITION_M1) 
-            if motor_number == 2 :
-                return self.readLongSigned(self.SmartDrive_POSITION_M2)
-        except:
-            print "Error: Could not read encoders"
-            return ""
+            return self.readLongSigned(reg)
+        except (IOError, OSError) as e:
+            raise wrapBusError(e, "could not read encoders", self.address, reg)
     
     ## Turns the specified motor(s) forever
     #  @param self The object pointer.
@@ -177,26 +440,15 @@ class SmartDrive(OpenElectrons_i2c):
     #  @param speed The speed at which you wish to turn the motor(s).
     def SmartDrive_Run_Unlimited( self, motor_number, direction, speed):
 
-        ctrl = 0
-        ctrl |= self.SmartDrive_CONTROL_SPEED
-        ctrl |= self.SmartDrive_CONTROL_BRK
+        ctrl = self.encodeControl(motor_number, self.SmartDrive_Next_Action_Brake)
         #print speed
         speed = int(speed)
         
-        if ( motor_number != self.SmartDrive_Motor_Both ):
-            ctrl |= self.SmartDrive_CONTROL_GO
         if ( direction == self.SmartDrive_Direction_Forward ):
             speed = speed
         if ( direction != self.SmartDrive_Direction_Forward ):
             speed = speed * -1
-        if ( (motor_number & 0x01) != 0 ): 
-            array = [speed, 0, 0, ctrl]
-            self.writeArray( self.SmartDrive_SPEED_M1, array)
-        if ( (motor_number & 0x02) != 0 ):
-            array = [speed, 0, 0, ctrl]
-            self.writeArray( self.SmartDrive_SPEED_M2, array); 
-        if ( motor_number == self.SmartDrive_Motor_Both ) :
-            self.writeByte(self.SmartDrive_COMMAND, self.S)  
+        self.writeMotorFrames(motor_number, None, speed, 0, ctrl)
 
     ## Stops the specified motor(s)
     #  @param self The object pointer.
@@ -229,38 +481,29 @@ class SmartDrive(OpenElectrons_i2c):
     #  @param next_action How you wish to stop the motor(s).
     def SmartDrive_Run_Seconds( self, motor_number, direction, speed, duration, wait_for_completion, next_action ):
         
-        ctrl = 0
-        ctrl |= self.SmartDrive_CONTROL_SPEED
-        ctrl |= self.SmartDrive_CONTROL_TIME
+        ctrl = self.encodeControl(motor_number, next_action, self.SmartDrive_CONTROL_TIME)
 
-        if ( next_action == self.SmartDrive_Next_Action_Brake ):
-            ctrl |= self.SmartDrive_CONTROL_BRK
-        if ( next_action == self.SmartDrive_Next_Action_BrakeHold ):
-            ctrl |= self.SmartDrive_CONTROL_BRK
-            ctrl |= self.SmartDrive_CONTROL_ON
-        if ( motor_number != self.SmartDrive_Motor_Both ):
-            ctrl |= self.SmartDrive_CONTROL_GO
         if ( direction == self.SmartDrive_Direction_Forward ):
             speed = speed
         if ( direction != self.SmartDrive_Direction_Forward ):
             speed = speed * -1    
-        if ( (motor_number & 0x01) != 0 ):
-            array = [speed, duration, 0, ctrl]
-            self.writeArray( self.SmartDrive_SPEED_M1, array) 
-        if ( (motor_number & 0x02) != 0 ) :
-            array = [speed, duration, 0, ctrl]
-            self.writeArray( self.SmartDrive_SPEED_M2, array)
-        if ( motor_number == self.SmartDrive_Motor_Both ) :
-            self.writeByte(self.SmartDrive_COMMAND, self.S)        
+        self.writeMotorFrames(motor_number, None, speed, duration, ctrl)
         if ( wait_for_completion == self.SmartDrive_Completion_Wait_For ):
-            time.sleep(0.050);  # this delay is required for the status byte to be available for reading.
-            self.SmartDrive_WaitUntilTimeDone(motor_number)
+            self.wait_engine.WaitTime(self, motor_number, duration)
             
     ## Waits until the specified time for the motor(s) to run is completed
     #  @param self The object pointer.
     #  @param motor_number Number of the motor(s) to wait for.
-    def SmartDrive_WaitUntilTimeDone(self, motor_number):
+    #  @param timeout Seconds to wait at most, None for the wait engine's default.
+    #  @exception SmartDrive_TimeoutError The motor(s) did not finish in time.
+    def SmartDrive_WaitUntilTimeDone(self, motor_number, timeout = None):
+        if timeout is None:
+            timeout = self.wait_engine.Timeout()
+        t0 = clock()
         while self.SmartDrive_IsTimeDone(motor_number) != True:
+            if clock() - t0 > timeout:
+                raise SmartDrive_TimeoutError("motor %d not done after %g seconds" % (motor_number, timeout),
+                                              motor_number, timeout)
             time.sleep(0.050)        
     
     ## Checks to ensure the specified time for the motor(s) to run is completed.
@@ -278,8 +521,9 @@ class SmartDrive(OpenElectrons_i2c):
             if (( result & 0x40 ) == 0 ):
                 return True
         elif ( motor_number == self.SmartDrive_Motor_Both ):
-            result = self.readByte(self.SmartDrive_STATUS_M1)
-            result2 = self.readByte(self.SmartDrive_STATUS_M2)
+            status = bytearray(2)
+            self.readBlockInto(self.SmartDrive_STATUS_M1, status, 0, 2)
+            result, result2 = status[0], status[1]
             # look for both time bits to be zero
             if (((result & 0x40) == 0) &((result2 & 0x40) == 0) ):
                 return True
@@ -296,39 +540,16 @@ class SmartDrive(OpenElectrons_i2c):
     #  @param next_action How you wish to stop the motor(s).
     def SmartDrive_Run_Degrees(self, motor_number, direction, speed, degrees, wait_for_completion, next_action):
         
-        ctrl = 0
-        ctrl |= self.SmartDrive_CONTROL_SPEED
-        ctrl |= self.SmartDrive_CONTROL_TACHO
-        ctrl |= self.SmartDrive_CONTROL_RELATIVE
+        ctrl = self.encodeControl(motor_number, next_action,
+                                  self.SmartDrive_CONTROL_TACHO | self.SmartDrive_CONTROL_RELATIVE)
         
         if ( direction == self.SmartDrive_Direction_Forward ):
             d = degrees
         if ( direction != self.SmartDrive_Direction_Forward ):
             d = degrees * -1 
-        
-        t4 = (d/0x1000000)
-        t3 = ((d%0x1000000)/0x10000)
-        t2 = (((d%0x1000000)%0x10000)/0x100)
-        t1 = (((d%0x1000000)%0x10000)%0x100)
-        
-        if ( next_action == self.SmartDrive_Next_Action_Brake ):
-            ctrl |= self.SmartDrive_CONTROL_BRK
-        if ( next_action == self.SmartDrive_Next_Action_BrakeHold ):
-            ctrl |= self.SmartDrive_CONTROL_BRK
-            ctrl |= self.SmartDrive_CONTROL_ON
-        if ( motor_number != self.SmartDrive_Motor_Both ):
-            ctrl |= self.SmartDrive_CONTROL_GO        
-        if ( (motor_number & 0x01) != 0 ):
-            array = [t1, t2, t3, t4, speed, 0, 0, ctrl]
-            self.writeArray(self.SmartDrive_SETPT_M1, array) 
-        if ( (motor_number & 0x02) != 0 ) :
-            array = [t1, t2, t3, t4, speed, 0, 0, ctrl]
-            self.writeArray(self.SmartDrive_SETPT_M2, array) 
-        if ( motor_number == self.SmartDrive_Motor_Both ) :
-            self.writeByte(self.SmartDrive_COMMAND, self.S)         
+        self.writeMotorFrames(motor_number, d, speed, 0, ctrl)
         if ( wait_for_completion == self.SmartDrive_Completion_Wait_For ):
-            time.sleep(0.050);  # this delay is required for the status byte to be available for reading.
-            self.SmartDrive_WaitUntilTachoDone(motor_number)
+            self.wait_engine.WaitTacho(self, motor_number, speed, delta = d)
             
     ## Turns the specified motor(s) for given relative tacheometer count
     #  @param self The object pointer.
@@ -340,39 +561,16 @@ class SmartDrive(OpenElectrons_i2c):
     #  @param next_action How you wish to stop the motor(s).
     def SmartDrive_Run_Rotations(self, motor_number, direction, speed, rotations, wait_for_completion, next_action):
         
-        ctrl = 0
-        ctrl |= self.SmartDrive_CONTROL_SPEED
-        ctrl |= self.SmartDrive_CONTROL_TACHO
-        ctrl |= self.SmartDrive_CONTROL_RELATIVE
+        ctrl = self.encodeControl(motor_number, next_action,
+                                  self.SmartDrive_CONTROL_TACHO | self.SmartDrive_CONTROL_RELATIVE)
         
         if ( direction == self.SmartDrive_Direction_Forward ):
             d = rotations * 360
         if ( direction != self.SmartDrive_Direction_Forward ):
             d = (rotations * 360) * -1 
-        
-        t4 = (d/0x1000000)
-        t3 = ((d%0x1000000)/0x10000)
-        t2 = (((d%0x1000000)%0x10000)/0x100)
-        t1 = (((d%0x1000000)%0x10000)%0x100)
-        
-        if ( next_action == self.SmartDrive_Next_Action_Brake ):
-            ctrl |= self.SmartDrive_CONTROL_BRK
-        if ( next_action == self.SmartDrive_Next_Action_BrakeHold ):
-            ctrl |= self.SmartDrive_CONTROL_BRK
-            ctrl |= self.SmartDrive_CONTROL_ON
-        if ( motor_number != self.SmartDrive_Motor_Both ):
-            ctrl |= self.SmartDrive_CONTROL_GO
-        if ( (motor_number & 0x01) != 0 ):
-            array = [t1, t2, t3, t4, speed, 0, 0, ctrl]
-            self.writeArray(self.SmartDrive_SETPT_M1, array) 
-        if ( (motor_number & 0x02) != 0 ) :
-            array = [t1, t2, t3, t4, speed, 0, 0, ctrl]
-            self.writeArray(self.SmartDrive_SETPT_M2, array) 
-        if ( motor_number == self.SmartDrive_Motor_Both ) :
-            self.writeByte(self.SmartDrive_COMMAND, self.S)        
+        self.writeMotorFrames(motor_number, d, speed, 0, ctrl)
         if ( wait_for_completion == self.SmartDrive_Completion_Wait_For ):
-            time.sleep(0.050);  # this delay is required for the status byte to be available for reading.
-            self.SmartDrive_WaitUntilTachoDone(motor_number)
+            self.wait_engine.WaitTacho(self, motor_number, speed, delta = d)
     
     ## Turns the specified motor(s) for given absolute tacheometer count
     #  @param self The object pointer.
@@ -384,40 +582,25 @@ class SmartDrive(OpenElectrons_i2c):
     #  @param next_action How you wish to stop the motor(s).
     def SmartDrive_Run_Tacho(self, motor_number, speed, tacho_count, wait_for_completion, next_action):
         
-        ctrl = 0
-        ctrl |= self.SmartDrive_CONTROL_SPEED
-        ctrl |= self.SmartDrive_CONTROL_TACHO
+        ctrl = self.encodeControl(motor_number, next_action, self.SmartDrive_CONTROL_TACHO)
         d = tacho_count
-        
-        t4 = (d/0x1000000)
-        t3 = ((d%0x1000000)/0x10000)
-        t2 = (((d%0x1000000)%0x10000)/0x100)
-        t1 = (((d%0x1000000)%0x10000)%0x100)
-        
-        if ( next_action == self.SmartDrive_Next_Action_Brake ):
-            ctrl |= self.SmartDrive_CONTROL_BRK
-        if ( next_action == self.SmartDrive_Next_Action_BrakeHold ):
-            ctrl |= self.SmartDrive_CONTROL_BRK
-            ctrl |= self.SmartDrive_CONTROL_ON
-        if ( motor_number != self.SmartDrive_Motor_Both ):
-            ctrl |= self.SmartDrive_CONTROL_GO
-        if ( (motor_number & 0x01) != 0 ):
-            array = [t1, t2, t3, t4, speed, 0, 0, ctrl]
-            self.writeArray(self.SmartDrive_SETPT_M1, array) 
-        if ( (motor_number & 0x02) != 0 ) :
-            array = [t1, t2, t3, t4, speed, 0, 0, ctrl]
-            self.writeArray(self.SmartDrive_SETPT_M2, array) 
-        if ( motor_number == self.SmartDrive_Motor_Both ) :
-            self.writeByte(self.SmartDrive_COMMAND, self.S)         
+        self.writeMotorFrames(motor_number, d, speed, 0, ctrl)
         if ( wait_for_completion == self.SmartDrive_Completion_Wait_For ):
-            time.sleep(0.050);  # this delay is required for the status byte to be available for reading.
-            self.SmartDrive_WaitUntilTachoDone(motor_number) 
+            self.wait_engine.WaitTacho(self, motor_number, speed, target = d)
     
     ## Waits until the specified tacheomter count for the motor(s) to run is reached.
     #  @param self The object pointer.
     #  @param motor_number Number of the motor(s) to wait for.
-    def SmartDrive_WaitUntilTachoDone(self, motor_number):
+    #  @param timeout Seconds to wait at most, None for the wait engine's default.
+    #  @exception SmartDrive_TimeoutError The motor(s) did not finish in time.
+    def SmartDrive_WaitUntilTachoDone(self, motor_number, timeout = None):
+        if timeout is None:
+            timeout = self.wait_engine.Timeout()
+        t0 = clock()
         while self.SmartDrive_IsTachoDone(motor_number) != True:
+            if clock() - t0 > timeout:
+                raise SmartDrive_TimeoutError("motor %d not done after %g seconds" % (motor_number, timeout),
+                                              motor_number, timeout)
             time.sleep(0.050)        
         
     ## Checks to ensure the specified tacheomter count for the motor(s) to run is reached.
@@ -435,8 +618,9 @@ class SmartDrive(OpenElectrons_i2c):
             if (( result & 0x08 ) == 0 ):
                 return True
         elif ( motor_number == self.SmartDrive_Motor_Both ):
-            result = self.readByte(self.SmartDrive_STATUS_M1)
-            result2 = self.readByte(self.SmartDrive_STATUS_M2)
+            status = bytearray(2)
+            self.readBlockInto(self.SmartDrive_STATUS_M1, status, 0, 2)
+            result, result2 = status[0], status[1]
             # look for both time bits to be zero
             if (((result & 0x08) == 0) & ((result2 & 0x08) == 0) ):
                 return True
@@ -454,35 +638,68 @@ class SmartDrive(OpenElectrons_i2c):
     def SetPerformanceParameters(self, Kp_tacho, Ki_tacho, Kd_tacho, Kp_speed, Ki_speed, Kd_speed, passcount, tolerance):
         
         Kp_t1 = Kp_tacho%0x100
-        Kp_t2 = Kp_tacho/0x100      
+        Kp_t2 = Kp_tacho//0x100      
         Ki_t1 = Ki_tacho%0x100
-        Ki_t2 = Ki_tacho/0x100
+        Ki_t2 = Ki_tacho//0x100
         Kd_t1 = Kd_tacho%0x100
-        Kd_t2 = Kd_tacho/0x100
+        Kd_t2 = Kd_tacho//0x100
         Kp_s1 = Kp_speed%0x100        
-        Kp_s2 = Kp_speed/0x100
+        Kp_s2 = Kp_speed//0x100
         Ki_s1 = Ki_speed%0x100 
-        Ki_s2 = Ki_speed/0x100
+        Ki_s2 = Ki_speed//0x100
         Kd_s1 = Kd_speed%0x100
-        Kd_s2 = Kd_speed/0x100
+        Kd_s2 = Kd_speed//0x100
         passcount = passcount
         tolerance = tolerance
         array = [Kp_t1 , Kp_t2 , Ki_t1, Ki_t2, Kd_t1, Kd_t2, Kp_s1, Kp_s2, Ki_s1, Ki_s2, Kd_s1, Kd_s2, passcount, tolerance]
         self.writeArray(self.SmartDrive_P_Kp, array)
         
-    ## Reads the values of the PID control registers
+    ## Prints the values of the PID control registers
     #  @param self The object pointer.
+    #  @return The values, as GetPerformanceParameters.
+    #  @exception SmartDrive_BusError The registers could not be read.
     def ReadPerformanceParameters(self):
-    
+        values = self.GetPerformanceParameters()
+        for name, value in zip(("Pkp", "Pki", "Pkd", "Skp", "Ski", "Skd", "Passcount", "Tolerance"), values):
+            print(name + ": " + str(value))
+        return values
+
+    ## Reads the PID control registers in one transaction
+    #  @param self The object pointer.
+    #  @return (Kp_tacho, Ki_tacho, Kd_tacho, Kp_speed, Ki_speed, Kd_speed, passcount, tolerance)
+    def GetPerformanceParameters(self):
+        buf = bytearray(PID.size)
         try:
-            print "Pkp: " + str(self.readInteger(self.SmartDrive_P_Kp))
-            print "Pki: " + str(self.readInteger(self.SmartDrive_P_Ki))
-            print "Pkd: " + str(self.readInteger(self.SmartDrive_P_Kd))
-            print "Skp: " + str(self.readInteger(self.SmartDrive_S_Kp))
-            print "Ski: " + str(self.readInteger(self.SmartDrive_S_Ki))
-            print "Skd: " + str(self.readInteger(self.SmartDrive_S_Kd))
-            print "Passcount: " + str(self.SmartDrive_PASSCOUNT)
-            print "Tolerance: " + str(self.SmartDrive_PASSTOLERANCE)
-        except:
-            print "Error: Could not read PID values"
-            return ""
\ No newline at end of file
+            self.readBlockInto(self.SmartDrive_P_Kp, buf, 0, PID.size)
+        except (IOError, OSError) as e:
+            raise wrapBusError(e, "could not read PID values", self.address, self.SmartDrive_P_Kp)
+        return PID.unpack_from(buf)
+
+    ## Applies the gains stored for this SmartDrive in a profile file
+    #  @param self The object pointer.
+    #  @param path Profile file written by SavePerformanceProfile.
+    #  @return True if the profile had an entry for this SmartDrive.
+    def LoadPerformanceProfile(self, path):
+        with open(path) as f:
+            profile = json.load(f)
+        gains = profile.get('controllers', {}).get('0x%02x' % (self.address << 1))
+        if gains is None:
+            return False
+        self.SetPerformanceParameters(*[gains[name] for name in PERFORMANCE_PARAMETERS])
+        return True
+
+    ## Stores the current gains of this SmartDrive in a profile file
+    #  Entries of other SmartDrives already in the file are kept.
+    #  @param self The object pointer.
+    #  @param path Profile file to update.
+    def SavePerformanceProfile(self, path):
+        profile = {'version': 1, 'controllers': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                profile = json.load(f)
+        values = self.GetPerformanceParameters()
+        profile['controllers']['0x%02x' % (self.address << 1)] = dict(zip(PERFORMANCE_PARAMETERS, values))
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(profile, f, indent = 2, sort_keys = True, separators = (',', ': '))
+        os.rename(tmp, path)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveBench
+# Bus-level benchmarks of the SmartDrive driver against simulated
+# controllers (see SmartDriveSim). Results are written as JSON:
+#
+#   python SmartDriveBench.py --latency 0.0002 --output bench.json
+
+import argparse
+import json
+import platform
+import sys
+import threading
+
+from SmartDrive import SmartDrive
+from SmartDriveFleet import SmartDrive_Fleet
+from SmartDriveRegisters import clock
+from SmartDriveSim import SmartDrive_Sim, SmartDrive_SimTransport
+
+def _drive(latency, byte_time, address = SmartDrive.SmartDrive_ADDRESS, status_delay = 0.0):
+    bus = SmartDrive_SimTransport(latency, byte_time)
+    sim = bus.Attach(address, SmartDrive_Sim(status_delay = status_delay))
+    sd = SmartDrive(address, transport = bus)
+    sd.wait_engine.status_delay = status_delay
+    return bus, sim, sd
+
+## Measures how many Run_Unlimited commands per second the driver can issue
+#  @param latency Simulated per-transaction latency, in seconds.
+#  @param byte_time Simulated per-byte cost, in seconds.
+#  @param count Number of commands to send.
+def BenchCommandRate(latency, byte_time, count = 2000):
+    bus, sim, sd = _drive(latency, byte_time)
+    result = {}
+    for name, motor in (('single', SmartDrive.SmartDrive_Motor_1), ('both', SmartDrive.SmartDrive_Motor_Both)):
+        t0 = clock()
+        for i in range(count):
+            sd.SmartDrive_Run_Unlimited(motor, SmartDrive.SmartDrive_Direction_Forward, 50)
+        elapsed = clock() - t0
+        result[name] = {'commands': count, 'seconds': elapsed, 'commands_per_second': count / elapsed}
+    return result
+
+## Counts bus transactions and bytes used by each driver operation
+#  @param latency Simulated per-transaction latency, in seconds.
+#  @param byte_time Simulated per-byte cost, in seconds.
+def BenchCost(latency, byte_time):
+    bus, sim, sd = _drive(latency, byte_time)
+    ops = [
+        ('ReadSnapshot', lambda: sd.ReadSnapshot()),
+        ('ReadTachometerPosition', lambda: sd.ReadTachometerPosition(1)),
+        ('GetBattVoltage', lambda: sd.GetBattVoltage()),
+        ('IsTachoDone_Both', lambda: sd.SmartDrive_IsTachoDone(SmartDrive.SmartDrive_Motor_Both)),
+        ('Run_Unlimited_Both', lambda: sd.SmartDrive_Run_Unlimited(SmartDrive.SmartDrive_Motor_Both, 1, 50)),
+        ('Run_Degrees_Both', lambda: sd.SmartDrive_Run_Degrees(SmartDrive.SmartDrive_Motor_Both, 1, 50, 90, 0, 1)),
+        ('Run_Both', lambda: sd.SmartDrive_Run_Both(50, -50, 90, 90)),
+        ('SetPerformanceParameters', lambda: sd.SetPerformanceParameters(10, 0, 5, 10, 0, 5, 3, 5)),
+        ('Stop_Both', lambda: sd.SmartDrive_Stop(SmartDrive.SmartDrive_Motor_Both, 1)),
+    ]
+    result = {}
+    for name, op in ops:
+        transactions, nbytes = bus.transactions, bus.bytes
+        op()
+        result[name] = {'transactions': bus.transactions - transactions, 'bytes': bus.bytes - nbytes}
+    return result
+
+## Measures how long after the real end of a move each Run_* mode returns
+#  @param latency Simulated per-transaction latency, in seconds.
+#  @param byte_time Simulated per-byte cost, in seconds.
+#  @param status_delay Simulated delay before the status byte is valid, in seconds.
+#  @param repeat Number of moves per mode.
+def BenchCompletion(latency, byte_time, status_delay = 0.05, repeat = 5):
+    bus, sim, sd = _drive(latency, byte_time, status_delay = status_delay)
+    wait = SmartDrive.SmartDrive_Completion_Wait_For
+    brake = SmartDrive.SmartDrive_Next_Action_Brake
+    both = SmartDrive.SmartDrive_Motor_Both
+    modes = [
+        ('Run_Seconds', 0, lambda: sd.SmartDrive_Run_Seconds(1, 1, 50, 1, wait, brake)),
+        ('Run_Degrees', 0, lambda: sd.SmartDrive_Run_Degrees(1, 1, 50, 90, wait, brake)),
+        ('Run_Degrees_short', 0, lambda: sd.SmartDrive_Run_Degrees(1, 1, 50, 10, wait, brake)),
+        ('Run_Rotations', 0, lambda: sd.SmartDrive_Run_Rotations(1, 1, 80, 1, wait, brake)),
+        ('Run_Tacho', 0, lambda: sd.SmartDrive_Run_Tacho(1, 50, sd.ReadTachometerPosition(1) + 180, wait, brake)),
+        ('Run_Degrees_Both', 1, lambda: sd.SmartDrive_Run_Degrees(both, 1, 50, 180, wait, brake)),
+    ]
+    result = {}
+    for name, m, run in modes:
+        lags = []
+        polls = []
+        for i in range(repeat):
+            transactions = bus.transactions
+            run()
+            done = clock()
+            lags.append(done - sim.completed[m])
+            polls.append(bus.transactions - transactions)
+        result[name] = {'mean_latency': sum(lags) / len(lags), 'max_latency': max(lags),
+                        'mean_transactions': float(sum(polls)) / len(polls)}
+    return result
+
+## Measures operation throughput with several controllers on one bus
+#  @param latency Simulated per-transaction latency, in seconds.
+#  @param byte_time Simulated per-byte cost, in seconds.
+#  @param sizes Numbers of controllers to try.
+#  @param ops Operations per controller.
+def BenchScaling(latency, byte_time, sizes = (1, 2, 4, 8), ops = 200):
+    result = {}
+    for size in sizes:
+        bus = SmartDrive_SimTransport(latency, byte_time)
+        addresses = [0x20 + 2 * i for i in range(size)]
+        for address in addresses:
+            bus.Attach(address)
+        fleet = SmartDrive_Fleet(addresses, transport = bus)
+
+        def work(sd):
+            for i in range(ops):
+                sd.ReadSnapshot()
+                sd.SmartDrive_Run_Unlimited(SmartDrive.SmartDrive_Motor_Both, 1, 50)
+
+        threads = [threading.Thread(target = work, args = (fleet[a],)) for a in addresses]
+        t0 = clock()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = clock() - t0
+        for address in addresses:
+            fleet.Preload(address, 50, 50, tacho_m1 = 360, tacho_m2 = 360)
+        start = fleet.SynchronizedStart()
+        result[str(size)] = {'operations': 2 * ops * size, 'seconds': elapsed,
+                             'operations_per_second': 2 * ops * size / elapsed,
+                             'transactions': bus.transactions, 'start_skew': start.skew}
+    return result
+
+## Runs every benchmark and returns the results as a dict
+#  @param latency Simulated per-transaction latency, in seconds.
+#  @param byte_time Simulated per-byte cost, in seconds.
+def RunAll(latency = 0.0002, byte_time = 0.00009):
+    return {
+        'python': platform.python_version(),
+        'latency': latency,
+        'byte_time': byte_time,
+        'command_rate': BenchCommandRate(latency, byte_time),
+        'cost': BenchCost(latency, byte_time),
+        'completion': BenchCompletion(latency, byte_time),
+        'scaling': BenchScaling(latency, byte_time),
+    }
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'SmartDrive bus benchmarks on simulated controllers')
+    parser.add_argument('--latency', type = float, default = 0.0002, help = 'per-transaction latency in seconds')
+    parser.add_argument('--byte-time', type = float, default = 0.00009, help = 'per-byte cost in seconds')
+    parser.add_argument('--output', help = 'write JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+    results = RunAll(args.latency, args.byte_time)
+    text = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
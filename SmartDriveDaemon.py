@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveDaemon
+# Bus server: one process owns the I2C bus and the other processes send it
+# register reads and writes over a Unix domain socket.
+#
+#   python SmartDriveDaemon.py --socket /run/smartdrive.sock --bus 1
+#
+# In a client process, pass the transport explicitly; SharedTransport gives
+# every SmartDrive in the process the same connection:
+#
+#   sd = SmartDrive(SmartDrive.SmartDrive_ADDRESS, transport = SharedTransport('/run/smartdrive.sock'))
+#
+# The daemon serves motion requests (writes) ahead of telemetry (reads),
+# sends queued writes to the same controller as one transaction, and
+# answers identical reads waiting in the queue with a single bus read.
+#
+# Protocol, little endian; one request in flight per connection:
+#   request   REQUEST header, then for OP_WRITE length payload bytes made of
+#             BLOCK headers (register, count) each followed by count bytes.
+#   response  RESPONSE header, then length bytes: the data read, or the
+#             error text when status is STATUS_ERROR.
+
+from collections import deque
+import argparse
+import os
+import socket
+import struct
+import threading
+
+from SmartDriveTransport import SmartDrive_RdwrTransport
+
+## Socket path used when none is given.
+DEFAULT_PATH = '/tmp/smartdrive.sock'
+
+## Request header: sequence, op, priority, 7 bit address, register, length.
+REQUEST = struct.Struct('<IBBBBH')
+## Write payload block header: register, count.
+BLOCK = struct.Struct('<BB')
+## Response header: sequence, status, length.
+RESPONSE = struct.Struct('<IBxH')
+
+OP_READ = 1
+OP_WRITE = 2
+
+## Request priorities, lowest value served first.
+PRIORITY_MOTION = 0
+PRIORITY_TELEMETRY = 1
+PRIORITY_DEFAULT = 0xFF    # motion for writes, telemetry for reads
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+def _recvInto(sock, view):
+    # fills the whole view or raises EOFError
+    while len(view):
+        n = sock.recv_into(view)
+        if n == 0:
+            raise EOFError("connection closed")
+        view = view[n:]
+
+class _Request(object):
+
+    __slots__ = ('op', 'address', 'reg', 'length', 'blocks', 'replies')
+
+    def __init__(self, op, address, reg, length, blocks, reply):
+        self.op = op
+        self.address = address
+        self.reg = reg
+        self.length = length
+        self.blocks = blocks
+        # (connection, sequence) to answer; more than one when reads coalesce
+        self.replies = [reply]
+
+class _Connection(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+
+    def reply(self, seq, status, payload):
+        try:
+            with self.send_lock:
+                self.sock.sendall(RESPONSE.pack(seq, status, len(payload)) + bytes(payload))
+        except (OSError, socket.error):
+            pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self.sock.close()
+
+## SmartDrive_BusDaemon: serves register transactions to client processes.
+class SmartDrive_BusDaemon(object):
+
+    ## Largest number of queued writes sent as one transaction
+    BATCH_MAX = 8
+
+    ## Initialize the daemon
+    #  @param self The object pointer.
+    #  @param path Unix socket path to listen on.
+    #  @param transport Transport that owns the bus, a SmartDrive_RdwrTransport on bus_number by default.
+    #  @param bus_number Number N of /dev/i2c-N, used when transport is None.
+    #  @param mode Permissions of the socket file.
+    def __init__(self, path = DEFAULT_PATH, transport = None, bus_number = 1, mode = 0o660):
+        if transport is None:
+            transport = SmartDrive_RdwrTransport(bus_number)
+        self.path = path
+        self.transport = transport
+        self.mode = mode
+        self.requests = 0
+        self.transactions = 0
+        self.coalesced = 0
+        self.batched = 0
+        self._queues = (deque(), deque())
+        self._pending_reads = {}
+        self._cond = threading.Condition()
+        self._running = False
+        self._sock = None
+        self._threads = []
+        self._connections = set()
+
+    ## Starts listening and serving on background threads
+    #  @param self The object pointer.
+    def Start(self):
+        if self._running:
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, self.mode)
+        self._sock.listen(16)
+        self._running = True
+        for target, name in ((self._accept, 'SmartDriveDaemonAccept'), (self._serve, 'SmartDriveDaemonBus')):
+            thread = threading.Thread(target = target, name = name)
+            thread.daemon = True
+            thread.start()
+            self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+
+    ## Stops serving and removes the socket file
+    #  @param self The object pointer.
+    def Stop(self):
+        if not self._running:
+            return
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        self._sock.close()
+        for conn in list(self._connections):
+            conn.close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    ## Returns the counters as a dict
+    def Counters(self):
+        return {'requests': self.requests, 'transactions': self.transactions,
+                'coalesced': self.coalesced, 'batched': self.batched}
+
+    def _accept(self):
+        while self._running:
+            try:
+                sock, peer = self._sock.accept()
+            except (OSError, socket.error):
+                return
+            conn = _Connection(sock)
+            self._connections.add(conn)
+            thread = threading.Thread(target = self._receive, args = (conn,),
+                                      name = 'SmartDriveDaemonClient')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _receive(self, conn):
+        header = bytearray(REQUEST.size)
+        try:
+            while self._running:
+                _recvInto(conn.sock, memoryview(header))
+                seq, op, priority, address, reg, length = REQUEST.unpack_from(header)
+                blocks = None
+                if op == OP_WRITE:
+                    payload = bytearray(length)
+                    _recvInto(conn.sock, memoryview(payload))
+                    blocks = []
+                    pos = 0
+                    while pos < length:
+                        reg, count = BLOCK.unpack_from(payload, pos)
+                        pos += BLOCK.size
+                        blocks.append((reg, payload[pos:pos + count]))
+                        pos += count
+                elif op != OP_READ:
+                    conn.reply(seq, STATUS_ERROR, b'unknown op')
+                    continue
+                if priority == PRIORITY_DEFAULT:
+                    priority = PRIORITY_MOTION if op == OP_WRITE else PRIORITY_TELEMETRY
+                self._submit(_Request(op, address, reg, length, blocks, (conn, seq)),
+                             min(priority, PRIORITY_TELEMETRY))
+        except (EOFError, OSError, socket.error):
+            pass
+        finally:
+            self._connections.discard(conn)
+            conn.close()
+
+    def _submit(self, request, priority):
+        with self._cond:
+            self.requests += 1
+            if request.op == OP_READ:
+                key = (request.address, request.reg, request.length)
+                queued = self._pending_reads.get(key)
+                if queued is not None:
+                    queued.replies.extend(request.replies)
+                    self.coalesced += 1
+                    return
+                self._pending_reads[key] = request
+            self._queues[priority].append(request)
+            self._cond.notify()
+
+    def _next(self):
+        # the next request, or a batch of writes to one controller
+        with self._cond:
+            while self._running and not (self._queues[0] or self._queues[1]):
+                self._cond.wait()
+            if not self._running:
+                return None
+            queue = self._queues[0] if self._queues[0] else self._queues[1]
+            request = queue.popleft()
+            if request.op == OP_READ:
+                del self._pending_reads[(request.address, request.reg, request.length)]
+                return [request]
+            batch = [request]
+            while (queue and len(batch) < self.BATCH_MAX and queue[0].op == OP_WRITE and
+                   queue[0].address == request.address):
+                batch.append(queue.popleft())
+            self.batched += len(batch) - 1
+            return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next()
+            if batch is None:
+                return
+            first = batch[0]
+            try:
+                if first.op == OP_READ:
+                    data = bytearray(first.length)
+                    self.transport.readInto(first.address, first.reg, data, 0, first.length)
+                else:
+                    blocks = []
+                    for request in batch:
+                        blocks.extend(request.blocks)
+                    self.transport.writeBlocks(first.address, blocks)
+                    data = b''
+                status = STATUS_OK
+            except Exception as e:
+                status = STATUS_ERROR
+                data = str(e).encode('utf-8', 'replace')
+            self.transactions += 1
+            for request in batch:
+                for conn, seq in request.replies:
+                    conn.reply(seq, status, data)
+
+## SmartDrive_DaemonTransport: SmartDrive transport talking to the bus daemon.
+#  One connection, one request in flight; the SmartDrive bus_lock already
+#  serializes the calls of one controller, the lock here covers several
+#  SmartDrives sharing a transport.
+class SmartDrive_DaemonTransport(object):
+
+    ## Connects to the daemon
+    #  @param self The object pointer.
+    #  @param path Unix socket path of the daemon.
+    #  @param priority PRIORITY_MOTION or PRIORITY_TELEMETRY for every request, or by op by default.
+    def __init__(self, path = DEFAULT_PATH, priority = PRIORITY_DEFAULT):
+        self.path = path
+        self.priority = priority
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._header = bytearray(RESPONSE.size)
+
+    def _call(self, op, address, reg, length, payload, buf, offset):
+        with self._lock:
+            self._seq = (self._seq + 1) & 0xFFFFFFFF
+            self.sock.sendall(REQUEST.pack(self._seq, op, self.priority, address, reg, length) + payload)
+            _recvInto(self.sock, memoryview(self._header))
+            seq, status, size = RESPONSE.unpack_from(self._header)
+            if status != STATUS_OK:
+                message = bytearray(size)
+                _recvInto(self.sock, memoryview(message))
+                raise IOError(message.decode('utf-8', 'replace'))
+            if size:
+                _recvInto(self.sock, memoryview(buf)[offset:offset + size])
+
+    def readInto(self, address, reg, buf, offset, length):
+        self._call(OP_READ, address, reg, length, b'', buf, offset)
+
+    def writeBlocks(self, address, blocks):
+        payload = bytearray()
+        for reg, data in blocks:
+            payload += BLOCK.pack(reg, len(data))
+            payload += data
+        self._call(OP_WRITE, address, 0, len(payload), bytes(payload), None, 0)
+
+    ## Closes the connection
+    #  @param self The object pointer.
+    def close(self):
+        self.sock.close()
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+## Returns the process-wide SmartDrive_DaemonTransport for a socket path
+#  @param path Unix socket path of the daemon.
+def SharedTransport(path = DEFAULT_PATH):
+    with _shared_lock:
+        transport = _shared.get(path)
+        if transport is None:
+            transport = _shared[path] = SmartDrive_DaemonTransport(path)
+        return transport
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'SmartDrive I2C bus daemon')
+    parser.add_argument('--socket', default = DEFAULT_PATH, help = 'Unix socket path to listen on')
+    parser.add_argument('--bus', type = int, default = 1, help = 'I2C bus number, /dev/i2c-N')
+    parser.add_argument('--mode', type = lambda s: int(s, 8), default = 0o660, help = 'socket file permissions, octal')
+    args = parser.parse_args(argv)
+    daemon = SmartDrive_BusDaemon(args.socket, bus_number = args.bus, mode = args.mode)
+    daemon.Start()
+    try:
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        pass
+    daemon.Stop()
+
+if __name__ == '__main__':
+    main()
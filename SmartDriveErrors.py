@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveErrors
+# SmartDrive exceptions and bus error recovery.
+#
+#   EnableRecovery(sd, SmartDrive_RetryPolicy(retries = 3))
+#
+# puts a recovery transport under the SmartDrive: register reads are
+# retried with backoff, writes are not (a repeated command could run a
+# move twice), and a circuit breaker stops sending to a device that keeps
+# failing, letting one probe through every probe_interval. SmartDrives on
+# one bus share its breaker: by default they share one transport (see
+# SharedSMBusTransport and SmartDriveFleet), and the breaker is kept per
+# bus transport.
+
+import threading
+import time
+import weakref
+
+from SmartDriveRegisters import clock
+from SmartDriveTransport import BusTransport
+
+## SmartDrive_Error: base of the SmartDrive exceptions.
+#  An IOError, so code catching the smbus errors keeps working.
+class SmartDrive_Error(IOError):
+    pass
+
+## SmartDrive_BusError: a register transaction failed.
+#  address  7 bit address of the SmartDrive, or None.
+#  reg      first register of the transaction, or None.
+#  cause    the underlying exception, or None.
+class SmartDrive_BusError(SmartDrive_Error):
+
+    def __init__(self, message, address = None, reg = None, cause = None):
+        SmartDrive_Error.__init__(self, message)
+        self.address = address
+        self.reg = reg
+        self.cause = cause
+
+    def __str__(self):
+        text = self.args[0]
+        if self.address is not None:
+            text += ' (address 0x%02x' % (self.address << 1)
+            if self.reg is not None:
+                text += ', register 0x%02x' % self.reg
+            text += ')'
+        if self.cause is not None:
+            text += ': %s' % (self.cause,)
+        return text
+
+## SmartDrive_CircuitOpenError: not sent, the circuit breaker of the bus is open.
+class SmartDrive_CircuitOpenError(SmartDrive_BusError):
+    pass
+
+## SmartDrive_TimeoutError: a wait ran past its deadline.
+#  motor_number  the motor(s) waited for.
+#  timeout       the deadline, in seconds from the start of the wait.
+class SmartDrive_TimeoutError(SmartDrive_Error):
+
+    def __init__(self, message, motor_number = None, timeout = None):
+        SmartDrive_Error.__init__(self, message)
+        self.motor_number = motor_number
+        self.timeout = timeout
+
+## Returns a SmartDrive_BusError for an exception raised by a transaction
+#  SmartDrive errors are returned unchanged.
+#  @param e The exception.
+#  @param message What failed.
+#  @param address 7 bit address of the SmartDrive.
+#  @param reg First register of the transaction.
+def wrapBusError(e, message, address = None, reg = None):
+    if isinstance(e, SmartDrive_Error):
+        return e
+    return SmartDrive_BusError(message, address, reg, e)
+
+## SmartDrive_RetryPolicy: how often and how fast reads are retried.
+class SmartDrive_RetryPolicy(object):
+
+    ## Initialize the policy
+    #  @param self The object pointer.
+    #  @param retries Retries after the first attempt.
+    #  @param backoff Delay before the first retry, in seconds.
+    #  @param factor Multiplier of the delay for each further retry.
+    #  @param max_backoff Longest delay between two attempts, in seconds.
+    def __init__(self, retries = 3, backoff = 0.0005, factor = 2.0, max_backoff = 0.010):
+        self.retries = retries
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+
+    ## Returns the delay before retry number n (0 = first retry)
+    def Delay(self, n):
+        return min(self.backoff * self.factor ** n, self.max_backoff)
+
+## SmartDrive_CircuitBreaker: stops traffic to a device that keeps failing.
+#  Closed until threshold consecutive failures, then open: requests are
+#  refused without touching the bus, except one probe every probe_interval.
+#  A successful probe closes it again.
+class SmartDrive_CircuitBreaker(object):
+
+    ## Initialize the breaker
+    #  @param self The object pointer.
+    #  @param threshold Consecutive failures that open the breaker.
+    #  @param probe_interval Seconds between probes while open.
+    def __init__(self, threshold = 5, probe_interval = 0.5):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.trips = 0
+        self.opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    ## True while requests are refused
+    def IsOpen(self):
+        return self.opened is not None
+
+    ## Returns True if a request may go to the bus now
+    def Allow(self):
+        with self._lock:
+            if self.opened is None:
+                return True
+            if not self._probing and clock() - self.opened >= self.probe_interval:
+                self._probing = True
+                return True
+            return False
+
+    def Success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._probing = False
+
+    ## Ends a request that got no answer from the bus, e.g. an interrupted one
+    #  If it was the probe, the next request may probe again.
+    def Abort(self):
+        with self._lock:
+            self._probing = False
+
+    def Failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing:
+                # the probe failed, stay open for another interval
+                self._probing = False
+                self.opened = clock()
+            elif self.opened is None and self.failures >= self.threshold:
+                self.opened = clock()
+                self.trips += 1
+
+## SmartDrive_RecoveryTransport: transport wrapper with retries and a breaker.
+class SmartDrive_RecoveryTransport(object):
+
+    ## Initialize the wrapper
+    #  @param self The object pointer.
+    #  @param inner The transport that reaches the bus.
+    #  @param policy A SmartDrive_RetryPolicy for reads.
+    #  @param breaker The SmartDrive_CircuitBreaker of the bus.
+    def __init__(self, inner, policy = None, breaker = None):
+        self.inner = inner
+        self.policy = policy if policy is not None else SmartDrive_RetryPolicy()
+        self.breaker = breaker if breaker is not None else SmartDrive_CircuitBreaker()
+        self.transactions = 0
+        self.errors = 0
+        self.retries = 0
+        self.recovered = 0
+        self.failed = 0
+        self.rejected = 0
+        self.recovery_seconds = 0.0
+
+    ## Returns the recovery counters as a dict
+    def Counters(self):
+        return {'transactions': self.transactions, 'errors': self.errors, 'retries': self.retries,
+                'recovered': self.recovered, 'failed': self.failed, 'rejected': self.rejected,
+                'recovery_seconds': self.recovery_seconds, 'trips': self.breaker.trips,
+                'open': self.breaker.IsOpen()}
+
+    def _allow(self, address, reg):
+        if not self.breaker.Allow():
+            self.rejected += 1
+            raise SmartDrive_CircuitOpenError("circuit breaker open", address, reg)
+
+    def readInto(self, address, reg, buf, offset, length):
+        self._allow(address, reg)
+        self.transactions += 1
+        t_fail = None
+        n = 0
+        settled = False
+        try:
+            while True:
+                try:
+                    self.inner.readInto(address, reg, buf, offset, length)
+                except (IOError, OSError) as e:
+                    self.errors += 1
+                    self.breaker.Failure()
+                    if t_fail is None:
+                        t_fail = clock()
+                    if n >= self.policy.retries or self.breaker.IsOpen():
+                        self.failed += 1
+                        settled = True
+                        raise wrapBusError(e, "read failed after %d attempts" % (n + 1), address, reg)
+                    time.sleep(self.policy.Delay(n))
+                    n += 1
+                    self.retries += 1
+                    continue
+                self.breaker.Success()
+                settled = True
+                if t_fail is not None:
+                    self.recovered += 1
+                    self.recovery_seconds += clock() - t_fail
+                return
+        finally:
+            if not settled:
+                # neither success nor bus error, e.g. KeyboardInterrupt: free the probe
+                self.breaker.Abort()
+
+    def writeBlocks(self, address, blocks):
+        reg = blocks[0][0] if blocks else None
+        self._allow(address, reg)
+        self.transactions += 1
+        settled = False
+        try:
+            self.inner.writeBlocks(address, blocks)
+            settled = True
+        except (IOError, OSError) as e:
+            self.errors += 1
+            self.failed += 1
+            self.breaker.Failure()
+            settled = True
+            raise wrapBusError(e, "write failed", address, reg)
+        finally:
+            if not settled:
+                self.breaker.Abort()
+        self.breaker.Success()
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+# recovery transport per wrapped transport and breaker per bus transport,
+# each dropped once no SmartDrive uses it any more
+_recovery = weakref.WeakValueDictionary()
+_breakers = weakref.WeakValueDictionary()
+_recovery_lock = threading.Lock()
+
+## Puts retries and a circuit breaker under a SmartDrive
+#  SmartDrives sharing one transport get the same recovery transport, and
+#  every recovery transport on one bus uses the same breaker, even with
+#  other wrappers (shadow, counters) in between.
+#  @param sd The SmartDrive.
+#  @param policy A SmartDrive_RetryPolicy, the default policy if None.
+#  @param breaker A SmartDrive_CircuitBreaker, the bus's own if None.
+#  @return The SmartDrive_RecoveryTransport.
+def EnableRecovery(sd, policy = None, breaker = None):
+    if isinstance(sd.transport, SmartDrive_RecoveryTransport):
+        return sd.transport
+    with _recovery_lock:
+        recovery = _recovery.get(sd.transport)
+        if recovery is None:
+            if breaker is None:
+                bus = BusTransport(sd.transport)
+                breaker = _breakers.get(bus)
+                if breaker is None:
+                    breaker = SmartDrive_CircuitBreaker()
+                    _breakers[bus] = breaker
+            recovery = SmartDrive_RecoveryTransport(sd.transport, policy, breaker)
+            _recovery[sd.transport] = recovery
+    sd.transport = recovery
+    return recovery
+
+## Removes retries and the circuit breaker from a SmartDrive
+#  @param sd The SmartDrive.
+def DisableRecovery(sd):
+    if isinstance(sd.transport, SmartDrive_RecoveryTransport):
+        sd.transport = sd.transport.inner
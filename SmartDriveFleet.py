@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveFleet
+# Several SmartDrives chained on one i2c bus, with one fair lock for the
+# bus and a fleet-wide synchronized start.
+
+from collections import namedtuple
+import threading
+
+from SmartDrive import SmartDrive
+from SmartDriveRegisters import clock
+from SmartDriveTransport import BusTransport
+
+## SmartDrive_FairLock: reentrant lock granted in request order.
+#  A thread that already holds it can take it again; other threads are
+#  served first come, first served, so a busy thread cannot starve the rest.
+class SmartDrive_FairLock(object):
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._next_ticket = 0
+        self._serving = 0
+        self._owner = None
+        self._depth = 0
+
+    def acquire(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._owner is me:
+                self._depth += 1
+                return True
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while self._serving != ticket:
+                self._cond.wait()
+            self._owner = me
+            self._depth = 1
+            return True
+
+    def release(self):
+        with self._cond:
+            if self._owner is not threading.current_thread():
+                raise RuntimeError("cannot release un-acquired lock")
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._serving += 1
+                self._cond.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+## SmartDrive_StartReport: result of a fleet-wide synchronized start.
+#  addresses the controllers started, in firing order.
+#  times     host time just after each S command was written.
+#  skew      seconds between the first and the last S command.
+SmartDrive_StartReport = namedtuple('SmartDrive_StartReport', 'addresses times skew')
+
+## SmartDrive_Fleet: owns the bus and the SmartDrives chained on it
+class SmartDrive_Fleet(object):
+
+    ## Initialize the fleet
+    #  @param self The object pointer.
+    #  @param addresses SmartDrive addresses (8 bit, as passed to SmartDrive()).
+    #  @param drives Already constructed SmartDrives to add to the fleet.
+    #  @param transport Register transport shared by the SmartDrives created from addresses.
+    def __init__(self, addresses = (), drives = (), transport = None):
+        self.lock = SmartDrive_FairLock()
+        self.drives = {}
+        self.bus = None
+        self.transport = None
+        self.max_skew = 0.0
+        self._preloaded = []
+        for address in addresses:
+            self.Add(SmartDrive(address, transport), address)
+        for drive in drives:
+            self.Add(drive)
+
+    ## Adds a SmartDrive to the fleet; it shares the fleet's transport and lock from now on
+    #  The first SmartDrive added brings the fleet's transport. A later one
+    #  on another transport is moved onto the fleet's; the bus handle or
+    #  transport it leaves behind is closed.
+    #  @param self The object pointer.
+    #  @param drive The SmartDrive.
+    #  @param address Key to file it under, defaults to its 8 bit address.
+    def Add(self, drive, address = None):
+        if address is None:
+            address = drive.address << 1
+        if self.transport is None:
+            self.transport = drive.transport
+            self.bus = drive.bus
+        elif drive.transport is not self.transport:
+            replaced = BusTransport(drive.transport)
+            base = BusTransport(self.transport)
+            drive.transport = self.transport
+            if hasattr(base, 'Attach'):
+                # route the drive's address through the fleet's bus handle
+                base.Attach(drive)
+            else:
+                drive.bus = self.bus
+            if replaced is not base and hasattr(replaced, 'close'):
+                replaced.close()
+        drive.bus_lock = self.lock
+        self.drives[address] = drive
+        return drive
+
+    def __getitem__(self, address):
+        return self.drives[address]
+
+    ## Runs several calls back to back while holding the bus
+    #  @param self The object pointer.
+    #  @param calls A sequence of (address, method name, args) tuples.
+    #  @return The list of results, in order.
+    def Batch(self, calls):
+        results = []
+        with self.lock:
+            for address, name, args in calls:
+                results.append(getattr(self.drives[address], name)(*args))
+        return results
+
+    ## Writes both motors' frames of one controller without starting them
+    #  @param self The object pointer.
+    #  @param address The controller to preload.
+    #  @param speed_m1 The signed speed of motor 1.
+    #  @param speed_m2 The signed speed of motor 2.
+    #  @param kwargs Further SmartDrive_Run_Both arguments (tacho_m1, tacho_m2, duration, move, next_action).
+    def Preload(self, address, speed_m1, speed_m2, **kwargs):
+        kwargs['start'] = False
+        self.drives[address].SmartDrive_Run_Both(speed_m1, speed_m2, **kwargs)
+        if address not in self._preloaded:
+            self._preloaded.append(address)
+
+    ## Starts every preloaded controller with back to back S commands
+    #  @param self The object pointer.
+    #  @param addresses Controllers to start, defaults to all preloaded ones.
+    #  @return A SmartDrive_StartReport.
+    def SynchronizedStart(self, addresses = None):
+        if addresses is None:
+            addresses = self._preloaded
+        addresses = list(addresses)
+        times = []
+        with self.lock:
+            for address in addresses:
+                drive = self.drives[address]
+                drive.writeByte(drive.SmartDrive_COMMAND, drive.S)
+                times.append(clock())
+        self._preloaded = []
+        skew = times[-1] - times[0] if times else 0.0
+        if skew > self.max_skew:
+            self.max_skew = skew
+        return SmartDrive_StartReport(addresses, times, skew)
+
+    ## Stops the motors of every controller
+    #  @param self The object pointer.
+    #  @param next_action How you wish to stop the motors.
+    def StopAll(self, next_action = SmartDrive.SmartDrive_Next_Action_Brake):
+        with self.lock:
+            for drive in self.drives.values():
+                drive.SmartDrive_Stop(drive.SmartDrive_Motor_Both, next_action)
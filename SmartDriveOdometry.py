@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveOdometry
+# Differential drive odometry for a robot with motor 1 on the left and
+# motor 2 on the right wheel.
+#
+#   odometry = SmartDrive_Odometry(sd, wheel_diameter = 0.056, track_width = 0.12)
+#   x, y, heading = odometry.Update()
+#   odometry.Drive(0.5, math.pi / 2, 50, SmartDrive.SmartDrive_Completion_Wait_For)
+#
+# Units are whatever wheel_diameter and track_width are given in; headings
+# are radians, counter-clockwise positive.
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from SmartDrive import SmartDrive
+from SmartDriveRegisters import POSITIONS
+
+## SmartDrive_Odometry: pose of a differential drive from its tacho counts.
+#  Both positions are read in one transaction, so the two wheels are
+#  sampled at the same instant.
+class SmartDrive_Odometry(object):
+
+    ## Initialize the odometry
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive driving the wheels.
+    #  @param wheel_diameter Wheel diameter.
+    #  @param track_width Distance between the two wheel contact points, same unit.
+    #  @param counts_per_rev Tacheometer counts per wheel revolution.
+    #  @param left_sign 1, or -1 if motor 1 counts down when the robot moves forward.
+    #  @param right_sign 1, or -1 if motor 2 counts down when the robot moves forward.
+    def __init__(self, sd, wheel_diameter, track_width, counts_per_rev = 360, left_sign = 1, right_sign = 1):
+        self.sd = sd
+        self.track_width = float(track_width)
+        self.distance_per_count = math.pi * wheel_diameter / counts_per_rev
+        self.left_sign = left_sign
+        self.right_sign = right_sign
+        self._block = bytearray(POSITIONS.size)
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.last = None
+        self.targets = None
+
+    ## Reads both positions in one transaction
+    #  @param self The object pointer.
+    #  @return (position_m1, position_m2)
+    def ReadPositions(self):
+        self.sd.readBlockInto(self.sd.SmartDrive_POSITION_M1, self._block, 0, POSITIONS.size)
+        return POSITIONS.unpack_from(self._block)
+
+    ## Sets the pose; the next sample is taken as the reference
+    #  @param self The object pointer.
+    def Reset(self, x = 0.0, y = 0.0, heading = 0.0):
+        self.x = x
+        self.y = y
+        self.heading = heading
+        self.last = None
+
+    ## Integrates one pair of positions into the pose
+    #  @param self The object pointer.
+    #  @param position_m1 Left wheel tacho count.
+    #  @param position_m2 Right wheel tacho count.
+    #  @return (x, y, heading)
+    def Integrate(self, position_m1, position_m2):
+        last = self.last
+        self.last = (position_m1, position_m2)
+        if last is None:
+            return self.x, self.y, self.heading
+        left = (position_m1 - last[0]) * self.left_sign * self.distance_per_count
+        right = (position_m2 - last[1]) * self.right_sign * self.distance_per_count
+        distance = 0.5 * (left + right)
+        turn = (right - left) / self.track_width
+        # the robot moved along an arc; its chord points at the mean heading
+        half = 0.5 * turn
+        if half:
+            distance *= math.sin(half) / half
+        heading = self.heading + half
+        self.x += distance * math.cos(heading)
+        self.y += distance * math.sin(heading)
+        self.heading += turn
+        return self.x, self.y, self.heading
+
+    ## Reads the positions and updates the pose
+    #  @param self The object pointer.
+    #  @return (x, y, heading)
+    def Update(self):
+        p1, p2 = self.ReadPositions()
+        return self.Integrate(p1, p2)
+
+    ## Integrates whole position traces at once (needs numpy)
+    #  The pose before the first sample is the current pose; the odometry
+    #  itself is not changed.
+    #  @param self The object pointer.
+    #  @param positions_m1 Left wheel tacho counts, one per sample.
+    #  @param positions_m2 Right wheel tacho counts, same length.
+    #  @return (x, y, heading) numpy arrays, one value per sample.
+    def IntegrateTrace(self, positions_m1, positions_m2):
+        if numpy is None:
+            raise RuntimeError("numpy is not installed")
+        p1 = numpy.asarray(positions_m1, dtype = numpy.float64)
+        p2 = numpy.asarray(positions_m2, dtype = numpy.float64)
+        left = numpy.diff(p1) * (self.left_sign * self.distance_per_count)
+        right = numpy.diff(p2) * (self.right_sign * self.distance_per_count)
+        turn = (right - left) / self.track_width
+        distance = 0.5 * (left + right) * numpy.sinc(turn / (2.0 * math.pi))
+        heading = numpy.empty(len(p1))
+        heading[0] = self.heading
+        numpy.cumsum(turn, out = heading[1:])
+        heading[1:] += self.heading
+        mean_heading = heading[:-1] + 0.5 * turn
+        x = numpy.empty(len(p1))
+        y = numpy.empty(len(p1))
+        x[0] = self.x
+        y[0] = self.y
+        numpy.cumsum(distance * numpy.cos(mean_heading), out = x[1:])
+        numpy.cumsum(distance * numpy.sin(mean_heading), out = y[1:])
+        x[1:] += self.x
+        y[1:] += self.y
+        return x, y, heading
+
+    ## Integrates samples recorded by SmartDriveRecorder (needs numpy)
+    #  @param self The object pointer.
+    #  @param records A RECORD_DTYPE array, e.g. ReadRecordLog() or the concatenated SmartDrive_Recorder.NumpyViews().
+    #  @return (times, x, y, heading) numpy arrays.
+    def IntegrateRecords(self, records):
+        x, y, heading = self.IntegrateTrace(records['position_m1'], records['position_m2'])
+        return records['time'], x, y, heading
+
+    ## Returns the tacho counts each wheel must turn for a move
+    #  @param self The object pointer.
+    #  @param distance Distance the middle of the axle travels.
+    #  @param turn Heading change in radians, counter-clockwise positive.
+    #  @return (counts_m1, counts_m2)
+    def Counts(self, distance, turn = 0.0):
+        half = 0.5 * turn * self.track_width
+        left = (distance - half) / self.distance_per_count
+        right = (distance + half) / self.distance_per_count
+        return int(round(left * self.left_sign)), int(round(right * self.right_sign))
+
+    ## Drives a distance while turning, both motors started by one command
+    #  Targets are absolute and chained from the previous Drive() target,
+    #  so a move that stops a few counts off does not shift the next. Speeds are scaled so both
+    #  wheels arrive together.
+    #  @param self The object pointer.
+    #  @param distance Distance the middle of the axle travels.
+    #  @param turn Heading change in radians, counter-clockwise positive.
+    #  @param speed Speed of the faster wheel, 0 - 100.
+    #  @param wait_for_completion Tells the program when to continue.
+    #  @param next_action How the motors hold at the end of the move.
+    #  @return The (m1, m2) absolute tacho targets.
+    def Drive(self, distance, turn = 0.0, speed = 50, wait_for_completion = SmartDrive.SmartDrive_Completion_Dont_Wait,
+              next_action = SmartDrive.SmartDrive_Next_Action_Brake):
+        counts_m1, counts_m2 = self.Counts(distance, turn)
+        if self.targets is None:
+            self.targets = self.ReadPositions()
+        targets = (self.targets[0] + counts_m1, self.targets[1] + counts_m2)
+        self.targets = targets
+        longest = max(abs(counts_m1), abs(counts_m2))
+        if longest == 0:
+            return targets
+        speed = abs(int(speed))
+        speed_m1 = max(1, int(round(speed * abs(counts_m1) / float(longest)))) if counts_m1 else 0
+        speed_m2 = max(1, int(round(speed * abs(counts_m2) / float(longest)))) if counts_m2 else 0
+        self.sd.SmartDrive_Run_Both(speed_m1, speed_m2, targets[0], targets[1],
+                                    move = self.sd.SmartDrive_Move_Absolute,
+                                    wait_for_completion = wait_for_completion, next_action = next_action)
+        return targets
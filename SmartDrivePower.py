@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDrivePower
+# Power telemetry: battery voltage and both motor currents sampled in one
+# transaction at a fixed rate, served from a cache, with running stats and
+# threshold callbacks.
+#
+#   power = SmartDrive_PowerTelemetry(sd, rate = 20.0)
+#   power.AddThreshold('voltage', 6500, shed_load, above = False, hysteresis = 200)
+#   power.Start()
+#   sd.GetBattVoltage()          # now answered from the cache
+#
+# Voltage is in millivolts, as GetBattVoltage; currents are the raw
+# register values, converted to amps with current_scale for power and
+# energy.
+
+from collections import namedtuple
+import threading
+import time
+
+from SmartDriveRegisters import clock, POWER
+
+## SmartDrive_PowerSample: one reading.
+#  time        host clock of the read.
+#  voltage     battery voltage in millivolts.
+#  current_m1  motor 1 current register.
+#  current_m2  motor 2 current register.
+#  power       voltage * (current_m1 + current_m2) in watts.
+SmartDrive_PowerSample = namedtuple('SmartDrive_PowerSample', 'time voltage current_m1 current_m2 power')
+
+## SmartDrive_WindowStats: stats of one channel over one window.
+SmartDrive_WindowStats = namedtuple('SmartDrive_WindowStats', 'count mean min max ewma')
+
+## Channel names accepted by Stats() and AddThreshold().
+CHANNELS = ('voltage', 'current_m1', 'current_m2', 'power')
+
+## SmartDrive_ChannelStats: running stats of one channel in fixed memory.
+#  Windows are consecutive (tumbling): mean, min and max cover the current
+#  window and the last complete one is kept; the EWMA runs across windows.
+class SmartDrive_ChannelStats(object):
+
+    __slots__ = ('window', 'alpha', 'start', 'count', 'total', 'low', 'high', 'ewma', 'previous')
+
+    def __init__(self, window, alpha):
+        self.window = window
+        self.alpha = alpha
+        self.start = None
+        self.count = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+        self.ewma = None
+        self.previous = None
+
+    def add(self, t, value):
+        if self.start is None:
+            self.start = t
+        elif t - self.start >= self.window:
+            self.previous = self.Current()
+            self.start = t
+            self.count = 0
+            self.total = 0.0
+            self.low = None
+            self.high = None
+        self.count += 1
+        self.total += value
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+
+    ## Stats of the window in progress
+    def Current(self):
+        mean = self.total / self.count if self.count else None
+        return SmartDrive_WindowStats(self.count, mean, self.low, self.high, self.ewma)
+
+    ## Stats of the last complete window, or None
+    def Previous(self):
+        return self.previous
+
+class _Threshold(object):
+
+    __slots__ = ('channel', 'limit', 'callback', 'above', 'hysteresis', 'tripped')
+
+    def __init__(self, channel, limit, callback, above, hysteresis):
+        self.channel = channel
+        self.limit = limit
+        self.callback = callback
+        self.above = above
+        self.hysteresis = hysteresis
+        self.tripped = False
+
+## SmartDrive_PowerTelemetry: samples the power registers of one SmartDrive.
+class SmartDrive_PowerTelemetry(object):
+
+    ## Initialize the telemetry
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive to sample.
+    #  @param rate Samples per second.
+    #  @param max_age Oldest cached sample served, in seconds; two periods by default.
+    #  @param window Length of a stats window, in seconds.
+    #  @param alpha EWMA weight of the newest sample.
+    #  @param current_scale Amps per count of the current registers.
+    def __init__(self, sd, rate = 10.0, max_age = None, window = 10.0, alpha = 0.1, current_scale = 0.001):
+        self.sd = sd
+        self.period = 1.0 / rate
+        self.max_age = max_age if max_age is not None else 2.0 * self.period
+        self.current_scale = current_scale
+        self.stats = dict((name, SmartDrive_ChannelStats(window, alpha)) for name in CHANNELS)
+        self.energy = 0.0
+        self.samples = 0
+        self.errors = 0
+        self.callback_errors = 0
+        # last exception counted in errors or callback_errors
+        self.last_error = None
+        self.latest = None
+        self._buf = bytearray(POWER.size)
+        self._thresholds = []
+        # guards the stats, energy, latest, thresholds and error counters
+        self._lock = threading.Lock()
+        # guards _buf from the bus read to the unpack
+        self._read_lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    ## Starts sampling and answers sd.GetBattVoltage / GetMotorCurrent from the cache
+    #  @param self The object pointer.
+    def Start(self):
+        if self._running:
+            return
+        self._running = True
+        self.sd.power_telemetry = self
+        self._thread = threading.Thread(target = self._run, name = 'SmartDrivePower')
+        self._thread.daemon = True
+        self._thread.start()
+
+    ## Stops sampling
+    #  @param self The object pointer.
+    def Stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if getattr(self.sd, 'power_telemetry', None) is self:
+            self.sd.power_telemetry = None
+
+    def _run(self):
+        t_start = clock()
+        n = 0
+        try:
+            while self._running:
+                delay = t_start + n * self.period - clock()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    self._sample(True)
+                except Exception as e:
+                    # a failed read leaves the cache to go stale; readers then go to the bus
+                    with self._lock:
+                        self.errors += 1
+                        self.last_error = e
+                n = max(n + 1, int((clock() - t_start) / self.period))
+        finally:
+            # however the thread ends, stop serving sd from a cache nothing refreshes
+            if self._thread is threading.current_thread():
+                self._running = False
+                if getattr(self.sd, 'power_telemetry', None) is self:
+                    self.sd.power_telemetry = None
+
+    ## Reads the power registers now, updating cache and stats
+    #  Thresholds are checked here only while the sampling thread is not
+    #  running; otherwise that thread checks them on its next sample.
+    #  @param self The object pointer.
+    #  @return A SmartDrive_PowerSample.
+    def Sample(self):
+        return self._sample(not self._running)
+
+    def _sample(self, check):
+        sd = self.sd
+        with self._read_lock:
+            sd.readBlockInto(sd.SmartDrive_BATT_VOLTAGE, self._buf, 0, POWER.size)
+            now = clock()
+            battery, reset, current_m1, current_m2 = POWER.unpack_from(self._buf)
+        voltage = battery * sd.SmartDrive_VOLTAGE_MULTIPLIER
+        power = voltage * 0.001 * (current_m1 + current_m2) * self.current_scale
+        sample = SmartDrive_PowerSample(now, voltage, current_m1, current_m2, power)
+        with self._lock:
+            previous = self.latest
+            if previous is not None and now <= previous.time:
+                # a newer sample got in first; keep latest and energy monotonic
+                return sample
+            if previous is not None:
+                self.energy += 0.5 * (power + previous.power) * (now - previous.time)
+            self.latest = sample
+            self.samples += 1
+            for name, value in zip(CHANNELS, sample[1:]):
+                self.stats[name].add(now, value)
+            fired = self._check(sample) if check else ()
+        for threshold, value in fired:
+            try:
+                threshold.callback(threshold.channel, value, sample)
+            except Exception as e:
+                # a failing callback must not stop the sampling
+                with self._lock:
+                    self.callback_errors += 1
+                    self.last_error = e
+        return sample
+
+    def _check(self, sample):
+        fired = []
+        for threshold in self._thresholds:
+            value = getattr(sample, threshold.channel)
+            if threshold.above:
+                crossed = value > threshold.limit
+                cleared = value <= threshold.limit - threshold.hysteresis
+            else:
+                crossed = value < threshold.limit
+                cleared = value >= threshold.limit + threshold.hysteresis
+            if not threshold.tripped and crossed:
+                threshold.tripped = True
+                fired.append((threshold, value))
+            elif threshold.tripped and cleared:
+                threshold.tripped = False
+        return fired
+
+    ## Returns a sample no older than max_age, reading the bus only if the cache is stale
+    #  @param self The object pointer.
+    #  @param max_age Overrides the configured freshness bound, in seconds.
+    def Read(self, max_age = None):
+        if max_age is None:
+            max_age = self.max_age
+        sample = self.latest
+        if sample is not None and clock() - sample.time <= max_age:
+            return sample
+        return self.Sample()
+
+    ## Battery voltage in millivolts, from the cache when fresh
+    def Voltage(self, max_age = None):
+        return self.Read(max_age).voltage
+
+    ## Current register of a motor, from the cache when fresh
+    #  @param self The object pointer.
+    #  @param motor_number 1 or 2.
+    #  @exception ValueError motor_number is not 1 or 2.
+    def Current(self, motor_number, max_age = None):
+        if motor_number not in (1, 2):
+            raise ValueError("motor_number must be 1 or 2, not %r" % (motor_number,))
+        sample = self.Read(max_age)
+        return sample.current_m1 if motor_number == 1 else sample.current_m2
+
+    ## Returns the SmartDrive_WindowStats of a channel
+    #  @param self The object pointer.
+    #  @param channel One of CHANNELS.
+    #  @param previous True for the last complete window instead of the current one.
+    def Stats(self, channel, previous = False):
+        with self._lock:
+            stats = self.stats[channel]
+            return stats.Previous() if previous else stats.Current()
+
+    ## Calls callback(channel, value, sample) when a channel crosses a limit
+    #  The callback runs on the sampling thread, once per crossing; it is
+    #  armed again when the value comes back hysteresis past the limit.
+    #  Exceptions it raises are counted in callback_errors.
+    #  @param self The object pointer.
+    #  @param channel One of CHANNELS.
+    #  @param limit The limit.
+    #  @param callback The function to call.
+    #  @param above True to fire when the value rises above limit, False when it drops below.
+    #  @param hysteresis Distance back past the limit that re-arms the threshold.
+    #  @return A handle for RemoveThreshold.
+    def AddThreshold(self, channel, limit, callback, above = True, hysteresis = 0.0):
+        if channel not in CHANNELS:
+            raise ValueError("unknown channel %r" % (channel,))
+        threshold = _Threshold(channel, limit, callback, above, hysteresis)
+        with self._lock:
+            self._thresholds = self._thresholds + [threshold]
+        return threshold
+
+    ## Removes a threshold added with AddThreshold
+    def RemoveThreshold(self, handle):
+        with self._lock:
+            self._thresholds = [t for t in self._thresholds if t is not handle]
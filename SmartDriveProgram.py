@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveProgram
+# Compiled motion programs: a fixed routine of Run_*, Stop and
+# SetPerformanceParameters calls recorded once as pre-encoded register
+# writes, waits and sleeps, saved as a binary file and replayed from a
+# memory map.
+#
+#   compiler = SmartDrive_ProgramCompiler()
+#   left = compiler.Controller(0)
+#   left.SmartDrive_Run_Degrees(3, 1, 50, 360, SmartDrive.SmartDrive_Completion_Wait_For, 1)
+#   compiler.Sleep(0.25)
+#   compiler.Save('routine.sdp')
+#
+#   program = SmartDrive_Program('routine.sdp')
+#   SmartDrive_ProgramPlayer([sd]).Play(program)
+
+from array import array
+import math
+import mmap
+import struct
+import time
+
+from SmartDrive import SmartDrive
+from SmartDriveErrors import SmartDrive_TimeoutError
+from SmartDriveRegisters import clock
+from SmartDriveWait import STATUS_TACHO, STATUS_TIME
+
+## File header: magic, version, step size, step count.
+PROGRAM_HEADER = struct.Struct('<4sHHI')
+PROGRAM_MAGIC = b'SDPG'
+
+## One step: opcode, controller index, register, data length, argument, data.
+STEP = struct.Struct('<BBBBI24s')
+STEP_DATA_OFFSET = 8
+STEP_DATA_MAX = 24
+
+# Step opcodes.
+OP_WRITE = 1        # write data[:length] at register
+OP_WAIT_TACHO = 2   # wait for the tacho bit of motor mask (arg), data = estimate (float, negative if unknown)
+OP_WAIT_TIME = 3    # wait for the time bit of motor mask (arg), data = estimate (float)
+OP_SLEEP = 4        # sleep arg microseconds
+
+_ESTIMATE = struct.Struct('<d')
+
+class _RecordingTransport(object):
+    # Collects the writes a SmartDrive makes instead of sending them.
+
+    def __init__(self, compiler, index):
+        self.compiler = compiler
+        self.index = index
+
+    def readInto(self, address, reg, buf, offset, length):
+        raise RuntimeError("motion programs cannot contain register reads")
+
+    def writeBlocks(self, address, blocks):
+        for reg, data in blocks:
+            for start in range(0, len(data), STEP_DATA_MAX):
+                chunk = bytes(bytearray(data[start:start + STEP_DATA_MAX]))
+                self.compiler.steps.append(STEP.pack(OP_WRITE, self.index, reg + start, len(chunk), 0, chunk))
+
+class _RecordingWaits(object):
+    # Stands in for the SmartDrive wait engine; records waits as steps.
+
+    def __init__(self, compiler, index, engine):
+        self.compiler = compiler
+        self.index = index
+        self.engine = engine
+
+    def WaitTime(self, sd, motor_number, duration):
+        self.compiler.steps.append(STEP.pack(OP_WAIT_TIME, self.index, 0, 8, motor_number,
+                                             _ESTIMATE.pack(float(duration))))
+
+    def WaitTacho(self, sd, motor_number, speed, delta = None, target = None):
+        # absolute targets depend on where the motor is at replay time
+        estimate = -1.0
+        if delta is not None:
+            if not isinstance(speed, tuple):
+                speed = (speed, speed)
+            if not isinstance(delta, tuple):
+                delta = (delta, delta)
+            estimate = 0.0
+            for m in (0, 1):
+                if motor_number & (1 << m):
+                    estimate = max(estimate, self.engine.TachoEstimate(speed[m], delta[m]))
+        self.compiler.steps.append(STEP.pack(OP_WAIT_TACHO, self.index, 0, 8, motor_number,
+                                             _ESTIMATE.pack(estimate)))
+
+## SmartDrive_ProgramCompiler: records SmartDrive calls as a program.
+#  Controller(n) returns a SmartDrive whose register writes and completion
+#  waits are captured as steps instead of going to the bus, so the encoding
+#  is exactly what the driver itself would send.
+class SmartDrive_ProgramCompiler(object):
+
+    def __init__(self):
+        self.steps = []
+        self._controllers = {}
+
+    ## Returns the recording SmartDrive for controller index
+    #  @param self The object pointer.
+    #  @param index Position of the controller in the list given to SmartDrive_ProgramPlayer.
+    def Controller(self, index = 0):
+        sd = self._controllers.get(index)
+        if sd is None:
+            sd = SmartDrive(SmartDrive.SmartDrive_ADDRESS, transport = _RecordingTransport(self, index))
+            sd.wait_engine = _RecordingWaits(self, index, sd.wait_engine)
+            self._controllers[index] = sd
+        return sd
+
+    ## Adds a fixed pause
+    #  @param self The object pointer.
+    #  @param seconds Length of the pause.
+    def Sleep(self, seconds):
+        self.steps.append(STEP.pack(OP_SLEEP, 0, 0, 0, int(round(seconds * 1e6)), b''))
+
+    ## Returns the compiled program as bytes
+    def Bytes(self):
+        return PROGRAM_HEADER.pack(PROGRAM_MAGIC, 1, STEP.size, len(self.steps)) + b''.join(self.steps)
+
+    ## Writes the compiled program to a file
+    #  @param self The object pointer.
+    #  @param path The file to write.
+    def Save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.Bytes())
+
+## SmartDrive_Program: a compiled program mapped from a file.
+#  Write steps are resolved once at load time into register blocks that
+#  point into the map; consecutive writes to the same controller are sent
+#  as one writeBlocks() call.
+class SmartDrive_Program(object):
+
+    ## Maps a program file
+    #  @param self The object pointer.
+    #  @param path The program file.
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            self.data = memoryview(self._map)
+        except TypeError:
+            # Python 2 mmap has no new-style buffer; fall back to a copy
+            self.data = memoryview(bytearray(self._map[:]))
+        magic, version, step_size, count = PROGRAM_HEADER.unpack_from(self._map, 0)
+        if magic != PROGRAM_MAGIC or step_size != STEP.size:
+            raise ValueError("not a SmartDrive motion program: %s" % path)
+        self.count = count
+        self._resolve()
+
+    def _resolve(self):
+        # ops[i], index[i], arg[i] describe step group i; blocks[i] holds its writes
+        self.ops = array('B')
+        self.index = array('B')
+        self.args = array('d')
+        self.masks = array('I')
+        self.blocks = []
+        base = PROGRAM_HEADER.size
+        for i in range(self.count):
+            offset = base + i * STEP.size
+            op, index, reg, length, arg = struct.unpack_from('<BBBBI', self._map, offset)
+            data = self.data[offset + STEP_DATA_OFFSET:offset + STEP_DATA_OFFSET + length]
+            if op == OP_WRITE:
+                if self.ops and self.ops[-1] == OP_WRITE and self.index[-1] == index:
+                    self.blocks[-1].append((reg, data))
+                    continue
+                self._add(op, index, 0, 0.0, [(reg, data)])
+            elif op == OP_SLEEP:
+                self._add(op, index, 0, arg / 1e6, None)
+            else:
+                self._add(op, index, arg, _ESTIMATE.unpack_from(self._map, offset + STEP_DATA_OFFSET)[0], None)
+
+    def _add(self, op, index, mask, arg, blocks):
+        self.ops.append(op)
+        self.index.append(index)
+        self.masks.append(mask)
+        self.args.append(arg)
+        self.blocks.append(blocks)
+
+    ## Number of step groups replayed
+    def __len__(self):
+        return len(self.ops)
+
+    ## Releases the map
+    def Close(self):
+        self.blocks = []
+        if hasattr(self.data, 'release'):
+            self.data.release()
+        self._map.close()
+        self._file.close()
+
+## SmartDrive_ProgramPlayer: replays programs on a list of SmartDrives.
+#  Every step group's start time, relative to the start of the run, is
+#  written to a preallocated timeline; Play returns a copy of it, so the
+#  timelines of two runs can be compared.
+class SmartDrive_ProgramPlayer(object):
+
+    ## Initialize the player
+    #  @param self The object pointer.
+    #  @param drives The SmartDrives, by controller index.
+    #  @param poll_interval Seconds between status reads while waiting.
+    #  @param spin Seconds before a deadline to stop sleeping and spin.
+    def __init__(self, drives, poll_interval = 0.002, spin = 0.001):
+        self.drives = list(drives)
+        self.poll_interval = poll_interval
+        self.spin = spin
+        self.timeline = array('d')
+        self._status = bytearray(2)
+
+    def _sleepUntil(self, deadline):
+        delay = deadline - clock() - self.spin
+        if delay > 0:
+            time.sleep(delay)
+        while clock() < deadline:
+            pass
+
+    def _wait(self, sd, mask, bit, estimate, started):
+        status = self._status
+        engine = sd.wait_engine
+        if estimate < 0:
+            timeout = engine.Timeout()
+            first = engine.status_delay
+        else:
+            timeout = engine.Timeout(estimate)
+            first = max(engine.status_delay, estimate - self.poll_interval)
+        self._sleepUntil(started + min(first, timeout))
+        while True:
+            sd.readBlockInto(sd.SmartDrive_STATUS_M1, status, 0, 2)
+            if not engine.Busy(mask, status[0], status[1], bit):
+                return
+            if clock() - started > timeout:
+                raise SmartDrive_TimeoutError("motor %d not done after %g seconds" % (mask, timeout),
+                                              mask, timeout)
+            self._sleepUntil(clock() + self.poll_interval)
+
+    ## Replays a program
+    #  @param self The object pointer.
+    #  @param program A SmartDrive_Program.
+    #  @return A new array of the step group start times in seconds.
+    #  @exception SmartDrive_TimeoutError A wait ran past the wait engine's deadline for its estimate.
+    def Play(self, program):
+        count = len(program)
+        if len(self.timeline) != count:
+            self.timeline = array('d', [0.0]) * count
+        timeline = self.timeline
+        drives = self.drives
+        ops = program.ops
+        index = program.index
+        masks = program.masks
+        args = program.args
+        blocks = program.blocks
+        # last command time per controller, waits are measured from it
+        started = [0.0] * len(drives)
+        t0 = clock()
+        deadline = t0
+        for i in range(count):
+            now = clock()
+            timeline[i] = now - t0
+            op = ops[i]
+            if op == OP_WRITE:
+                drives[index[i]].writeBlocks(blocks[i])
+                started[index[i]] = clock()
+            elif op == OP_SLEEP:
+                # sleeps are scheduled on absolute times so they do not drift
+                deadline = max(deadline, now) + args[i]
+                self._sleepUntil(deadline)
+            elif op == OP_WAIT_TACHO:
+                self._wait(drives[index[i]], masks[i], STATUS_TACHO, args[i], started[index[i]])
+            elif op == OP_WAIT_TIME:
+                self._wait(drives[index[i]], masks[i], STATUS_TIME, args[i], started[index[i]])
+        return array('d', timeline)
+
+## Compares two timelines of the same program
+#  @param a The first timeline.
+#  @param b The second timeline.
+#  @return (mean, max, rms) absolute difference in seconds.
+def CompareTimelines(a, b):
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0.0, 0.0, 0.0
+    total = 0.0
+    worst = 0.0
+    squares = 0.0
+    for i in range(n):
+        d = abs(a[i] - b[i])
+        total += d
+        squares += d * d
+        if d > worst:
+            worst = d
+    return total / n, worst, math.sqrt(squares / n)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveRealtime
+# Host-side control loops at a few hundred Hz.
+#
+#   drive = SmartDrive_DriveChannel(sd)
+#   runner = SmartDrive_LoopRunner(0.004, gc_mode = 'freeze', cpus = [3])
+#
+#   def step(tick, now):
+#       p1, p2 = drive.ReadPositions()
+#       drive.SetSpeeds(control_m1(p1), control_m2(p2))
+#
+#   runner.Run(step, duration = 10.0)
+#   print(runner.stats.Report())
+#
+# The channels encode their command frames once; a speed update patches
+# one byte in place and sends the same buffer, with no per-tick lists,
+# frames or branches over motor constants.
+
+from array import array
+import gc
+import math
+import os
+import time
+
+from SmartDriveRegisters import clock, INT32, POSITIONS
+
+def _speedByte(speed):
+    speed = int(speed)
+    if speed > 100:
+        speed = 100
+    elif speed < -100:
+        speed = -100
+    return speed & 0xFF
+
+## SmartDrive_MotorChannel: pre-bound unlimited-run command of one motor.
+#  Sends the speed, time, command B and command A registers of the motor
+#  (4 bytes), the same frame SmartDrive_Run_Unlimited writes.
+class SmartDrive_MotorChannel(object):
+
+    ## Binds the channel
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive.
+    #  @param motor_number SmartDrive_Motor_1 or SmartDrive_Motor_2.
+    #  @exception ValueError motor_number is not SmartDrive_Motor_1 or SmartDrive_Motor_2.
+    def __init__(self, sd, motor_number):
+        if motor_number not in (sd.SmartDrive_Motor_1, sd.SmartDrive_Motor_2):
+            raise ValueError("motor_number must be SmartDrive_Motor_1 or SmartDrive_Motor_2, not %r" % (motor_number,))
+        self.sd = sd
+        self.motor_number = motor_number
+        reg = sd.SmartDrive_SPEED_M1 if motor_number == sd.SmartDrive_Motor_1 else sd.SmartDrive_SPEED_M2
+        self.buf = bytearray(4)
+        self.buf[3] = sd.SmartDrive_CONTROL_SPEED | sd.SmartDrive_CONTROL_BRK | sd.SmartDrive_CONTROL_GO
+        self.blocks = [(reg, self.buf)]
+        self._position = sd.SmartDrive_POSITION_M1 if motor_number == sd.SmartDrive_Motor_1 else sd.SmartDrive_POSITION_M2
+        self._read = bytearray(4)
+
+    ## Runs the motor at a signed speed, -100 - 100
+    def SetSpeed(self, speed):
+        self.buf[0] = _speedByte(speed)
+        self.sd.writeBlocks(self.blocks)
+
+    ## Reads the tacho position of the motor
+    def ReadPosition(self):
+        self.sd.readBlockInto(self._position, self._read, 0, 4)
+        return INT32.unpack_from(self._read)[0]
+
+## SmartDrive_DriveChannel: pre-bound unlimited-run command of both motors.
+#  One 12 byte write of 0x46 - 0x51 sets both speeds, each motor started by
+#  the GO bit of its own command A register, so an update is a single
+#  transaction on any transport. The motor 2 setpoint registers in between
+#  are rewritten with 0; unlimited runs do not use them.
+class SmartDrive_DriveChannel(object):
+
+    ## Binds the channel
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive.
+    def __init__(self, sd):
+        self.sd = sd
+        ctrl = sd.SmartDrive_CONTROL_SPEED | sd.SmartDrive_CONTROL_BRK | sd.SmartDrive_CONTROL_GO
+        self.buf = bytearray(sd.SmartDrive_CMD_A_M2 - sd.SmartDrive_SPEED_M1 + 1)
+        self._m1 = 0
+        self._m2 = sd.SmartDrive_SPEED_M2 - sd.SmartDrive_SPEED_M1
+        self.buf[sd.SmartDrive_CMD_A_M1 - sd.SmartDrive_SPEED_M1] = ctrl
+        self.buf[sd.SmartDrive_CMD_A_M2 - sd.SmartDrive_SPEED_M1] = ctrl
+        self.blocks = [(sd.SmartDrive_SPEED_M1, self.buf)]
+        self._read = bytearray(POSITIONS.size)
+
+    ## Runs both motors at signed speeds, -100 - 100
+    def SetSpeeds(self, speed_m1, speed_m2):
+        buf = self.buf
+        buf[self._m1] = _speedByte(speed_m1)
+        buf[self._m2] = _speedByte(speed_m2)
+        self.sd.writeBlocks(self.blocks)
+
+    ## Reads both tacho positions in one transaction
+    #  @return (position_m1, position_m2)
+    def ReadPositions(self):
+        self.sd.readBlockInto(self.sd.SmartDrive_POSITION_M1, self._read, 0, POSITIONS.size)
+        return POSITIONS.unpack_from(self._read)
+
+## SmartDrive_LoopStats: timing of a fixed-period loop.
+#  The histogram of tick-to-tick periods has bins of period / bins_per_period
+#  from 0 to 2 * period, plus one overflow bin. ticks counts the steps run;
+#  periods counts the gaps between them, one fewer per run.
+class SmartDrive_LoopStats(object):
+
+    def __init__(self, period, bins_per_period = 50):
+        self.period = period
+        self.bin_width = period / bins_per_period
+        self.histogram = array('L', [0]) * (2 * bins_per_period + 1)
+        self.Clear()
+
+    ## Resets all counters
+    def Clear(self):
+        for i in range(len(self.histogram)):
+            self.histogram[i] = 0
+        self.ticks = 0
+        self.periods = 0
+        self.missed = 0
+        self.skipped = 0
+        self.late_max = 0.0
+        self.work_max = 0.0
+        self._sum = 0.0
+        self._squares = 0.0
+
+    def record(self, period, late, work):
+        self.periods += 1
+        i = int(period / self.bin_width)
+        last = len(self.histogram) - 1
+        self.histogram[i if i < last else last] += 1
+        d = period - self.period
+        self._sum += d
+        self._squares += d * d
+        if late > self.late_max:
+            self.late_max = late
+        if work > self.work_max:
+            self.work_max = work
+
+    ## Returns the period below which the fraction q of ticks fell (bin upper bound)
+    def Quantile(self, q):
+        target = q * self.periods
+        seen = 0
+        for i, n in enumerate(self.histogram):
+            seen += n
+            if seen >= target and n:
+                if i == len(self.histogram) - 1:
+                    return float('inf')
+                return (i + 1) * self.bin_width
+        return 0.0
+
+    ## Returns the stats as a dict
+    def Report(self):
+        n = self.periods
+        mean = self._sum / n if n else 0.0
+        jitter = math.sqrt(max(0.0, self._squares / n - mean * mean)) if n else 0.0
+        return {'ticks': self.ticks, 'periods': self.periods, 'missed': self.missed, 'skipped': self.skipped,
+                'period': self.period, 'period_mean': self.period + mean, 'period_jitter': jitter,
+                'p50': self.Quantile(0.5), 'p99': self.Quantile(0.99),
+                'late_max': self.late_max, 'work_max': self.work_max}
+
+## SmartDrive_LoopRunner: calls a step function at a fixed period.
+#  Tick n is due at start + n * period; the runner sleeps until spin
+#  seconds before that and busy-waits the rest, so sleep wake-up latency
+#  does not show in the period. A tick whose step runs past the next tick's
+#  start counts as a missed deadline; the latest tick already due then
+#  runs at once and older ones are skipped rather than run back to back.
+class SmartDrive_LoopRunner(object):
+
+    ## Initialize the runner
+    #  @param self The object pointer.
+    #  @param period Loop period in seconds.
+    #  @param spin Seconds before each tick to stop sleeping and busy-wait.
+    #  @param gc_mode None, 'disable' to turn the collector off while running, or 'freeze' to also move everything allocated so far out of its reach (Python 3.7+).
+    #  @param cpus CPU numbers to pin the running thread to (Linux), None to leave it alone.
+    def __init__(self, period, spin = 0.0005, gc_mode = None, cpus = None):
+        if gc_mode not in (None, 'disable', 'freeze'):
+            raise ValueError("gc_mode must be None, 'disable' or 'freeze'")
+        self.period = period
+        self.spin = spin
+        self.gc_mode = gc_mode
+        self.cpus = cpus
+        self.stats = SmartDrive_LoopStats(period)
+        self._running = False
+
+    ## Makes Run() return after the current tick
+    def Stop(self):
+        self._running = False
+
+    # saved holds [affinity to restore, collector was enabled, frozen]; each
+    # entry is filled in only once its change is made, so _leave undoes
+    # exactly what a failing _enter got done
+    def _enter(self, saved):
+        if self.cpus is not None and hasattr(os, 'sched_setaffinity'):
+            affinity = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, self.cpus)
+            saved[0] = affinity
+        if self.gc_mode is not None:
+            gc.collect()
+            saved[1] = gc.isenabled()
+            gc.disable()
+            if self.gc_mode == 'freeze' and hasattr(gc, 'freeze'):
+                gc.freeze()
+                saved[2] = True
+
+    def _leave(self, saved):
+        if saved[2]:
+            gc.unfreeze()
+        if saved[1]:
+            gc.enable()
+        if saved[0] is not None:
+            os.sched_setaffinity(0, saved[0])
+
+    ## Runs the loop
+    #  @param self The object pointer.
+    #  @param step Called as step(tick, now) every period; returning False stops the loop.
+    #  @param ticks Number of ticks to run, None for no limit.
+    #  @param duration Seconds to run, None for no limit.
+    #  @return The SmartDrive_LoopStats.
+    def Run(self, step, ticks = None, duration = None):
+        period = self.period
+        spin = self.spin
+        stats = self.stats
+        sleep = time.sleep
+        saved = [None, False, False]
+        self._running = True
+        try:
+            self._enter(saved)
+            t0 = clock()
+            end = t0 + duration if duration is not None else None
+            n = 0
+            last = None
+            while self._running:
+                due = t0 + n * period
+                if end is not None and due >= end:
+                    break
+                delay = due - clock() - spin
+                if delay > 0:
+                    sleep(delay)
+                now = clock()
+                while now < due:
+                    now = clock()
+                result = step(n, now)
+                done = clock()
+                stats.ticks += 1
+                if last is not None:
+                    stats.record(now - last, now - due, done - now)
+                last = now
+                n += 1
+                if ticks is not None and n >= ticks:
+                    break
+                if result is False:
+                    break
+                if done > t0 + n * period:
+                    # the step overran the next tick: run the latest due tick now, drop older ones
+                    stats.missed += 1
+                    behind = int((done - t0) / period)
+                    if behind > n:
+                        stats.skipped += behind - n
+                        n = behind
+        finally:
+            self._running = False
+            self._leave(saved)
+        return stats
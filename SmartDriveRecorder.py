@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveRecorder
+# Background tachometer recorder: samples both motor positions and status
+# bytes at a fixed rate into a preallocated ring buffer, optionally
+# streaming every sample to a memory-mapped binary log.
+
+from array import array
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from SmartDriveRegisters import clock, POSITIONS_STATUS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+## One sample: host time, position M1, position M2, status M1, status M2.
+RECORD = struct.Struct('<diiBB2x')
+RECORD_SIZE = RECORD.size
+
+## numpy dtype matching RECORD, when numpy is available.
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([('time', '<f8'), ('position_m1', '<i4'), ('position_m2', '<i4'),
+                                ('status_m1', 'u1'), ('status_m2', 'u1'), ('pad', 'V2')])
+else:
+    RECORD_DTYPE = None
+
+## Log file header: magic, version, record size, record count.
+LOG_HEADER = struct.Struct('<4sHHQ')
+LOG_MAGIC = b'SDTR'
+
+## SmartDrive_RecordLog: append-only memory-mapped file of RECORD samples.
+#  The file grows in steps of grow records; the header count is updated
+#  after every append, so a reader can map the file while it is written.
+class SmartDrive_RecordLog(object):
+
+    ## Opens the log file
+    #  @param self The object pointer.
+    #  @param path File to write.
+    #  @param grow Number of records to add to the file each time it fills up.
+    #  @param append True to add to the records already in the file instead of truncating it.
+    def __init__(self, path, grow = 4096, append = False):
+        self.path = path
+        self.grow = grow
+        self.count = 0
+        self.closed = False
+        flags = os.O_RDWR | os.O_CREAT
+        if not append:
+            flags |= os.O_TRUNC
+        self._fd = os.open(path, flags, 0o644)
+        self._capacity = 0
+        self._map = None
+        if append and os.fstat(self._fd).st_size >= LOG_HEADER.size:
+            magic, version, size, count = LOG_HEADER.unpack(os.read(self._fd, LOG_HEADER.size))
+            if magic != LOG_MAGIC or size != RECORD_SIZE:
+                os.close(self._fd)
+                raise ValueError("not a SmartDrive record log: %s" % path)
+            self.count = self._capacity = count
+        self._extend()
+
+    def _extend(self):
+        if self._map is not None:
+            self._map.close()
+        self._capacity += self.grow
+        size = LOG_HEADER.size + self._capacity * RECORD_SIZE
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        LOG_HEADER.pack_into(self._map, 0, LOG_MAGIC, 1, RECORD_SIZE, self.count)
+
+    ## Appends one sample
+    def Append(self, t, position_m1, position_m2, status_m1, status_m2):
+        if self.count == self._capacity:
+            self._extend()
+        RECORD.pack_into(self._map, LOG_HEADER.size + self.count * RECORD_SIZE,
+                         t, position_m1, position_m2, status_m1, status_m2)
+        self.count += 1
+        struct.pack_into('<Q', self._map, 8, self.count)
+
+    ## Flushes and closes the log, trimming unused space
+    def Close(self):
+        if self._map is None:
+            return
+        self.closed = True
+        self._map.flush()
+        self._map.close()
+        self._map = None
+        os.ftruncate(self._fd, LOG_HEADER.size + self.count * RECORD_SIZE)
+        os.close(self._fd)
+
+## Reads a log written by SmartDrive_RecordLog
+#  @param path The log file.
+#  @return A numpy record array if numpy is available, otherwise a list of RECORD tuples.
+def ReadRecordLog(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, size, count = LOG_HEADER.unpack_from(data, 0)
+    if magic != LOG_MAGIC or size != RECORD_SIZE:
+        raise ValueError("not a SmartDrive record log: %s" % path)
+    if numpy is not None:
+        return numpy.frombuffer(data, RECORD_DTYPE, count, LOG_HEADER.size)
+    return [RECORD.unpack_from(data, LOG_HEADER.size + i * RECORD_SIZE) for i in range(count)]
+
+## SmartDrive_Recorder: fixed-rate tachometer sampling on its own thread.
+#  Each sample is one block read of 0x52 - 0x5B. Samples are scheduled on
+#  absolute times (start + n * period), so a late sample does not push the
+#  later ones back; the lateness of each sample is kept as jitter stats.
+#  A failed read is counted in errors and its slot left out.
+class SmartDrive_Recorder(object):
+
+    ## Initialize the recorder
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive to sample.
+    #  @param rate Target samples per second.
+    #  @param capacity Number of samples kept in the ring buffer.
+    #  @param log_path Optional file to stream every sample to, see SmartDrive_RecordLog.
+    def __init__(self, sd, rate = 200.0, capacity = 4096, log_path = None):
+        self.sd = sd
+        self.period = 1.0 / rate
+        self.capacity = capacity
+        self.ring = bytearray(capacity * RECORD_SIZE)
+        self.count = 0
+        self.log = SmartDrive_RecordLog(log_path) if log_path else None
+        self.errors = 0
+        self.last_error = None
+        self._block = bytearray(POSITIONS_STATUS.size)
+        # held while a sample is stored and while samples are copied out
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self._jitter_n = 0
+        self._jitter_mean = 0.0
+        self._jitter_m2 = 0.0
+        self._jitter_max = 0.0
+
+    ## Starts sampling
+    #  After a Stop the log file is reopened and appended to.
+    #  @param self The object pointer.
+    def Start(self):
+        if self._running:
+            return
+        if self.log is not None and self.log.closed:
+            self.log = SmartDrive_RecordLog(self.log.path, self.log.grow, append = True)
+        self._running = True
+        self._thread = threading.Thread(target = self._run, name = 'SmartDriveRecorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    ## Stops sampling and closes the log file
+    #  @param self The object pointer.
+    def Stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.log is not None:
+            self.log.Close()
+
+    def _run(self):
+        sd = self.sd
+        block = self._block
+        ring = self.ring
+        period = self.period
+        t_start = clock()
+        n = 0
+        while self._running:
+            scheduled = t_start + n * period
+            delay = scheduled - clock()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                sd.readBlockInto(sd.SmartDrive_POSITION_M1, block, 0, POSITIONS_STATUS.size)
+            except (IOError, OSError) as e:
+                self.errors += 1
+                self.last_error = e
+            else:
+                now = clock()
+                p1, p2, s1, s2 = POSITIONS_STATUS.unpack_from(block)
+                with self._lock:
+                    offset = (self.count % self.capacity) * RECORD_SIZE
+                    RECORD.pack_into(ring, offset, now, p1, p2, s1, s2)
+                    self.count += 1
+                if self.log is not None:
+                    self.log.Append(now, p1, p2, s1, s2)
+                self._jitter(now - scheduled)
+            n += 1
+            # skip slots already missed instead of bursting to catch up
+            behind = int((clock() - t_start) / period)
+            if behind > n:
+                n = behind
+
+    def _jitter(self, late):
+        self._jitter_n += 1
+        d = late - self._jitter_mean
+        self._jitter_mean += d / self._jitter_n
+        self._jitter_m2 += d * (late - self._jitter_mean)
+        if late > self._jitter_max:
+            self._jitter_max = late
+
+    ## Returns timing stats: samples, mean/max/stddev lateness in seconds, achieved rate
+    #  @param self The object pointer.
+    def JitterStats(self):
+        n = self._jitter_n
+        stddev = math.sqrt(self._jitter_m2 / n) if n else 0.0
+        rate = 0.0
+        with self._lock:
+            length = self.Length()
+            if length > 1:
+                first = RECORD.unpack_from(self.ring, self._offset(0))[0]
+                last = RECORD.unpack_from(self.ring, self._offset(length - 1))[0]
+                if last > first:
+                    rate = (length - 1) / (last - first)
+        return {'samples': n, 'mean': self._jitter_mean, 'max': self._jitter_max,
+                'stddev': stddev, 'rate': rate}
+
+    ## Number of samples currently held in the ring buffer
+    def Length(self):
+        return min(self.count, self.capacity)
+
+    def _offset(self, index, count = None):
+        # index 0 is the oldest sample still in the ring
+        if count is None:
+            count = self.count
+        first = count - min(count, self.capacity)
+        return ((first + index) % self.capacity) * RECORD_SIZE
+
+    ## Returns sample index (0 = oldest held) as a RECORD tuple
+    def Sample(self, index):
+        with self._lock:
+            return RECORD.unpack_from(self.ring, self._offset(index))
+
+    ## Returns the newest sample as a RECORD tuple, or None
+    def Latest(self):
+        with self._lock:
+            if self.count == 0:
+                return None
+            return RECORD.unpack_from(self.ring, self._offset(self.Length() - 1))
+
+    ## Returns zero-copy memoryviews on the held samples, oldest first.
+    #  The ring wraps, so the samples come as up to two views. While the
+    #  recorder runs it keeps overwriting them; Stop it first, or use Trace.
+    def Views(self):
+        view = memoryview(self.ring)
+        length = self.Length()
+        start = self._offset(0)
+        end = start + length * RECORD_SIZE
+        if end <= len(self.ring):
+            return [view[start:end]]
+        return [view[start:], view[:end - len(self.ring)]]
+
+    ## Returns the held samples as numpy record arrays (views, no copy), oldest first
+    def NumpyViews(self):
+        if numpy is None:
+            raise RuntimeError("numpy is not installed")
+        return [numpy.frombuffer(v, RECORD_DTYPE) for v in self.Views()]
+
+    ## Returns (times, positions) of one motor over the held samples
+    #  @param self The object pointer.
+    #  @param motor_number 1 or 2.
+    def Trace(self, motor_number):
+        with self._lock:
+            ring = bytes(self.ring)
+            count = self.count
+        length = min(count, self.capacity)
+        times = array('d', [0.0]) * length
+        positions = array('d', [0.0]) * length
+        field = 1 if motor_number == 1 else 2
+        for i in range(length):
+            record = RECORD.unpack_from(ring, self._offset(i, count))
+            times[i] = record[0]
+            positions[i] = record[field]
+        return times, positions
+
+    ## Returns (times, velocities) of one motor, in counts per second
+    #  @param self The object pointer.
+    #  @param motor_number 1 or 2.
+    def Velocity(self, motor_number):
+        times, positions = self.Trace(motor_number)
+        return _derive(times, positions)
+
+    ## Returns (times, accelerations) of one motor, in counts per second squared
+    #  @param self The object pointer.
+    #  @param motor_number 1 or 2.
+    def Acceleration(self, motor_number):
+        times, velocity = self.Velocity(motor_number)
+        return _derive(times, velocity)
+
+# Backward differences: value i is the slope between samples i - 1 and i.
+def _derive(times, values):
+    length = len(values) - 1
+    if length < 1:
+        return array('d'), array('d')
+    out_t = array('d', [0.0]) * length
+    out_v = array('d', [0.0]) * length
+    for i in range(length):
+        dt = times[i + 1] - times[i]
+        out_t[i] = times[i + 1]
+        out_v[i] = (values[i + 1] - values[i]) / dt if dt > 0 else 0.0
+    return out_t, out_v
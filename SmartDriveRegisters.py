@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveRegisters
+# Register layouts and the host clock shared by the SmartDrive modules.
+# It imports no other SmartDrive module, so the modules SmartDrive itself
+# imports can use it too.
+
+import struct
+import time
+
+## Host clock for intervals and deadlines, monotonic where available.
+clock = getattr(time, 'monotonic', time.time)
+
+## One motor's command frame: setpoint, speed, time, command B, command A.
+FRAME = struct.Struct('<ibBBB')
+
+## Positions M1/M2, 0x52 - 0x59.
+POSITIONS = struct.Struct('<ii')
+
+## Positions M1/M2 followed by status M1/M2, 0x52 - 0x5B.
+POSITIONS_STATUS = struct.Struct('<iiBB')
+
+## PID gains, pass count and tolerance, 0x5E - 0x6B.
+PID = struct.Struct('<6HBB')
+
+## Battery voltage, reset status, current M1, current M2, 0x6E - 0x73.
+POWER = struct.Struct('<BBHH')
+
+UINT16 = struct.Struct('<H')
+INT32 = struct.Struct('<i')
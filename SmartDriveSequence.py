@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveSequence
+# Pipelined execution of a list or stream of tacho moves. Segments are
+# encoded ahead of time into ready-to-send register blocks and the next one
+# is written as soon as the previous one is seen complete.
+
+from collections import deque, namedtuple
+import time
+
+from SmartDrive import SmartDrive
+from SmartDriveErrors import SmartDrive_TimeoutError
+from SmartDriveRegisters import clock, POSITIONS_STATUS
+from SmartDriveWait import STATUS_TACHO
+
+## SmartDrive_Move: one segment of a motion sequence.
+#  motor_number SmartDrive_Motor_1, _2 or _Both.
+#  speed        speed, 0 - 100 (the direction follows from the target).
+#  target       absolute tacho target, or (m1, m2) for Motor_Both; or None.
+#  delta        tacho distance from the previous segment's target, or (m1, m2); used when target is None.
+#  next_action  how the motor(s) hold at the end of the segment.
+SmartDrive_Move = namedtuple('SmartDrive_Move', 'motor_number speed target delta next_action')
+SmartDrive_Move.__new__.__defaults__ = (None, None, SmartDrive.SmartDrive_Next_Action_Brake)
+
+## SmartDrive_SequenceReport: timing of one sequence run.
+#  segments  number of segments executed.
+#  elapsed   seconds from the first write to the last completion.
+#  polls     status reads made.
+#  gap_mean  mean seconds from a segment's completion being seen to the next write.
+#  gap_max   worst such gap.
+#  idle_max  worst upper bound on motor idle time between segments (last busy poll to next write).
+SmartDrive_SequenceReport = namedtuple('SmartDrive_SequenceReport',
+                                       'segments elapsed polls gap_mean gap_max idle_max')
+
+## SmartDrive_MotionSequence: runs moves back to back on one SmartDrive.
+#  Relative moves are turned into absolute targets chained from the previous
+#  target (not from where the motor happened to stop), so errors do not add
+#  up along the path. A segment that runs past the wait engine's deadline
+#  for its estimate raises SmartDrive_TimeoutError.
+class SmartDrive_MotionSequence(object):
+
+    ## Initialize the executor
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive to drive.
+    #  @param lookahead Number of segments encoded ahead of the running one.
+    #  @param tolerance Count a segment done once every motor is within this many counts of its target, None to wait for the status bit only.
+    #  @param min_interval Shortest gap between two status reads, in seconds.
+    #  @param max_interval Longest gap between two status reads, in seconds.
+    def __init__(self, sd, lookahead = 4, tolerance = 0, min_interval = 0.001, max_interval = 0.020):
+        self.sd = sd
+        self.lookahead = lookahead
+        self.tolerance = tolerance
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.last_report = None
+
+    ## Encodes one move into (motor_number, targets, speed, blocks)
+    #  @param self The object pointer.
+    #  @param move A SmartDrive_Move.
+    #  @param targets The (m1, m2) absolute targets the previous segment ended at.
+    def Encode(self, move, targets):
+        sd = self.sd
+        t1, t2 = targets
+        if move.target is not None:
+            target = move.target if isinstance(move.target, tuple) else (move.target, move.target)
+            if move.motor_number & 0x01:
+                t1 = target[0]
+            if move.motor_number & 0x02:
+                t2 = target[1]
+        else:
+            delta = move.delta if isinstance(move.delta, tuple) else (move.delta, move.delta)
+            if move.motor_number & 0x01:
+                t1 += delta[0]
+            if move.motor_number & 0x02:
+                t2 += delta[1]
+        ctrl = sd.encodeControl(move.motor_number, move.next_action, sd.SmartDrive_CONTROL_TACHO)
+        speed = abs(int(move.speed))
+        if move.motor_number == sd.SmartDrive_Motor_Both:
+            setpoint = (t1, t2)
+        elif move.motor_number == sd.SmartDrive_Motor_1:
+            setpoint = t1
+        else:
+            setpoint = t2
+        blocks = sd.encodeMotorBlocks(move.motor_number, setpoint, speed, 0, ctrl)
+        return move.motor_number, (t1, t2), speed, blocks
+
+    def _done(self, motor_number, targets, block, elapsed):
+        p1, p2, s1, s2 = POSITIONS_STATUS.unpack_from(block)
+        if self.tolerance is not None:
+            near = True
+            if motor_number & 0x01 and abs(targets[0] - p1) > self.tolerance:
+                near = False
+            if motor_number & 0x02 and abs(targets[1] - p2) > self.tolerance:
+                near = False
+            if near:
+                return True, p1, p2
+        if elapsed < self.sd.wait_engine.status_delay:
+            return False, p1, p2
+        return not self.sd.wait_engine.Busy(motor_number, s1, s2, STATUS_TACHO), p1, p2
+
+    ## Runs the moves, returning once the last one is complete
+    #  @param self The object pointer.
+    #  @param moves A list or any iterable (e.g. a generator) of SmartDrive_Move.
+    #  @return A SmartDrive_SequenceReport.
+    #  @exception SmartDrive_TimeoutError A segment did not complete in time.
+    def Run(self, moves):
+        sd = self.sd
+        block = bytearray(POSITIONS_STATUS.size)
+        sd.readBlockInto(sd.SmartDrive_POSITION_M1, block, 0, POSITIONS_STATUS.size)
+        p1, p2, s1, s2 = POSITIONS_STATUS.unpack_from(block)
+        polls = 1
+        moves = iter(moves)
+        queue = deque()
+        targets = (p1, p2)
+
+        def refill(targets):
+            while len(queue) < self.lookahead:
+                try:
+                    move = next(moves)
+                except StopIteration:
+                    break
+                segment = self.Encode(move, targets)
+                targets = segment[1]
+                queue.append(segment)
+            return targets
+
+        targets = refill(targets)
+        segments = 0
+        gaps = []
+        idle_max = 0.0
+        t_first = None
+        t_last_done = None
+        t_busy = None
+        positions = (p1, p2)
+        engine = sd.wait_engine
+        while queue:
+            motor_number, segment_targets, speed, blocks = queue.popleft()
+            sd.writeBlocks(blocks)
+            t_start = clock()
+            if t_first is None:
+                t_first = t_start
+            else:
+                gaps.append(t_start - t_last_done)
+                if t_start - t_busy > idle_max:
+                    idle_max = t_start - t_busy
+            segments += 1
+            # encode the following segments while this one runs
+            targets = refill(targets)
+            rate = engine.TachoRate(speed)
+            timeout = None
+            while True:
+                remaining = 0
+                if motor_number & 0x01:
+                    remaining = abs(segment_targets[0] - positions[0])
+                if motor_number & 0x02:
+                    remaining = max(remaining, abs(segment_targets[1] - positions[1]))
+                if timeout is None:
+                    timeout = engine.Timeout(remaining / rate)
+                delay = min(max(0.5 * remaining / rate, self.min_interval), self.max_interval)
+                time.sleep(delay)
+                sd.readBlockInto(sd.SmartDrive_POSITION_M1, block, 0, POSITIONS_STATUS.size)
+                polls += 1
+                now = clock()
+                done, p1, p2 = self._done(motor_number, segment_targets, block, now - t_start)
+                positions = (p1, p2)
+                if done:
+                    t_last_done = now
+                    break
+                if now - t_start > timeout:
+                    raise SmartDrive_TimeoutError("segment %d not done after %g seconds" % (segments, timeout),
+                                                  motor_number, timeout)
+                t_busy = now
+            if t_busy is None or t_busy < t_start:
+                t_busy = t_start
+        elapsed = (t_last_done - t_first) if t_first is not None else 0.0
+        gap_mean = sum(gaps) / len(gaps) if gaps else 0.0
+        report = SmartDrive_SequenceReport(segments, elapsed, polls, gap_mean,
+                                           max(gaps) if gaps else 0.0, idle_max)
+        self.last_report = report
+        return report
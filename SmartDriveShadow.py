@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveShadow
+# Write-through shadow of the SmartDrive register file.
+#
+#   EnableShadow(sd)
+#
+# Writes are compared with the shadow and only changed byte ranges go to
+# the bus. Reads of registers only the host writes (PID gains, pass count
+# and tolerance) are served from the shadow once known. The reset status
+# register is watched so a controller reset drops the shadow and pushes
+# the host-owned registers back.
+
+from SmartDrive import SmartDrive
+
+def _span(first, last):
+    return range(first, last + 1)
+
+## Registers the host owns: the controller never changes them on its own,
+#  so unchanged writes can be skipped. The time and command registers are
+#  not in here; they are always written, because writing them acts.
+HOST_OWNED = frozenset(
+    list(_span(SmartDrive.SmartDrive_SETPT_M1, SmartDrive.SmartDrive_SPEED_M1)) +
+    [SmartDrive.SmartDrive_CMD_B_M1] +
+    list(_span(SmartDrive.SmartDrive_SETPT_M2, SmartDrive.SmartDrive_SPEED_M2)) +
+    [SmartDrive.SmartDrive_CMD_B_M2] +
+    list(_span(SmartDrive.SmartDrive_P_Kp, SmartDrive.SmartDrive_PASSTOLERANCE)))
+
+## Host-owned registers that may be answered from the shadow on read.
+READ_CACHED = frozenset(_span(SmartDrive.SmartDrive_P_Kp, SmartDrive.SmartDrive_PASSTOLERANCE))
+
+## Host-owned registers written back after a controller reset.
+RESTORED = (SmartDrive.SmartDrive_P_Kp, SmartDrive.SmartDrive_PASSTOLERANCE)
+
+class _Shadow(object):
+
+    __slots__ = ('values', 'valid')
+
+    def __init__(self):
+        self.values = bytearray(256)
+        self.valid = bytearray(256)
+
+## SmartDrive_ShadowTransport: transport wrapper keeping the shadow.
+class SmartDrive_ShadowTransport(object):
+
+    ## Initialize the shadow
+    #  @param self The object pointer.
+    #  @param inner The transport that reaches the bus.
+    #  @param merge_gap Longest run of unchanged bytes between two changed
+    #         ranges that is rewritten anyway to keep them in one transaction;
+    #         None never splits a block, so no write costs more transactions
+    #         than the caller asked for.
+    #  @param restore Write the host-owned PID registers back after a reset.
+    def __init__(self, inner, merge_gap = None, restore = True):
+        self.inner = inner
+        self.merge_gap = merge_gap
+        self.restore = restore
+        self.shadows = {}
+        self.saved_writes = 0
+        self.extra_writes = 0
+        self.saved_bytes = 0
+        self.saved_reads = 0
+        self.resets = 0
+
+    def _shadow(self, address):
+        shadow = self.shadows.get(address)
+        if shadow is None:
+            shadow = self.shadows[address] = _Shadow()
+        return shadow
+
+    ## Forgets the shadow of one controller, or of all of them
+    #  @param self The object pointer.
+    #  @param address 7 bit address, None for all.
+    def Invalidate(self, address = None):
+        if address is None:
+            self.shadows.clear()
+        else:
+            self.shadows.pop(address, None)
+
+    ## Returns the counters as a dict
+    #  saved_writes counts blocks skipped whole, extra_writes the
+    #  transactions added by splitting a block at a long unchanged run.
+    def Counters(self):
+        return {'saved_writes': self.saved_writes, 'extra_writes': self.extra_writes,
+                'saved_bytes': self.saved_bytes,
+                'saved_reads': self.saved_reads, 'resets': self.resets}
+
+    def readInto(self, address, reg, buf, offset, length):
+        shadow = self._shadow(address)
+        end = reg + length
+        cached = True
+        for r in range(reg, end):
+            if r not in READ_CACHED or not shadow.valid[r]:
+                cached = False
+                break
+        if cached:
+            buf[offset:offset + length] = shadow.values[reg:end]
+            self.saved_reads += 1
+            return
+        self.inner.readInto(address, reg, buf, offset, length)
+        if reg <= SmartDrive.SmartDrive_RESETSTATUS < end and buf[offset + SmartDrive.SmartDrive_RESETSTATUS - reg]:
+            # the values just read are the post-reset defaults; restore from
+            # the shadow as it was before and start a fresh one
+            self._resync(address, self.shadows.pop(address, None))
+            return
+        for i in range(length):
+            if reg + i in READ_CACHED:
+                shadow.values[reg + i] = buf[offset + i]
+                shadow.valid[reg + i] = 1
+
+    def _resync(self, address, old):
+        # the controller came out of reset: acknowledge and put back the
+        # host-owned registers it lost
+        self.resets += 1
+        blocks = [(SmartDrive.SmartDrive_RESETSTATUS, bytearray(1))]
+        first, last = RESTORED
+        if self.restore and old is not None and all(old.valid[first:last + 1]):
+            blocks.append((first, old.values[first:last + 1]))
+        self.writeBlocks(address, blocks)
+
+    ## Reads the reset status register and resyncs if the controller was reset
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive to check.
+    #  @return True if a reset was detected.
+    def CheckReset(self, sd):
+        resets = self.resets
+        sd.readByte(sd.SmartDrive_RESETSTATUS)
+        return self.resets != resets
+
+    def writeBlocks(self, address, blocks):
+        shadow = self._shadow(address)
+        values = shadow.values
+        valid = shadow.valid
+        out = []
+        for reg, data in blocks:
+            length = len(data)
+            # find the byte ranges that must go out
+            ranges = []
+            for i in range(length):
+                r = reg + i
+                if r in HOST_OWNED and valid[r] and values[r] == data[i]:
+                    continue
+                if ranges and (self.merge_gap is None or i - ranges[-1][1] <= self.merge_gap):
+                    ranges[-1][1] = i + 1
+                else:
+                    ranges.append([i, i + 1])
+            sent = 0
+            for start, stop in ranges:
+                out.append((reg + start, data[start:stop]))
+                sent += stop - start
+            self.saved_bytes += length - sent
+            if ranges:
+                self.extra_writes += len(ranges) - 1
+            else:
+                self.saved_writes += 1
+        if out:
+            try:
+                self.inner.writeBlocks(address, out)
+            except Exception:
+                # the device may hold the old values, the new ones or a mix
+                for reg, data in blocks:
+                    for r in range(reg, reg + len(data)):
+                        valid[r] = 0
+                raise
+        # record the values only once they are on the device
+        for reg, data in blocks:
+            for i in range(len(data)):
+                r = reg + i
+                if r in HOST_OWNED:
+                    values[r] = data[i]
+                    valid[r] = 1
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+## Puts a shadow under a SmartDrive
+#  @param sd The SmartDrive.
+#  @param kwargs Options for SmartDrive_ShadowTransport.
+#  @return The SmartDrive_ShadowTransport.
+def EnableShadow(sd, **kwargs):
+    if not isinstance(sd.transport, SmartDrive_ShadowTransport):
+        sd.transport = SmartDrive_ShadowTransport(sd.transport, **kwargs)
+    return sd.transport
+
+## Removes the shadow from a SmartDrive
+#  @param sd The SmartDrive.
+def DisableShadow(sd):
+    if isinstance(sd.transport, SmartDrive_ShadowTransport):
+        sd.transport = sd.transport.inner
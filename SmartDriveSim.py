@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveSim
+# A simulated SmartDrive and an i2c transport to reach it, for running
+# the driver without hardware:
+#
+#   bus = SmartDrive_SimTransport(latency = 0.0002)
+#   sim = bus.Attach(0x36)
+#   sd = SmartDrive(0x36, transport = bus)
+
+import struct
+import threading
+import time
+
+from SmartDrive import SmartDrive
+from SmartDriveRegisters import clock, FRAME, INT32
+
+# Status byte bits reported by the simulated motors.
+STATUS_SPEED = 0x01
+STATUS_POWERED = 0x04
+STATUS_TACHO = 0x08
+STATUS_BRAKE = 0x10
+STATUS_TIME = 0x40
+
+class _SimMotor(object):
+
+    __slots__ = ('position', 'velocity', 'mode', 'target', 'end', 'brake',
+                 'started', 'last', 'status')
+
+    def __init__(self, now):
+        self.position = 0.0
+        self.velocity = 0.0
+        self.mode = None
+        self.target = 0
+        self.end = 0.0
+        self.brake = False
+        self.started = now
+        self.last = now
+        self.status = 0
+
+## SmartDrive_Sim: register-level model of one SmartDrive.
+#  Holds the register file 0x00 - 0xFF, reacts to the command register and
+#  to GO bits in the motor command registers, and moves the tachometer
+#  positions at speed * full_speed_rate / 100 counts per second. Timed and
+#  tacho moves end on their own; completion times are kept in completed.
+class SmartDrive_Sim(object):
+
+    ## Initialize the simulated controller
+    #  @param self The object pointer.
+    #  @param full_speed_rate Tacheometer counts per second at speed 100.
+    #  @param battery_mv Battery voltage reported, in millivolts.
+    #  @param status_delay Seconds after a start before the status bits show the move.
+    def __init__(self, full_speed_rate = 1000.0, battery_mv = 9000, status_delay = 0.0):
+        self.full_speed_rate = full_speed_rate
+        self.status_delay = status_delay
+        self.registers = bytearray(256)
+        self.registers[SmartDrive.SmartDrive_BATT_VOLTAGE] = int(battery_mv / SmartDrive.SmartDrive_VOLTAGE_MULTIPLIER) & 0xFF
+        now = clock()
+        self.motors = [_SimMotor(now), _SimMotor(now)]
+        self.completed = [None, None]
+        self.lock = threading.Lock()
+
+    ## Copies length registers starting at reg into buf at offset
+    def read(self, reg, buf, offset, length):
+        with self.lock:
+            self._advance(clock())
+            self._publish()
+            buf[offset:offset + length] = self.registers[reg:reg + length]
+
+    ## Writes data to the registers starting at reg and acts on it
+    def write(self, reg, data):
+        with self.lock:
+            now = clock()
+            self._advance(now)
+            end = reg + len(data)
+            self.registers[reg:end] = data
+            if reg <= SmartDrive.SmartDrive_COMMAND < end:
+                self._command(self.registers[SmartDrive.SmartDrive_COMMAND], now)
+            for m, cmd_a in enumerate((SmartDrive.SmartDrive_CMD_A_M1, SmartDrive.SmartDrive_CMD_A_M2)):
+                if reg <= cmd_a < end and self.registers[cmd_a] & SmartDrive.SmartDrive_CONTROL_GO:
+                    self.registers[cmd_a] &= ~SmartDrive.SmartDrive_CONTROL_GO & 0xFF
+                    self._start(m, now)
+
+    def _command(self, cmd, now):
+        if cmd == SmartDrive.S:
+            self._start(0, now)
+            self._start(1, now)
+        elif cmd == SmartDrive.R:
+            for motor in self.motors:
+                motor.position = 0.0
+        elif cmd in (SmartDrive.a, SmartDrive.b, SmartDrive.c):
+            self._stopCommand(cmd - SmartDrive.a + 1, False)
+        elif cmd in (SmartDrive.A, SmartDrive.B, SmartDrive.C):
+            self._stopCommand(cmd - SmartDrive.A + 1, True)
+
+    def _stopCommand(self, motor_number, brake):
+        for m in (0, 1):
+            if motor_number & (m + 1):
+                self._stop(self.motors[m], brake)
+
+    def _start(self, m, now):
+        motor = self.motors[m]
+        setpoint, speed, duration, cmd_b, ctrl = FRAME.unpack_from(self.registers, SmartDrive.SmartDrive_SETPT_M1 + 8 * m)
+        velocity = speed * self.full_speed_rate / 100.0
+        motor.brake = bool(ctrl & SmartDrive.SmartDrive_CONTROL_BRK)
+        motor.started = now
+        motor.last = now
+        status = STATUS_SPEED | STATUS_POWERED
+        if ctrl & SmartDrive.SmartDrive_CONTROL_TACHO:
+            if ctrl & SmartDrive.SmartDrive_CONTROL_RELATIVE:
+                motor.target = int(round(motor.position)) + setpoint
+            else:
+                motor.target = setpoint
+            if motor.target < motor.position:
+                velocity = -abs(velocity)
+            else:
+                velocity = abs(velocity)
+            motor.mode = 'tacho'
+            status |= STATUS_TACHO
+        elif ctrl & SmartDrive.SmartDrive_CONTROL_TIME:
+            motor.end = now + duration
+            motor.mode = 'time'
+            status |= STATUS_TIME
+        else:
+            motor.mode = 'run'
+        motor.velocity = velocity
+        motor.status = status
+
+    def _stop(self, motor, brake):
+        motor.mode = None
+        motor.velocity = 0.0
+        motor.status = STATUS_BRAKE if brake else 0
+
+    def _advance(self, now):
+        for m, motor in enumerate(self.motors):
+            if motor.mode is None:
+                motor.last = now
+                continue
+            dt = now - motor.last
+            if motor.mode == 'tacho':
+                remaining = motor.target - motor.position
+                step = motor.velocity * dt
+                if motor.velocity == 0 or abs(step) >= abs(remaining):
+                    done = motor.last + (abs(remaining / motor.velocity) if motor.velocity else 0.0)
+                    motor.position = float(motor.target)
+                    self._finish(m, motor, done)
+                else:
+                    motor.position += step
+            elif motor.mode == 'time' and now >= motor.end:
+                motor.position += motor.velocity * max(0.0, motor.end - motor.last)
+                self._finish(m, motor, motor.end)
+            else:
+                motor.position += motor.velocity * dt
+            motor.last = now
+
+    def _finish(self, m, motor, when):
+        self._stop(motor, motor.brake)
+        self.completed[m] = when
+
+    def _publish(self):
+        regs = self.registers
+        now = clock()
+        for m, motor in enumerate(self.motors):
+            INT32.pack_into(regs, SmartDrive.SmartDrive_POSITION_M1 + 4 * m, int(round(motor.position)))
+            status = motor.status
+            if now < motor.started + self.status_delay:
+                # the firmware has not posted the new state yet
+                status = 0
+            regs[SmartDrive.SmartDrive_STATUS_M1 + m] = status
+            current = int(abs(motor.velocity) * 0.5)
+            struct.pack_into('<H', regs, SmartDrive.SmartDrive_CURRENT_M1 + 2 * m, min(current, 0xFFFF))
+
+## SmartDrive_SimTransport: a bus of simulated SmartDrives.
+#  Drop-in transport for SmartDrive (see SmartDriveTransport). Every call
+#  is one transaction, as with SmartDrive_RdwrTransport, and costs
+#  latency + bytes * byte_time seconds. Counts transactions and bytes.
+class SmartDrive_SimTransport(object):
+
+    ## Initialize the simulated bus
+    #  @param self The object pointer.
+    #  @param latency Fixed cost of one transaction, in seconds.
+    #  @param byte_time Cost of each byte on the wire, in seconds (about 90e-6 at 100 kHz).
+    def __init__(self, latency = 0.0, byte_time = 0.0):
+        self.latency = latency
+        self.byte_time = byte_time
+        self.devices = {}
+        self.transactions = 0
+        self.bytes = 0
+
+    ## Puts a simulated SmartDrive on the bus
+    #  @param self The object pointer.
+    #  @param SmartDrive_address 8 bit address, as passed to SmartDrive().
+    #  @param device The SmartDrive_Sim to attach, a new one by default.
+    #  @return The attached SmartDrive_Sim.
+    def Attach(self, SmartDrive_address = SmartDrive.SmartDrive_ADDRESS, device = None):
+        if device is None:
+            device = SmartDrive_Sim()
+        self.devices[SmartDrive_address >> 1] = device
+        return device
+
+    def _spend(self, nbytes):
+        self.transactions += 1
+        self.bytes += nbytes
+        cost = self.latency + nbytes * self.byte_time
+        if cost <= 0:
+            return
+        deadline = clock() + cost
+        if cost > 0.002:
+            time.sleep(cost - 0.001)
+        while clock() < deadline:
+            pass
+
+    def _device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            raise IOError("no device at address 0x%02x" % address)
+        return device
+
+    def readInto(self, address, reg, buf, offset, length):
+        device = self._device(address)
+        # address + register byte, then address + data
+        self._spend(length + 3)
+        device.read(reg, buf, offset, length)
+
+    def writeBlocks(self, address, blocks):
+        device = self._device(address)
+        self._spend(sum(len(data) + 2 for reg, data in blocks))
+        for reg, data in blocks:
+            device.write(reg, data)
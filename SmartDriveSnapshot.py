@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveSnapshot
+# Decoded telemetry records for the SmartDrive read register block.
+#
+# The block is 34 registers. SmartDrive_RdwrTransport reads it in one
+# transaction. SmartDrive_SMBusTransport is limited to 32 registers per
+# transaction, so it reads 0x52 - 0x71 in one and current M2 (0x72 - 0x73)
+# in a second. Everything but current_m2 is then still from a single
+# read, but a fully atomic snapshot needs the I2C_RDWR transport.
+
+from array import array
+from collections import namedtuple
+import struct
+
+from SmartDriveRegisters import INT32
+
+# Layout of the read register block, SmartDrive_POSITION_M1 (0x52) up to
+# and including the high byte of SmartDrive_CURRENT_M2 (0x73).
+#   0x52 position M1, 0x56 position M2          (signed 32 bit)
+#   0x5A status M1/M2, 0x5C tasks M1/M2         (bytes)
+#   0x5E..0x69 P Kp/Ki/Kd, S Kp/Ki/Kd           (unsigned 16 bit)
+#   0x6A pass count, 0x6B pass tolerance        (bytes)
+#   0x6C checksum, 0x6D reserved                (bytes)
+#   0x6E battery voltage, 0x6F reset status     (bytes)
+#   0x70 current M1, 0x72 current M2            (unsigned 16 bit)
+SNAPSHOT_FORMAT = struct.Struct('<ii4B6H6B2H')
+SNAPSHOT_START = 0x52
+SNAPSHOT_SIZE = SNAPSHOT_FORMAT.size
+
+_Fields = namedtuple('SmartDrive_Snapshot', [
+    'position_m1', 'position_m2',
+    'status_m1', 'status_m2', 'tasks_m1', 'tasks_m2',
+    'p_kp', 'p_ki', 'p_kd', 's_kp', 's_ki', 's_kd',
+    'passcount', 'tolerance', 'checksum', 'reserved',
+    'battery', 'reset_status',
+    'current_m1', 'current_m2',
+    'timestamp'])
+
+## SmartDrive_Snapshot: one consistent picture of the read register block.
+#  Immutable; fields are the raw register values plus the host timestamp
+#  (time.time()) at which the block read completed.
+class SmartDrive_Snapshot(_Fields):
+
+    __slots__ = ()
+
+    ## Decodes a snapshot from a raw register block
+    #  @param buf A bytes-like object holding the register block.
+    #  @param offset Offset of the block inside buf.
+    #  @param timestamp Time at which the block was read.
+    @classmethod
+    def decode(cls, buf, offset = 0, timestamp = 0.0):
+        return cls._make(SNAPSHOT_FORMAT.unpack_from(buf, offset) + (timestamp,))
+
+    ## Battery voltage in millivolts, scaled the same way as GetBattVoltage.
+    @property
+    def voltage(self):
+        # imported here, SmartDrive imports this module
+        from SmartDrive import SmartDrive
+        return self.battery * SmartDrive.SmartDrive_VOLTAGE_MULTIPLIER
+
+    ## Returns the tachometer position of the given motor (1 or 2).
+    def position(self, motor_number):
+        if motor_number == 1:
+            return self.position_m1
+        return self.position_m2
+
+    ## Returns the status byte of the given motor (1 or 2).
+    def status(self, motor_number):
+        if motor_number == 1:
+            return self.status_m1
+        return self.status_m2
+
+## SmartDrive_SnapshotArray: preallocated storage for a run of snapshots.
+#  Raw register blocks are kept back to back in one bytearray and only
+#  decoded when an element is accessed, so filling the array does not
+#  allocate per sample.
+class SmartDrive_SnapshotArray(object):
+
+    ## Allocates room for count snapshots
+    #  @param self The object pointer.
+    #  @param count Number of snapshots the array can hold.
+    def __init__(self, count):
+        self.capacity = count
+        self.count = 0
+        self.raw = bytearray(count * SNAPSHOT_SIZE)
+        self.timestamps = array('d', [0.0]) * count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("snapshot index out of range")
+        return SmartDrive_Snapshot.decode(self.raw, index * SNAPSHOT_SIZE, self.timestamps[index])
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    ## Returns a memoryview on the raw block of slot index, for filling in place.
+    def slot(self, index):
+        start = index * SNAPSHOT_SIZE
+        return memoryview(self.raw)[start:start + SNAPSHOT_SIZE]
+
+    ## Returns the positions of one motor as an array of signed longs.
+    def positions(self, motor_number):
+        offset = 0 if motor_number == 1 else 4
+        out = array('l', [0]) * self.count
+        unpack = INT32.unpack_from
+        for i in range(self.count):
+            out[i] = unpack(self.raw, i * SNAPSHOT_SIZE + offset)[0]
+        return out
+
+    ## Discards the stored snapshots, keeping the buffers.
+    def clear(self):
+        self.count = 0
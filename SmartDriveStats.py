@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveStats
+# Opt-in instrumentation for SmartDrive: call counts, errors, bytes moved
+# and latency histograms per public method and per register transaction,
+# exported as text in the Prometheus exposition format.
+#
+#   stats = SmartDrive_Stats()
+#   Instrument(sd, stats)
+#   ...
+#   stats.WriteTextfile('/var/lib/node_exporter/smartdrive.prom')
+#
+# Nothing is wrapped until Instrument() is called, so an uninstrumented
+# SmartDrive pays nothing.
+
+from array import array
+from bisect import bisect_left
+import functools
+import os
+import socket
+import threading
+
+from SmartDriveRegisters import clock
+
+## Upper bounds, in seconds, of the latency histogram buckets; the last bucket is +Inf.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005,
+                   0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 5.0)
+
+## SmartDrive_OpStats: counters and latency histogram of one operation
+class SmartDrive_OpStats(object):
+
+    __slots__ = ('calls', 'errors', 'bytes', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = array('L', [0]) * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, elapsed, nbytes, error):
+        self.calls += 1
+        self.seconds += elapsed
+        self.bytes += nbytes
+        if error:
+            self.errors += 1
+        self.buckets[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    ## Returns the latency below which the fraction q of calls completed (bucket upper bound)
+    def Quantile(self, q):
+        target = q * self.calls
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+        return 0.0
+
+## SmartDrive_Stats: operation stats of one or more SmartDrives
+class SmartDrive_Stats(object):
+
+    def __init__(self):
+        self.ops = {}
+        self.started = clock()
+        self._lock = threading.Lock()
+
+    ## Records one call
+    #  @param self The object pointer.
+    #  @param controller Address label of the SmartDrive.
+    #  @param kind 'method' or 'register'.
+    #  @param name Operation name.
+    #  @param elapsed Seconds the call took.
+    #  @param nbytes Register bytes moved.
+    #  @param error True if the call raised.
+    def Record(self, controller, kind, name, elapsed, nbytes = 0, error = False):
+        key = (controller, kind, name)
+        with self._lock:
+            op = self.ops.get(key)
+            if op is None:
+                op = self.ops[key] = SmartDrive_OpStats()
+            op.record(elapsed, nbytes, error)
+
+    ## Returns a plain dict copy of all counters, for JSON or logging
+    #  @param self The object pointer.
+    def Snapshot(self):
+        out = {'uptime': clock() - self.started, 'operations': []}
+        with self._lock:
+            for (controller, kind, name), op in sorted(self.ops.items()):
+                out['operations'].append({
+                    'controller': controller, 'kind': kind, 'name': name,
+                    'calls': op.calls, 'errors': op.errors, 'bytes': op.bytes,
+                    'seconds': op.seconds, 'buckets': list(op.buckets),
+                    'p50': op.Quantile(0.5), 'p99': op.Quantile(0.99)})
+        return out
+
+    ## Returns bus utilisation per controller: register transaction seconds / uptime
+    #  @param self The object pointer.
+    def BusUtilisation(self):
+        uptime = clock() - self.started
+        busy = {}
+        with self._lock:
+            for (controller, kind, name), op in self.ops.items():
+                if kind == 'register':
+                    busy[controller] = busy.get(controller, 0.0) + op.seconds
+        return dict((c, s / uptime if uptime > 0 else 0.0) for c, s in busy.items())
+
+    ## Returns the counters in the Prometheus text exposition format
+    #  @param self The object pointer.
+    def Exposition(self):
+        lines = []
+        with self._lock:
+            items = sorted(self.ops.items())
+            lines.append('# TYPE smartdrive_calls_total counter')
+            for (controller, kind, name), op in items:
+                lines.append('smartdrive_calls_total{%s} %d' % (_labels(controller, kind, name), op.calls))
+            lines.append('# TYPE smartdrive_errors_total counter')
+            for (controller, kind, name), op in items:
+                lines.append('smartdrive_errors_total{%s} %d' % (_labels(controller, kind, name), op.errors))
+            lines.append('# TYPE smartdrive_bytes_total counter')
+            for (controller, kind, name), op in items:
+                lines.append('smartdrive_bytes_total{%s} %d' % (_labels(controller, kind, name), op.bytes))
+            lines.append('# TYPE smartdrive_latency_seconds histogram')
+            for (controller, kind, name), op in items:
+                labels = _labels(controller, kind, name)
+                cumulative = 0
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    cumulative += op.buckets[i]
+                    lines.append('smartdrive_latency_seconds_bucket{%s,le="%g"} %d' % (labels, bound, cumulative))
+                lines.append('smartdrive_latency_seconds_bucket{%s,le="+Inf"} %d' % (labels, op.calls))
+                lines.append('smartdrive_latency_seconds_sum{%s} %.9f' % (labels, op.seconds))
+                lines.append('smartdrive_latency_seconds_count{%s} %d' % (labels, op.calls))
+        lines.append('# TYPE smartdrive_bus_utilisation gauge')
+        for controller, value in sorted(self.BusUtilisation().items()):
+            lines.append('smartdrive_bus_utilisation{controller="%s"} %.6f' % (controller, value))
+        return '\n'.join(lines) + '\n'
+
+    ## Writes the exposition text to a file, atomically (textfile collectors)
+    #  @param self The object pointer.
+    #  @param path The file to write.
+    def WriteTextfile(self, path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.Exposition())
+        os.rename(tmp, path)
+
+def _labels(controller, kind, name):
+    return 'controller="%s",kind="%s",op="%s"' % (controller, kind, name)
+
+## SmartDrive_StatsServer: serves the exposition text over HTTP on a socket
+class SmartDrive_StatsServer(object):
+
+    ## Starts listening
+    #  @param self The object pointer.
+    #  @param stats The SmartDrive_Stats to serve.
+    #  @param port TCP port, 0 picks a free one (see self.port).
+    #  @param host Interface to bind.
+    def __init__(self, stats, port = 9464, host = '127.0.0.1'):
+        self.stats = stats
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(4)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target = self._serve, name = 'SmartDriveStatsServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, peer = self._sock.accept()
+            except (OSError, socket.error):
+                return
+            try:
+                conn.recv(1024)
+                body = self.stats.Exposition().encode('ascii')
+                conn.sendall(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n' +
+                             ('Content-Length: %d\r\n\r\n' % len(body)).encode('ascii') + body)
+            except (OSError, socket.error):
+                pass
+            finally:
+                conn.close()
+
+    ## Stops listening
+    def Close(self):
+        self._sock.close()
+
+## SmartDrive_InstrumentedTransport: counts and times every register transaction
+class SmartDrive_InstrumentedTransport(object):
+
+    def __init__(self, transport, stats, controller):
+        self.inner = transport
+        self.stats = stats
+        self.controller = controller
+
+    def readInto(self, address, reg, buf, offset, length):
+        t0 = clock()
+        try:
+            self.inner.readInto(address, reg, buf, offset, length)
+        except Exception:
+            self.stats.Record(self.controller, 'register', 'read', clock() - t0, length, True)
+            raise
+        self.stats.Record(self.controller, 'register', 'read', clock() - t0, length)
+
+    def writeBlocks(self, address, blocks):
+        nbytes = 0
+        for reg, data in blocks:
+            nbytes += len(data)
+        t0 = clock()
+        try:
+            self.inner.writeBlocks(address, blocks)
+        except Exception:
+            self.stats.Record(self.controller, 'register', 'write', clock() - t0, nbytes, True)
+            raise
+        self.stats.Record(self.controller, 'register', 'write', clock() - t0, nbytes)
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+def _wrap(method, stats, controller, name):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        t0 = clock()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            stats.Record(controller, 'method', name, clock() - t0, 0, True)
+            raise
+        stats.Record(controller, 'method', name, clock() - t0)
+        return result
+    return wrapper
+
+## Names of the SmartDrive methods Instrument() wraps.
+def _publicMethods(sd):
+    names = []
+    for name in dir(type(sd)):
+        if name.startswith('_') or name[0].islower() and name != 'command':
+            continue
+        if callable(getattr(type(sd), name)):
+            names.append(name)
+    return names
+
+## Starts recording stats for a SmartDrive
+#  Wraps every public method (and command()) on the instance and puts an
+#  instrumented transport under it. Undo with Uninstrument().
+#  @param sd The SmartDrive.
+#  @param stats The SmartDrive_Stats to record into, a new one by default.
+#  @return The SmartDrive_Stats.
+def Instrument(sd, stats = None):
+    if stats is None:
+        stats = SmartDrive_Stats()
+    if isinstance(sd.transport, SmartDrive_InstrumentedTransport):
+        return sd.transport.stats
+    controller = '0x%02x' % (sd.address << 1)
+    for name in _publicMethods(sd):
+        setattr(sd, name, _wrap(getattr(sd, name), stats, controller, name))
+    sd.transport = SmartDrive_InstrumentedTransport(sd.transport, stats, controller)
+    return stats
+
+## Stops recording stats for a SmartDrive
+#  @param sd The SmartDrive.
+def Uninstrument(sd):
+    if not isinstance(sd.transport, SmartDrive_InstrumentedTransport):
+        return
+    for name in _publicMethods(sd):
+        if name in sd.__dict__:
+            del sd.__dict__[name]
+    sd.transport = sd.transport.inner
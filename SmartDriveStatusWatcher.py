@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveStatusWatcher
+# One background poll loop per SmartDrive that reads the status and tasks
+# bytes (0x5A - 0x5D) in a single transaction and fans the result out to
+# any number of waiters.
+
+import threading
+import time
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    # Python 2 without the futures backport: Future() is unavailable.
+    Future = None
+
+from SmartDriveErrors import SmartDrive_Error
+from SmartDriveRegisters import clock
+from SmartDriveWait import STATUS_TACHO
+
+class _Waiter(object):
+
+    __slots__ = ('motor_number', 'bit', 'not_before', 'event', 'callback', 'future', 'error')
+
+    def __init__(self, motor_number, bit, not_before):
+        self.motor_number = motor_number
+        self.bit = bit
+        self.not_before = not_before
+        self.event = None
+        self.callback = None
+        self.future = None
+        self.error = None
+
+## SmartDrive_StatusWatcher: shared status poll loop for one SmartDrive.
+#  The loop only reads the bus while somebody is waiting or subscribed,
+#  and never faster than once per interval, no matter how many waiters
+#  there are. A failed status read is counted and retried at the next
+#  poll; an exception raised by a callback is counted and does not stop
+#  the loop. If the loop itself dies, pending waiters fail with the
+#  exception, which is kept in error. Waiters pending at Stop(), or added
+#  while the loop is not running, fail with SmartDrive_Error.
+class SmartDrive_StatusWatcher(object):
+
+    ## Initialize the watcher
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive to watch.
+    #  @param interval Seconds between two status reads.
+    def __init__(self, sd, interval = 0.010):
+        self.sd = sd
+        self.interval = interval
+        self.status = bytearray(4)
+        self.polls = 0
+        self.errors = 0
+        self.callback_errors = 0
+        self.last_error = None
+        self.error = None
+        self._waiters = []
+        self._listeners = []
+        self._lock = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    ## Starts the poll thread
+    #  @param self The object pointer.
+    def Start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self.error = None
+            self._thread = threading.Thread(target = self._run, name = 'SmartDriveStatusWatcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    ## Stops the poll thread and waits for it to exit
+    #  Pending waiters fail with SmartDrive_Error.
+    #  @param self The object pointer.
+    def Stop(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._drain(SmartDrive_Error("status watcher stopped"))
+
+    ## Registers a callback for every change of the status or tasks bytes
+    #  @param self The object pointer.
+    #  @param callback Called as callback(status_m1, status_m2, tasks_m1, tasks_m2) on the watcher thread.
+    def Subscribe(self, callback):
+        with self._lock:
+            self._listeners.append(callback)
+            self._lock.notify_all()
+
+    ## Removes a callback registered with Subscribe
+    #  @param self The object pointer.
+    #  @param callback The callback to remove.
+    def Unsubscribe(self, callback):
+        with self._lock:
+            self._listeners.remove(callback)
+
+    def _add(self, motor_number, bit):
+        # the status byte is not valid right after a command
+        return _Waiter(motor_number, bit, clock() + self.sd.wait_engine.status_delay)
+
+    def _queue(self, waiter):
+        with self._lock:
+            running = self._running
+            if running:
+                self._waiters.append(waiter)
+                self._lock.notify_all()
+            else:
+                error = self.error or SmartDrive_Error("status watcher not running")
+        if not running:
+            # nothing would ever complete this waiter
+            self._finish(waiter, error)
+
+    ## Returns a threading.Event set once the given status bit clears
+    #  The event is also set if the poll loop dies or is stopped; check error.
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) to watch.
+    #  @param bit STATUS_TIME or STATUS_TACHO.
+    def Event(self, motor_number, bit = STATUS_TACHO):
+        waiter = self._add(motor_number, bit)
+        waiter.event = threading.Event()
+        self._queue(waiter)
+        return waiter.event
+
+    ## Calls callback(motor_number) on the watcher thread once the given status bit clears
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) to watch.
+    #  @param callback The function to call.
+    #  @param bit STATUS_TIME or STATUS_TACHO.
+    def OnDone(self, motor_number, callback, bit = STATUS_TACHO):
+        waiter = self._add(motor_number, bit)
+        waiter.callback = callback
+        self._queue(waiter)
+
+    ## Returns a concurrent.futures.Future resolved once the given status bit clears
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) to watch.
+    #  @param bit STATUS_TIME or STATUS_TACHO.
+    def GetFuture(self, motor_number, bit = STATUS_TACHO):
+        if Future is None:
+            raise RuntimeError("concurrent.futures is not available")
+        waiter = self._add(motor_number, bit)
+        waiter.future = Future()
+        self._queue(waiter)
+        return waiter.future
+
+    ## Blocks until the given status bit clears on the motor(s)
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) to wait for.
+    #  @param bit STATUS_TIME or STATUS_TACHO.
+    #  @param timeout Seconds to wait at most, None waits forever.
+    #  @return True if the motor(s) completed, False on timeout.
+    #  @exception SmartDrive_Error The watcher was stopped or not running.
+    #  @exception Exception The poll loop died with this exception.
+    def WaitFor(self, motor_number, bit = STATUS_TACHO, timeout = None):
+        waiter = self._add(motor_number, bit)
+        waiter.event = threading.Event()
+        self._queue(waiter)
+        done = waiter.event.wait(timeout)
+        if waiter.error is not None:
+            raise waiter.error
+        return done
+
+    def _run(self):
+        try:
+            self._loop()
+        except BaseException as e:
+            self._fail(e)
+            raise
+
+    def _loop(self):
+        status = self.status
+        last = bytearray(4)
+        next_poll = clock()
+        while True:
+            with self._lock:
+                while self._running and not self._waiters and not self._listeners:
+                    self._lock.wait()
+                if not self._running:
+                    return
+            delay = next_poll - clock()
+            if delay > 0:
+                time.sleep(delay)
+            next_poll = max(next_poll + self.interval, clock())
+            try:
+                self.sd.readBlockInto(self.sd.SmartDrive_STATUS_M1, status, 0, 4)
+            except (IOError, OSError) as e:
+                # retried at the next poll
+                self.errors += 1
+                self.last_error = e
+                continue
+            self.polls += 1
+            self._dispatch(status, last)
+            last[:] = status
+
+    def _dispatch(self, status, last):
+        now = clock()
+        done = []
+        with self._lock:
+            pending = []
+            for waiter in self._waiters:
+                if now < waiter.not_before or self._busy(waiter, status):
+                    pending.append(waiter)
+                else:
+                    done.append(waiter)
+            self._waiters = pending
+            listeners = list(self._listeners) if status != last else ()
+        for waiter in done:
+            try:
+                self._finish(waiter)
+            except Exception as e:
+                self._callbackError(e)
+        for callback in listeners:
+            try:
+                callback(status[0], status[1], status[2], status[3])
+            except Exception as e:
+                self._callbackError(e)
+
+    def _callbackError(self, e):
+        self.callback_errors += 1
+        self.last_error = e
+
+    def _finish(self, waiter, error = None):
+        waiter.error = error
+        if waiter.event is not None:
+            waiter.event.set()
+        if waiter.future is not None and not waiter.future.done():
+            if error is None:
+                waiter.future.set_result(waiter.motor_number)
+            else:
+                waiter.future.set_exception(error)
+        if waiter.callback is not None and error is None:
+            waiter.callback(waiter.motor_number)
+
+    def _fail(self, e):
+        with self._lock:
+            self._running = False
+            self.error = e
+        self._drain(e)
+
+    def _drain(self, e):
+        with self._lock:
+            waiters = self._waiters
+            self._waiters = []
+        for waiter in waiters:
+            try:
+                self._finish(waiter, e)
+            except Exception as e2:
+                self._callbackError(e2)
+
+    def _busy(self, waiter, status):
+        if ( waiter.motor_number & 0x01 ) and ( status[0] & waiter.bit ):
+            return True
+        if ( waiter.motor_number & 0x02 ) and ( status[1] & waiter.bit ):
+            return True
+        return False
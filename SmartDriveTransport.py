@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveTransport
+# Register transports used by SmartDrive.
+#
+# A transport moves register blocks:
+#   readInto(address, reg, buf, offset, length)  reads length registers into buf
+#   writeBlocks(address, blocks)                  writes (reg, bytearray) pairs in order
+#
+# SmartDrive_SMBusTransport goes through the OpenElectrons_i2c helpers and
+# is the default; SharedSMBusTransport gives every SmartDrive on a bus the
+# same one, with one bus handle and one bus_lock. SmartDrive_RdwrTransport talks to /dev/i2c-N with the
+# I2C_RDWR ioctl, so a register read (address write + data read, joined by
+# a repeated start) or a whole list of block writes is one kernel call.
+
+import ctypes
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from OpenElectrons_i2c import OpenElectrons_i2c
+
+# from linux/i2c-dev.h and linux/i2c.h
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
+class _i2c_msg(ctypes.Structure):
+    _fields_ = [('addr', ctypes.c_uint16),
+                ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16),
+                ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+class _i2c_rdwr_ioctl_data(ctypes.Structure):
+    _fields_ = [('msgs', ctypes.POINTER(_i2c_msg)),
+                ('nmsgs', ctypes.c_uint32)]
+
+## SmartDrive_SMBusTransport: the OpenElectrons_i2c helpers of the devices on one bus handle.
+#  Block reads are limited to BLOCK_MAX registers per transaction, longer
+#  reads are split, so they are not atomic; use SmartDrive_RdwrTransport
+#  where a long read must be one transaction.
+class SmartDrive_SMBusTransport(object):
+
+    BLOCK_MAX = 32
+
+    ## Initialize the transport
+    #  @param self The object pointer.
+    #  @param device The OpenElectrons_i2c instance whose bus handle and helpers to use.
+    def __init__(self, device):
+        self.device = device
+        self.bus = device.bus
+        self.devices = {device.address: device}
+        # shared by the SmartDrives on this transport, see SmartDrive.bus_lock
+        self.bus_lock = threading.RLock()
+
+    ## Routes the transactions of another device through this transport's bus handle
+    #  @param self The object pointer.
+    #  @param device The OpenElectrons_i2c instance.
+    def Attach(self, device):
+        device.bus = self.bus
+        self.devices[device.address] = device
+
+    ## Closes the bus handle, unless it is the one shared by every SmartDrive on the bus
+    #  @param self The object pointer.
+    def close(self):
+        with _smbus_lock:
+            if self in _smbus.values():
+                return
+        close = getattr(self.bus, 'close', None)
+        if close is not None:
+            close()
+
+    def _device(self, address):
+        device = self.devices.get(address)
+        if device is None:
+            raise ValueError("no device at address 0x%02x on this transport" % (address << 1))
+        return device
+
+    def readInto(self, address, reg, buf, offset, length):
+        device = self._device(address)
+        if length == 1:
+            buf[offset] = OpenElectrons_i2c.readByte(device, reg)
+            return
+        while length > 0:
+            n = min(length, self.BLOCK_MAX)
+            buf[offset:offset + n] = bytearray(OpenElectrons_i2c.readArray(device, reg, n))
+            reg += n
+            offset += n
+            length -= n
+
+    def writeBlocks(self, address, blocks):
+        device = self._device(address)
+        for reg, data in blocks:
+            if len(data) == 1:
+                OpenElectrons_i2c.writeByte(device, reg, data[0])
+            else:
+                OpenElectrons_i2c.writeArray(device, reg, list(data))
+
+# SMBus transport per bus number, see SharedSMBusTransport
+_smbus = {}
+_smbus_lock = threading.Lock()
+
+## Returns the SMBus transport of the bus OpenElectrons_i2c picks, shared by every device on it
+#  The first device opens the bus handle; later ones use the same handle
+#  instead of opening their own.
+#  @param device An OpenElectrons_i2c instance with its address set.
+def SharedSMBusTransport(device):
+    number = OpenElectrons_i2c.which_bus()
+    with _smbus_lock:
+        transport = _smbus.get(number)
+        if transport is None:
+            OpenElectrons_i2c.__init__(device, device.address)
+            transport = _smbus[number] = SmartDrive_SMBusTransport(device)
+        else:
+            transport.Attach(device)
+    return transport
+
+## Returns the transport that reaches the bus under any wrappers (retries, shadow, counters)
+#  @param transport A transport, possibly wrapped.
+def BusTransport(transport):
+    while hasattr(transport, 'inner'):
+        transport = transport.inner
+    return transport
+
+## SmartDrive_RdwrTransport: combined transactions through the I2C_RDWR ioctl.
+#  Message descriptors and data buffers are allocated once; one transport
+#  can be shared by every SmartDrive on the bus (callers serialize access
+#  with its bus_lock, which SmartDrive picks up as its own).
+class SmartDrive_RdwrTransport(object):
+
+    ## Largest number of messages sent in one ioctl
+    MAX_MSGS = 8
+    ## Size of the shared transmit and receive buffers
+    BUFFER_SIZE = 256
+
+    ## Initialize the transport
+    #  @param self The object pointer.
+    #  @param bus_number Number N of the /dev/i2c-N device to open.
+    #  @param ioctl The ioctl function, fcntl.ioctl unless testing.
+    #  @param fd An already open file descriptor, instead of opening bus_number.
+    def __init__(self, bus_number = 1, ioctl = None, fd = None):
+        if ioctl is None:
+            if fcntl is None:
+                raise RuntimeError("I2C_RDWR transport needs fcntl")
+            ioctl = fcntl.ioctl
+        if fd is None:
+            fd = os.open('/dev/i2c-%d' % bus_number, os.O_RDWR)
+        self.fd = fd
+        self.ioctl = ioctl
+        self.calls = 0
+        self.bus_lock = threading.RLock()
+        self._tx = bytearray(self.BUFFER_SIZE)
+        self._rx = bytearray(self.BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx)
+        self._c_tx = (ctypes.c_uint8 * self.BUFFER_SIZE).from_buffer(self._tx)
+        self._c_rx = (ctypes.c_uint8 * self.BUFFER_SIZE).from_buffer(self._rx)
+        self._tx_addr = ctypes.addressof(self._c_tx)
+        self._msgs = (_i2c_msg * self.MAX_MSGS)()
+        self._data = _i2c_rdwr_ioctl_data(ctypes.cast(self._msgs, ctypes.POINTER(_i2c_msg)), 0)
+        self._byte_ptr = ctypes.POINTER(ctypes.c_uint8)
+
+    def _submit(self, nmsgs):
+        self._data.nmsgs = nmsgs
+        self.calls += 1
+        self.ioctl(self.fd, I2C_RDWR, self._data)
+
+    def readInto(self, address, reg, buf, offset, length):
+        if length > self.BUFFER_SIZE:
+            raise ValueError("read of %d registers exceeds transport buffer" % length)
+        msgs = self._msgs
+        self._tx[0] = reg
+        msgs[0].addr = address
+        msgs[0].flags = 0
+        msgs[0].len = 1
+        msgs[0].buf = ctypes.cast(self._c_tx, self._byte_ptr)
+        msgs[1].addr = address
+        msgs[1].flags = I2C_M_RD
+        msgs[1].len = length
+        msgs[1].buf = ctypes.cast(self._c_rx, self._byte_ptr)
+        self._submit(2)
+        buf[offset:offset + length] = self._rx_view[:length]
+
+    def writeBlocks(self, address, blocks):
+        # checked up front so an oversized block does not leave the others half sent
+        for reg, data in blocks:
+            if len(data) + 1 > self.BUFFER_SIZE:
+                raise ValueError("write of %d registers exceeds transport buffer" % len(data))
+        msgs = self._msgs
+        tx = self._tx
+        n = 0
+        pos = 0
+        for reg, data in blocks:
+            size = len(data) + 1
+            if n == self.MAX_MSGS or pos + size > self.BUFFER_SIZE:
+                self._submit(n)
+                n = 0
+                pos = 0
+            tx[pos] = reg
+            tx[pos + 1:pos + size] = data
+            msgs[n].addr = address
+            msgs[n].flags = 0
+            msgs[n].len = size
+            msgs[n].buf = ctypes.cast(self._tx_addr + pos, self._byte_ptr)
+            n += 1
+            pos += size
+        if n:
+            self._submit(n)
+
+    ## Closes the bus device
+    #  @param self The object pointer.
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+## SmartDrive_FakeI2C: in-memory stand-in for the kernel side of I2C_RDWR.
+#  Holds a 256 byte register file per address and decodes the message
+#  list passed to ioctl, so SmartDrive_RdwrTransport can be exercised
+#  without hardware.
+class SmartDrive_FakeI2C(object):
+
+    def __init__(self):
+        self.registers = {}
+        self.calls = 0
+        self.messages = 0
+
+    ## Returns the register file of a 7 bit address
+    def Registers(self, address):
+        regs = self.registers.get(address)
+        if regs is None:
+            regs = self.registers[address] = bytearray(256)
+        return regs
+
+    ## Returns a SmartDrive_RdwrTransport bound to this fake bus
+    def Transport(self):
+        return SmartDrive_RdwrTransport(ioctl = self.ioctl, fd = -1)
+
+    def ioctl(self, fd, request, data):
+        if request != I2C_RDWR:
+            raise IOError("unsupported ioctl 0x%x" % request)
+        self.calls += 1
+        pointer = 0
+        for i in range(data.nmsgs):
+            msg = data.msgs[i]
+            regs = self.Registers(msg.addr)
+            self.messages += 1
+            if msg.flags & I2C_M_RD:
+                for j in range(msg.len):
+                    msg.buf[j] = regs[(pointer + j) & 0xFF]
+                pointer += msg.len
+            else:
+                pointer = msg.buf[0]
+                for j in range(1, msg.len):
+                    regs[(pointer + j - 1) & 0xFF] = msg.buf[j]
+                pointer += msg.len - 1
+        return 0
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveTuner
+# PID gain tuning from step responses.
+#
+#   tuner = SmartDrive_Tuner([sd1, sd2], motor_number = 1)
+#   gains, score = tuner.Tune()
+#   tuner.Apply(gains, 'gains.json')
+#
+# Each experiment sets the gains, turns the motor a fixed number of degrees
+# with SmartDrive_Run_Degrees and holds it, records the tacho trace with
+# SmartDrive_Recorder and scores settle time, overshoot and steady state
+# error. A bounded compass search walks the gain space; every controller
+# given runs a different candidate at the same time. The gains are shared
+# by both motors of a controller, so candidates run in parallel across
+# controllers, not across the motors of one.
+#
+# Apply a saved profile at startup with SmartDrive(profile = 'gains.json')
+# or SmartDrive.LoadPerformanceProfile.
+
+from collections import namedtuple
+import threading
+import time
+
+from SmartDrive import SmartDrive, PERFORMANCE_PARAMETERS
+from SmartDriveRecorder import SmartDrive_Recorder
+from SmartDriveRegisters import clock
+
+## SmartDrive_Gains: the SetPerformanceParameters arguments.
+SmartDrive_Gains = namedtuple('SmartDrive_Gains', ' '.join(PERFORMANCE_PARAMETERS))
+
+## SmartDrive_StepScore: quality of one step response.
+#  settle_time   seconds until the position stays within the band, the window length if it never does.
+#  overshoot     counts travelled past the target.
+#  steady_error  counts between the final position and the target.
+#  cost          weighted sum the tuner minimizes.
+SmartDrive_StepScore = namedtuple('SmartDrive_StepScore', 'settle_time overshoot steady_error cost')
+
+## Default search bounds for each parameter.
+DEFAULT_BOUNDS = {'Kp_tacho': (0, 0xFFFF), 'Ki_tacho': (0, 0xFFFF), 'Kd_tacho': (0, 0xFFFF),
+                  'Kp_speed': (0, 0xFFFF), 'Ki_speed': (0, 0xFFFF), 'Kd_speed': (0, 0xFFFF),
+                  'passcount': (1, 0xFF), 'tolerance': (0, 0xFF)}
+
+## Scores a step response
+#  @param times Sample times, seconds from the step command.
+#  @param positions Tacho counts at those times.
+#  @param target The commanded tacho position.
+#  @param start The position before the step.
+#  @param window Seconds recorded; the settle time of a response that never settles.
+#  @param band Counts from the target that count as settled.
+#  @param overshoot_weight Cost in seconds of one count of overshoot.
+#  @param error_weight Cost in seconds of one count of steady state error.
+#  @return A SmartDrive_StepScore.
+def ScoreStep(times, positions, target, start, window, band = 3, overshoot_weight = 0.01, error_weight = 0.01):
+    if not len(positions):
+        return SmartDrive_StepScore(window, 0, 0, float('inf'))
+    direction = 1 if target >= start else -1
+    overshoot = 0
+    for p in positions:
+        past = (p - target) * direction
+        if past > overshoot:
+            overshoot = past
+    steady_error = abs(positions[-1] - target)
+    settle_time = window
+    if steady_error <= band:
+        settle_time = times[0]
+        for i in range(len(positions) - 1, -1, -1):
+            if abs(positions[i] - target) > band:
+                settle_time = times[i + 1]
+                break
+    cost = settle_time + overshoot_weight * overshoot + error_weight * steady_error
+    return SmartDrive_StepScore(settle_time, overshoot, steady_error, cost)
+
+## SmartDrive_Tuner: searches PID gains with step response experiments.
+class SmartDrive_Tuner(object):
+
+    ## Initialize the tuner
+    #  @param self The object pointer.
+    #  @param drives SmartDrives to run experiments on, one candidate each at a time.
+    #  @param motor_number Motor stepped on each SmartDrive, 1 or 2.
+    #  @param degrees Size of the step.
+    #  @param speed Speed of the step, 0 - 100.
+    #  @param window Seconds recorded after each step command.
+    #  @param rate Tacho samples per second.
+    #  @param band Counts from the target that count as settled.
+    #  @param tune Names of the parameters searched; the others keep their start values.
+    #  @param bounds Dict of name: (low, high) overriding DEFAULT_BOUNDS.
+    #  @param overshoot_weight Cost in seconds of one count of overshoot.
+    #  @param error_weight Cost in seconds of one count of steady state error.
+    def __init__(self, drives, motor_number = 1, degrees = 360, speed = 50, window = 1.5, rate = 500.0, band = 3,
+                 tune = ('Kp_tacho', 'Ki_tacho', 'Kd_tacho'), bounds = None,
+                 overshoot_weight = 0.01, error_weight = 0.01):
+        self.drives = list(drives)
+        self.motor_number = motor_number
+        self.degrees = degrees
+        self.speed = speed
+        self.window = window
+        self.band = band
+        self.tune = tuple(tune)
+        self.bounds = dict(DEFAULT_BOUNDS)
+        if bounds:
+            self.bounds.update(bounds)
+        self.overshoot_weight = overshoot_weight
+        self.error_weight = error_weight
+        capacity = int(rate * (window + 0.5)) + 16
+        self._recorders = [SmartDrive_Recorder(sd, rate, capacity) for sd in self.drives]
+        # alternate the step direction so the motors stay near where they started
+        self._directions = [SmartDrive.SmartDrive_Direction_Forward] * len(self.drives)
+        self.history = []
+
+    ## Runs one step response experiment
+    #  @param self The object pointer.
+    #  @param index Index of the SmartDrive in drives.
+    #  @param gains A SmartDrive_Gains to apply first.
+    #  @return A SmartDrive_StepScore.
+    def Experiment(self, index, gains):
+        sd = self.drives[index]
+        recorder = self._recorders[index]
+        direction = self._directions[index]
+        self._directions[index] = direction ^ 1
+        sd.SetPerformanceParameters(*gains)
+        start = sd.ReadTachometerPosition(self.motor_number)
+        target = start + self.degrees if direction == sd.SmartDrive_Direction_Forward else start - self.degrees
+        recorder.Start()
+        t0 = clock()
+        sd.SmartDrive_Run_Degrees(self.motor_number, direction, self.speed, self.degrees,
+                                  sd.SmartDrive_Completion_Dont_Wait, sd.SmartDrive_Next_Action_BrakeHold)
+        time.sleep(max(0.0, t0 + self.window - clock()))
+        recorder.Stop()
+        times, positions = recorder.Trace(self.motor_number)
+        first = 0
+        while first < len(times) and times[first] < t0:
+            first += 1
+        step_times = [t - t0 for t in times[first:]]
+        return ScoreStep(step_times, positions[first:], target, start, self.window, self.band,
+                         self.overshoot_weight, self.error_weight)
+
+    ## Scores a list of candidates, running one per SmartDrive at a time
+    #  @param self The object pointer.
+    #  @param candidates List of SmartDrive_Gains.
+    #  @return List of SmartDrive_StepScore, in the same order.
+    def Evaluate(self, candidates):
+        scores = [None] * len(candidates)
+        errors = []
+
+        def run(index, slot):
+            try:
+                scores[slot] = self.Experiment(index, candidates[slot])
+            except Exception as e:
+                errors.append(e)
+
+        for base in range(0, len(candidates), len(self.drives)):
+            threads = []
+            for index in range(min(len(self.drives), len(candidates) - base)):
+                thread = threading.Thread(target = run, args = (index, base + index), name = 'SmartDriveTuner')
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+        for gains, score in zip(candidates, scores):
+            self.history.append((gains, score))
+        return scores
+
+    def _clip(self, name, value):
+        low, high = self.bounds[name]
+        return min(max(int(value), low), high)
+
+    ## Searches the gains
+    #  Compass search: every tuned parameter is moved up and down by its
+    #  step; the best neighbour is taken if it beats the current gains,
+    #  otherwise the steps are halved. Stops when all steps are below one or
+    #  after max_evaluations experiments.
+    #  @param self The object pointer.
+    #  @param initial Start gains, a SmartDrive_Gains; read from the first SmartDrive by default.
+    #  @param steps Dict of name: first step, half the start value (at least 4) by default.
+    #  @param max_evaluations Largest number of experiments run.
+    #  @return (best SmartDrive_Gains, its SmartDrive_StepScore)
+    def Tune(self, initial = None, steps = None, max_evaluations = 60):
+        if initial is None:
+            initial = SmartDrive_Gains(*self.drives[0].GetPerformanceParameters())
+        best = SmartDrive_Gains(*[self._clip(name, getattr(initial, name)) for name in PERFORMANCE_PARAMETERS])
+        if steps is None:
+            steps = dict((name, max(4, getattr(best, name) // 2)) for name in self.tune)
+        else:
+            steps = dict(steps)
+        best_score = self.Evaluate([best])[0]
+        seen = set([best])
+        evaluations = 1
+        while evaluations < max_evaluations and any(step >= 1 for step in steps.values()):
+            candidates = []
+            for name in self.tune:
+                for sign in (1, -1):
+                    value = self._clip(name, getattr(best, name) + sign * steps[name])
+                    candidate = best._replace(**{name: value})
+                    if candidate not in seen:
+                        seen.add(candidate)
+                        candidates.append(candidate)
+            candidates = candidates[:max_evaluations - evaluations]
+            if not candidates:
+                steps = dict((name, step // 2) for name, step in steps.items())
+                continue
+            scores = self.Evaluate(candidates)
+            evaluations += len(candidates)
+            improved = False
+            for candidate, score in zip(candidates, scores):
+                if score.cost < best_score.cost:
+                    best, best_score = candidate, score
+                    improved = True
+            if not improved:
+                steps = dict((name, step // 2) for name, step in steps.items())
+        return best, best_score
+
+    ## Sets gains on every SmartDrive and optionally saves them as their profile
+    #  @param self The object pointer.
+    #  @param gains A SmartDrive_Gains.
+    #  @param path Profile file to update, see SmartDrive.SavePerformanceProfile.
+    def Apply(self, gains, path = None):
+        for sd in self.drives:
+            sd.SetPerformanceParameters(*gains)
+            if path:
+                sd.SavePerformanceProfile(path)
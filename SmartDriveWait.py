@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2014 OpenElectrons.com
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+
+## @package SmartDriveWait
+# Completion waiting for SmartDrive moves, driven by an estimate of when
+# the move will finish instead of a fixed poll period.
+
+from collections import namedtuple
+import time
+
+from SmartDriveErrors import SmartDrive_TimeoutError
+from SmartDriveRegisters import clock, POSITIONS_STATUS
+
+# Status bits that stay set while a timed or tacho move is running.
+STATUS_TIME = 0x40
+STATUS_TACHO = 0x08
+
+## SmartDrive_WaitReport: what one completion wait cost.
+#  polls     number of status reads made.
+#  elapsed   seconds from the start of the wait until completion was seen.
+#  estimate  seconds the engine first expected the move to take.
+#  overshoot upper bound, in seconds, on how long after the real completion
+#            it was noticed (time since the last poll that still saw it busy).
+SmartDrive_WaitReport = namedtuple('SmartDrive_WaitReport', 'polls elapsed estimate overshoot')
+
+## SmartDrive_WaitSchedule: when to read the status during one wait.
+#  Does no I/O and no sleeping, so the blocking waits of the engine and the
+#  asyncio ones of AsyncSmartDrive follow the same schedule.
+class SmartDrive_WaitSchedule(object):
+
+    ## Starts a schedule
+    #  @param self The object pointer.
+    #  @param engine The SmartDrive_WaitEngine whose settings to use.
+    #  @param motor_number Number of the motor(s) waited for.
+    #  @param estimate Seconds the move is expected to take, None if unknown.
+    #  @param t0 Time the move was started, on the clock the caller passes to Next and Done.
+    def __init__(self, engine, motor_number, estimate, t0):
+        self.engine = engine
+        self.motor_number = motor_number
+        self.estimate = estimate
+        self.t0 = t0
+        self.eta = t0 + (estimate or 0.0)
+        self.earliest = t0 + engine.status_delay
+        self.timeout = engine.Timeout(estimate)
+        self.deadline = t0 + self.timeout
+        self.polls = 0
+        self.t_busy = t0
+
+    ## Returns the time of the next status read
+    #  @param self The object pointer.
+    #  @param now The current time.
+    #  @param remaining Estimated seconds until the move ends, by default from the start estimate.
+    def Next(self, now, remaining = None):
+        if remaining is None:
+            remaining = self.eta - now
+        return min(max(self.earliest, now + self.engine.Interval(remaining)), self.deadline)
+
+    ## Records a status read
+    #  @param self The object pointer.
+    #  @param now Time of the read.
+    #  @param busy True if the read showed the motor(s) still running.
+    #  @return True once the move is done.
+    #  @exception SmartDrive_TimeoutError The move is still running past the deadline.
+    def Done(self, now, busy):
+        self.polls += 1
+        if not busy:
+            return True
+        if now >= self.deadline:
+            raise SmartDrive_TimeoutError("motor %d not done after %g seconds" % (self.motor_number, self.timeout),
+                                          self.motor_number, self.timeout)
+        self.t_busy = now
+        return False
+
+    ## Returns the SmartDrive_WaitReport of a finished wait and keeps it as the engine's last_report
+    #  @param self The object pointer.
+    #  @param now Time completion was seen.
+    def Report(self, now):
+        report = SmartDrive_WaitReport(self.polls, now - self.t0, self.estimate, now - self.t_busy)
+        self.engine.last_report = report
+        return report
+
+## SmartDrive_WaitEngine: sleeps until close to the expected end of a move,
+#  then polls more densely as it gets closer.
+#
+#  However long the move, the first status read is scheduled margin seconds
+#  before its estimated end. From there the next poll comes after
+#  fraction * (estimated time remaining), clamped to [min_interval,
+#  max_interval]. Past the estimate the gap grows with the time overdue, up
+#  to max_interval, so a stalled motor or a wrong estimate costs one read
+#  every max_interval. A small fraction and min_interval give low
+#  completion latency at the cost of more bus reads; larger values cut bus
+#  load.
+#
+#  Every wait has a deadline: timeout if set, otherwise timeout_factor
+#  times the estimate plus timeout_floor, or default_timeout when there is
+#  no estimate. Past it SmartDrive_TimeoutError is raised.
+class SmartDrive_WaitEngine(object):
+
+    ## Initialize the wait engine
+    #  @param self The object pointer.
+    #  @param min_interval Shortest gap between two status reads, in seconds.
+    #  @param max_interval Longest gap between two status reads near or past the estimated end, in seconds.
+    #  @param fraction Part of the estimated remaining time to sleep before the next read.
+    #  @param status_delay Time after a command before the status byte is valid, in seconds.
+    #  @param full_speed_rate Tacheometer counts per second at speed 100, used until a live rate is measured.
+    #  @param timeout Seconds any wait may take at most, None to derive the deadline from the estimate.
+    #  @param margin Seconds before the estimated end at which dense polling starts.
+    #  @param timeout_factor Multiple of the estimate a wait may take.
+    #  @param timeout_floor Seconds added to the estimated deadline.
+    #  @param default_timeout Seconds a wait without an estimate may take; longer than the longest timed run (255 s).
+    def __init__(self, min_interval = 0.002, max_interval = 0.050, fraction = 0.5,
+                 status_delay = 0.050, full_speed_rate = 1000.0, timeout = None, margin = 0.050,
+                 timeout_factor = 3.0, timeout_floor = 1.0, default_timeout = 300.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.fraction = fraction
+        self.status_delay = status_delay
+        self.full_speed_rate = full_speed_rate
+        self.timeout = timeout
+        self.margin = margin
+        self.timeout_factor = timeout_factor
+        self.timeout_floor = timeout_floor
+        self.default_timeout = default_timeout
+        self.last_report = None
+
+    ## Returns the seconds a wait may take
+    #  @param self The object pointer.
+    #  @param estimate Seconds the move is expected to take, None if unknown.
+    def Timeout(self, estimate = None):
+        if self.timeout is not None:
+            return self.timeout
+        if estimate is None:
+            return self.default_timeout
+        return self.status_delay + self.timeout_factor * estimate + self.timeout_floor
+
+    ## Returns the seconds to sleep before the next status read
+    #  @param self The object pointer.
+    #  @param remaining Estimated seconds until the move ends, negative once overdue.
+    def Interval(self, remaining):
+        if remaining > self.margin + self.min_interval:
+            # far from done: sleep through to shortly before the estimated end
+            return remaining - self.margin
+        # close to or past the estimate
+        interval = abs(remaining) * self.fraction
+        if interval < self.min_interval:
+            return self.min_interval
+        if interval > self.max_interval:
+            return self.max_interval
+        return interval
+
+    ## Returns a SmartDrive_WaitSchedule for a move started at t0
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s) waited for.
+    #  @param estimate Seconds the move is expected to take, None if unknown.
+    #  @param t0 Start time, now on the monotonic clock by default.
+    def Schedule(self, motor_number, estimate, t0 = None):
+        return SmartDrive_WaitSchedule(self, motor_number, estimate, clock() if t0 is None else t0)
+
+    ## Returns the tacheometer counts per second expected at a speed
+    #  @param self The object pointer.
+    #  @param speed The commanded speed.
+    def TachoRate(self, speed):
+        rate = abs(speed) * self.full_speed_rate / 100.0
+        if rate <= 0:
+            rate = self.full_speed_rate / 100.0
+        return rate
+
+    ## Returns the seconds a tacho move is expected to take
+    #  @param self The object pointer.
+    #  @param speed The commanded speed.
+    #  @param counts The tacheometer counts to travel.
+    def TachoEstimate(self, speed, counts):
+        return abs(counts) / self.TachoRate(speed)
+
+    def _sleepUntil(self, when):
+        delay = when - clock()
+        if delay > 0:
+            time.sleep(delay)
+
+    ## Waits for a timed move started just now to complete
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive running the move.
+    #  @param motor_number Number of the motor(s) to wait for.
+    #  @param duration The commanded run time in seconds.
+    #  @return A SmartDrive_WaitReport.
+    def WaitTime(self, sd, motor_number, duration):
+        schedule = self.Schedule(motor_number, duration)
+        status = bytearray(2)
+        while True:
+            self._sleepUntil(schedule.Next(clock()))
+            sd.readBlockInto(sd.SmartDrive_STATUS_M1, status, 0, 2)
+            now = clock()
+            if schedule.Done(now, self.Busy(motor_number, status[0], status[1], STATUS_TIME)):
+                return schedule.Report(now)
+
+    ## Waits for a tacho move started just now to complete
+    #  @param self The object pointer.
+    #  @param sd The SmartDrive running the move.
+    #  @param motor_number Number of the motor(s) to wait for.
+    #  @param speed The commanded speed, or a (m1, m2) pair.
+    #  @param delta The relative tacheometer count of the move, or a (m1, m2) pair, or None.
+    #  @param target The absolute tacheometer target of the move, or a (m1, m2) pair, or None.
+    #  @return A SmartDrive_WaitReport.
+    def WaitTacho(self, sd, motor_number, speed, delta = None, target = None):
+        t0 = clock()
+        buf = bytearray(POSITIONS_STATUS.size)
+        if not isinstance(speed, tuple):
+            speed = (speed, speed)
+        rates = [self.TachoRate(speed[0]), self.TachoRate(speed[1])]
+        # Read the start positions right after the command went out.
+        sd.readBlockInto(sd.SmartDrive_POSITION_M1, buf, 0, POSITIONS_STATUS.size)
+        p1, p2, s1, s2 = POSITIONS_STATUS.unpack_from(buf)
+        if delta is not None:
+            if not isinstance(delta, tuple):
+                delta = (delta, delta)
+            targets = (p1 + delta[0], p2 + delta[1])
+        elif isinstance(target, tuple):
+            targets = target
+        else:
+            targets = (target, target)
+        prev = (p1, p2)
+        t_prev = clock()
+        schedule = None
+        while True:
+            # the move ends when the slower motor gets there
+            eta = 0.0
+            if motor_number & 0x01:
+                eta = abs(targets[0] - prev[0]) / rates[0]
+            if motor_number & 0x02:
+                eta = max(eta, abs(targets[1] - prev[1]) / rates[1])
+            if schedule is None:
+                schedule = self.Schedule(motor_number, eta, t0)
+                # the start position read counts as a busy poll
+                schedule.Done(t_prev, True)
+            self._sleepUntil(schedule.Next(clock(), eta))
+            sd.readBlockInto(sd.SmartDrive_POSITION_M1, buf, 0, POSITIONS_STATUS.size)
+            now = clock()
+            p1, p2, s1, s2 = POSITIONS_STATUS.unpack_from(buf)
+            if schedule.Done(now, self.Busy(motor_number, s1, s2, STATUS_TACHO)):
+                return schedule.Report(now)
+            # Refine the rate estimates from the live tachometer movement.
+            if now > t_prev:
+                for m, moved in ((0, abs(p1 - prev[0])), (1, abs(p2 - prev[1]))):
+                    if moved:
+                        rates[m] = 0.5 * rates[m] + 0.5 * (moved / (now - t_prev))
+            prev = (p1, p2)
+            t_prev = now
+
+    ## Returns True while the given status bit is set on any of the motor(s)
+    #  @param self The object pointer.
+    #  @param motor_number Number of the motor(s).
+    #  @param status_m1 Status byte of motor 1.
+    #  @param status_m2 Status byte of motor 2.
+    #  @param bit STATUS_TIME or STATUS_TACHO.
+    def Busy(self, motor_number, status_m1, status_m2, bit):
+        if ( motor_number & 0x01 ) and ( status_m1 & bit ):
+            return True
+        if ( motor_number & 0x02 ) and ( status_m2 & bit ):
+            return True
+        return False
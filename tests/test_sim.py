@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Tests of SmartDrive and the shadow transport against the simulator.
+
+import time
+import unittest
+
+from SmartDrive import SmartDrive
+from SmartDriveShadow import EnableShadow
+from SmartDriveSim import SmartDrive_SimTransport
+
+class _FailingTransport(object):
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.fail = False
+
+    def readInto(self, address, reg, buf, offset, length):
+        self.inner.readInto(address, reg, buf, offset, length)
+
+    def writeBlocks(self, address, blocks):
+        if self.fail:
+            raise IOError("write failed")
+        self.inner.writeBlocks(address, blocks)
+
+class SmartDriveSimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = SmartDrive_SimTransport()
+        self.sim = self.bus.Attach()
+        self.sd = SmartDrive(transport = self.bus)
+
+    def test_unlimited_both_is_one_transaction(self):
+        self.sim.registers[SmartDrive.SmartDrive_SETPT_M1] = 0x7F
+        before = self.bus.transactions
+        self.sd.SmartDrive_Run_Unlimited(SmartDrive.SmartDrive_Motor_Both, SmartDrive.SmartDrive_Direction_Forward, 50)
+        self.assertEqual(self.bus.transactions - before, 1)
+        # the setpoint bytes are not part of the block
+        self.assertEqual(self.sim.registers[SmartDrive.SmartDrive_SETPT_M1], 0x7F)
+        time.sleep(0.05)
+        self.assertTrue(self.sd.ReadTachometerPosition(1) > 0)
+        self.assertTrue(self.sd.ReadTachometerPosition(2) > 0)
+        self.sd.SmartDrive_Stop(SmartDrive.SmartDrive_Motor_Both, SmartDrive.SmartDrive_Next_Action_Brake)
+
+    def test_degrees_wait_for(self):
+        self.sd.SmartDrive_Run_Degrees(1, SmartDrive.SmartDrive_Direction_Forward, 100, 90,
+                                       SmartDrive.SmartDrive_Completion_Wait_For,
+                                       SmartDrive.SmartDrive_Next_Action_Brake)
+        self.assertTrue(abs(self.sd.ReadTachometerPosition(1) - 90) <= 5)
+
+    def test_battery_voltage(self):
+        self.assertTrue(abs(self.sd.GetBattVoltage() - 9000) < SmartDrive.SmartDrive_VOLTAGE_MULTIPLIER)
+
+class ShadowSimTest(unittest.TestCase):
+
+    PID = (100, 20, 5, 80, 10, 2, 3, 4)
+
+    def setUp(self):
+        self.bus = SmartDrive_SimTransport()
+        self.sim = self.bus.Attach()
+        self.failing = _FailingTransport(self.bus)
+        self.sd = SmartDrive(transport = self.failing)
+        self.shadow = EnableShadow(self.sd)
+
+    def test_unchanged_write_is_skipped(self):
+        self.sd.SetPerformanceParameters(*self.PID)
+        before = self.bus.transactions
+        self.sd.SetPerformanceParameters(*self.PID)
+        self.assertEqual(self.bus.transactions, before)
+        self.assertEqual(self.shadow.Counters()['saved_writes'], 1)
+        self.sd.GetPerformanceParameters()
+        self.assertEqual(self.bus.transactions, before)
+
+    def test_failed_write_is_sent_again(self):
+        self.sd.SetPerformanceParameters(*self.PID)
+        self.failing.fail = True
+        changed = (1,) + self.PID[1:]
+        self.assertRaises(Exception, self.sd.SetPerformanceParameters, *changed)
+        self.failing.fail = False
+        before = self.bus.transactions
+        self.sd.SetPerformanceParameters(*changed)
+        self.assertEqual(self.bus.transactions - before, 1)
+        self.assertEqual(self.sim.registers[SmartDrive.SmartDrive_P_Kp], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Tests of SmartDrive_RdwrTransport against SmartDrive_FakeI2C.
+
+import unittest
+
+from SmartDriveTransport import SmartDrive_FakeI2C, SmartDrive_RdwrTransport
+
+ADDRESS = 0x1B
+
+class RdwrTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = SmartDrive_FakeI2C()
+        self.transport = self.fake.Transport()
+        self.regs = self.fake.Registers(ADDRESS)
+
+    def test_read_is_one_ioctl(self):
+        self.regs[0x52:0x56] = bytearray([1, 2, 3, 4])
+        buf = bytearray(6)
+        self.transport.readInto(ADDRESS, 0x52, buf, 1, 4)
+        self.assertEqual(buf, bytearray([0, 1, 2, 3, 4, 0]))
+        self.assertEqual(self.fake.calls, 1)
+        self.assertEqual(self.fake.messages, 2)
+        self.assertEqual(self.transport.calls, 1)
+
+    def test_blocks_go_out_in_one_ioctl(self):
+        self.transport.writeBlocks(ADDRESS, [(0x42, bytearray([1, 2, 3])), (0x41, bytearray([0x53]))])
+        self.assertEqual(self.regs[0x41:0x45], bytearray([0x53, 1, 2, 3]))
+        self.assertEqual(self.fake.calls, 1)
+        self.assertEqual(self.fake.messages, 2)
+
+    def test_max_msgs_flushes(self):
+        count = SmartDrive_RdwrTransport.MAX_MSGS + 1
+        blocks = [(0x10 + i, bytearray([i + 1])) for i in range(count)]
+        self.transport.writeBlocks(ADDRESS, blocks)
+        self.assertEqual(self.regs[0x10:0x10 + count], bytearray(range(1, count + 1)))
+        self.assertEqual(self.fake.calls, 2)
+        self.assertEqual(self.fake.messages, count)
+
+    def test_buffer_overflow_splits(self):
+        # two blocks that fit the buffer alone but not together
+        size = SmartDrive_RdwrTransport.BUFFER_SIZE // 2
+        first = bytearray([0xAA]) * size
+        second = bytearray([0x55]) * 8
+        self.transport.writeBlocks(ADDRESS, [(0x00, first), (0xC0, second)])
+        self.assertEqual(self.regs[0x00:size], first)
+        self.assertEqual(self.regs[0xC0:0xC8], second)
+        self.assertEqual(self.fake.calls, 1)
+        self.transport.writeBlocks(ADDRESS, [(0x00, first), (0x00, first)])
+        self.assertEqual(self.fake.calls, 3)
+
+    def test_oversized_block_sends_nothing(self):
+        small = (0x41, bytearray([0x53]))
+        big = (0x00, bytearray(SmartDrive_RdwrTransport.BUFFER_SIZE))
+        self.assertRaises(ValueError, self.transport.writeBlocks, ADDRESS, [small, big])
+        self.assertEqual(self.fake.calls, 0)
+        self.assertEqual(self.regs[0x41], 0)
+
+    def test_oversized_read(self):
+        buf = bytearray(SmartDrive_RdwrTransport.BUFFER_SIZE + 1)
+        self.assertRaises(ValueError, self.transport.readInto, ADDRESS, 0, buf, 0, len(buf))
+        self.assertEqual(self.fake.calls, 0)
+
+    def test_addresses_are_separate(self):
+        self.transport.writeBlocks(ADDRESS, [(0x41, bytearray([1]))])
+        self.transport.writeBlocks(ADDRESS + 1, [(0x41, bytearray([2]))])
+        self.assertEqual(self.fake.Registers(ADDRESS)[0x41], 1)
+        self.assertEqual(self.fake.Registers(ADDRESS + 1)[0x41], 2)
+
+if __name__ == '__main__':
+    unittest.main()